@@ -1,8 +1,10 @@
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, HTTPException, Query, Header
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List
 from config import load_config
-import itertools
+from logsource import LogSet
+import json, itertools
 
 cfg = load_config()
 app = FastAPI(title="Collector Service (BGL)")
@@ -10,6 +12,12 @@ app = FastAPI(title="Collector Service (BGL)")
 DATASET_PATH = cfg["dataset_path"]
 ENCODING = cfg.get("encoding", "utf-8")
 DEFAULT_BATCH = int(cfg.get("batch_size", 1000))
+STREAM_CHUNK = int(cfg.get("stream_chunk_rows", 10000))
+# dataset_path — путь, glob или список (BGL.log.2.gz, BGL.log.1, BGL.log ...)
+LOGS = LogSet(DATASET_PATH, ENCODING, threads=int(cfg.get("decompress_threads", 4)))
+
+NDJSON_MEDIA = "application/x-ndjson"
+ARROW_MEDIA  = "application/vnd.apache.arrow.stream"
 
 class LogLine(BaseModel):
     line_id: int
@@ -26,29 +34,119 @@ class BatchResponse(BaseModel):
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "dataset_path": DATASET_PATH}
+    try:
+        files = LOGS.files()
+    except FileNotFoundError:
+        files = []
+    return {"status": "ok", "dataset_path": DATASET_PATH, "dataset_files": files}
 
-def parse_bgl_line(idx: int, line: str) -> LogLine:
+def parse_bgl_fields(idx: int, line: str) -> dict:
     s = line.rstrip("\n")
     if not s:
-        return LogLine(line_id=idx, raw="", alert_tag="-", is_alert=False, message="")
+        return {"line_id": idx, "raw": "", "alert_tag": "-", "is_alert": False, "message": ""}
     parts = s.split(maxsplit=1)
     first = parts[0]
     rest = parts[1] if len(parts) > 1 else ""
     is_alert = (first != "-")
-    return LogLine(line_id=idx, raw=s, alert_tag=first, is_alert=is_alert, message=rest)
+    return {"line_id": idx, "raw": s, "alert_tag": first, "is_alert": is_alert, "message": rest}
+
+def parse_bgl_line(idx: int, line: str) -> LogLine:
+    return LogLine(**parse_bgl_fields(idx, line))
+
+def iter_slice(start: int, stop: int):
+    try:
+        yield from LOGS.iter_slice(start, stop)
+    except FileNotFoundError as e:
+        raise HTTPException(404, str(e))
+
+def iter_row_chunks(start: int, stop: int):
+    rows = []
+    for idx, line in iter_slice(start, stop):
+        rows.append(parse_bgl_fields(idx, line))
+        if len(rows) == STREAM_CHUNK:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+def open_row_chunks(start: int, stop: int):
+    """
+    Первый кусок читается до ответа: ошибка открытия набора (нет файлов) уходит
+    клиенту как 404, а не обрывом уже начатого потока с кодом 200.
+    """
+    chunks = iter_row_chunks(start, stop)
+    first = next(chunks, None)
+    return itertools.chain([] if first is None else [first], chunks)
+
+def ndjson_stream(chunks):
+    for rows in chunks:
+        yield "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
 
-def iter_slice(path: str, start: int, stop: int):
-    with open(path, "r", encoding=ENCODING, errors="replace") as f:
-        for idx, line in itertools.islice(enumerate(f), start, stop):
-            yield idx, line
+class _ChunkSink:
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def arrow_stream(chunks):
+    """Arrow IPC stream: по одному record batch на STREAM_CHUNK строк."""
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ("line_id", pa.int64()), ("raw", pa.string()), ("alert_tag", pa.string()),
+        ("is_alert", pa.bool_()), ("message", pa.string()),
+    ])
+    out: list[bytes] = []
+    writer = pa.ipc.new_stream(pa.PythonFile(_ChunkSink(out), mode="w"), schema)
+    for rows in chunks:
+        writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+        yield b"".join(out)
+        out.clear()
+    writer.close()
+    yield b"".join(out)
+
+def response_format(fmt: str | None, accept: str | None) -> str:
+    """format= важнее Accept; по умолчанию — обычный JSON-ответ."""
+    if fmt:
+        return fmt
+    accept = accept or ""
+    if ARROW_MEDIA in accept:
+        return "arrow"
+    if NDJSON_MEDIA in accept:
+        return "ndjson"
+    return "json"
 
 @app.get("/collect", response_model=BatchResponse)
-def collect_batch(offset: int = Query(0, ge=0), limit: int = Query(DEFAULT_BATCH, gt=0)):
+def collect_batch(offset: int = Query(0, ge=0), limit: int = Query(DEFAULT_BATCH, gt=0),
+                  format: str | None = Query(None, pattern="^(json|ndjson|arrow)$"),
+                  accept: str | None = Header(None)):
+    """
+    format=ndjson|arrow (или соответствующий Accept) отдаёт строки потоком
+    по мере чтения файла, с постоянным потреблением памяти.
+    """
     start = offset
+    fmt = response_format(format, accept)
+    if fmt == "arrow":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(406, "pyarrow is not installed, use format=ndjson")
+        return StreamingResponse(arrow_stream(open_row_chunks(start, offset + limit)), media_type=ARROW_MEDIA)
+    if fmt == "ndjson":
+        return StreamingResponse(ndjson_stream(open_row_chunks(start, offset + limit)), media_type=NDJSON_MEDIA)
+
     end = offset + limit
     items: list[LogLine] = []
-    for idx, line in iter_slice(DATASET_PATH, start, end):
+    for idx, line in iter_slice(start, end):
         items.append(parse_bgl_line(idx, line))
     return BatchResponse(start=start, end=start+len(items), total=None, data=items)
 
@@ -0,0 +1,138 @@
+import os, re, io, glob, gzip, queue, threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # .zst без zstandard не читаются, остальное работает
+    zstandard = None
+
+
+def rotation_key(path: str):
+    """
+    Порядок файлов ротации: BGL.log.2.gz, BGL.log.1.zst, BGL.log — от старых к живому.
+    Расширение сжатия отбрасывается, числовой суффикс ротации сортируется по убыванию.
+    """
+    name = re.sub(r"\.(gz|zst)$", "", path)
+    m = re.match(r"^(.*?)(?:\.(\d+))?$", name)
+    return m.group(1), (-int(m.group(2)) if m.group(2) else 1), path
+
+def resolve_log_files(spec) -> list[str]:
+    """dataset_path — путь, glob-шаблон или список из них."""
+    files = set()
+    for item in ([spec] if isinstance(spec, str) else spec):
+        files.update(p for p in glob.glob(item) if os.path.isfile(p))
+    if not files:
+        raise FileNotFoundError(f"No log files match {spec!r}")
+    return sorted(files, key=rotation_key)
+
+def open_binary(path: str):
+    """Потоковое чтение с распаковкой .gz/.zst на лету, без временных файлов."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is not installed, cannot read {path}")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True,
+                                                           read_across_frames=True)
+    return open(path, "rb")
+
+def open_text(path: str, encoding: str):
+    # строки режутся только по '\n', как в C++-майнере, иначе line_id разъедутся
+    return io.TextIOWrapper(open_binary(path), encoding=encoding, errors="replace", newline="\n")
+
+
+class LogSet:
+    """
+    Упорядоченный набор логов (ротация + сжатие) как одна последовательность строк
+    со сквозными line_id. Число строк закрытых файлов кэшируется по (path, size, mtime),
+    поэтому offset пропускает целые файлы без распаковки; файлы после нужного
+    распаковываются заранее в threads потоках в ограниченные очереди чанков.
+    """
+
+    def __init__(self, spec, encoding: str = "utf-8", threads: int = 4,
+                 chunk_lines: int = 10000, queue_chunks: int = 8):
+        self.spec = spec
+        self.encoding = encoding
+        self.threads = max(int(threads), 1)
+        self.chunk_lines = chunk_lines
+        self.queue_chunks = queue_chunks
+        self._counts: dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def files(self) -> list[str]:
+        # набор перечитывается на каждый запрос: ротация добавляет файлы
+        return resolve_log_files(self.spec)
+
+    def line_count(self, path: str) -> int:
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._counts.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        n, last = 0, b"\n"
+        with open_binary(path) as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                n += block.count(b"\n")
+                last = block[-1:]
+        n += last != b"\n"
+        with self._lock:
+            self._counts[path] = (key, n)
+        return n
+
+    def _produce(self, path: str, out: queue.Queue, cancel: threading.Event):
+        def put(item):
+            while not cancel.is_set():
+                try:
+                    out.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            with open_text(path, self.encoding) as f:
+                while not cancel.is_set():
+                    chunk = f.readlines(self.chunk_lines * 256)
+                    if not chunk or not put(chunk):
+                        break
+        except Exception as e:
+            put(e)
+        put(None)
+
+    def iter_slice(self, start: int, stop: int):
+        """(line_id, line) для line_id из [start, stop)."""
+        files = self.files()
+        base, first = 0, 0
+        if start > 0 and len(files) > 1:
+            # живой (последний) файл не считаем — он растёт, его читаем всегда
+            with ThreadPoolExecutor(self.threads) as ex:
+                counts = list(ex.map(self.line_count, files[:-1]))
+            while first < len(counts) and base + counts[first] <= start:
+                base += counts[first]
+                first += 1
+        files = files[first:]
+        cancel = threading.Event()
+        queues = [queue.Queue(self.queue_chunks) for _ in files]
+        ex = ThreadPoolExecutor(self.threads)
+        try:
+            # задачи стартуют по порядку, поэтому текущий файл всегда уже в работе
+            for path, q in zip(files, queues):
+                ex.submit(self._produce, path, q, cancel)
+            idx = base
+            for q in queues:
+                while (chunk := q.get()) is not None:
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    if idx + len(chunk) <= start:
+                        idx += len(chunk)
+                        continue
+                    for line in chunk:
+                        if idx >= stop:
+                            return
+                        if idx >= start:
+                            yield idx, line
+                        idx += 1
+        finally:
+            cancel.set()
+            ex.shutdown(wait=False, cancel_futures=True)
@@ -8,39 +8,223 @@
 #include <cctype>
 #include <set>
 #include <map>
+#include <unordered_set>
+#include <thread>
+#include <future>
+#include <stdexcept>
+#include <exception>
+#include <atomic>
+#include <chrono>
+#include <cstdio>
+#include <zlib.h>
+#ifdef HAVE_ZSTD
+#include <zstd.h>
+#endif
 
 namespace fs = std::filesystem;
 
+// Построчное чтение .log / .log.N как есть и .gz / .zst (при сборке с -DHAVE_ZSTD)
+// с распаковкой на лету, без временных файлов.
+class LineReader {
+    std::ifstream plain;
+    gzFile gz = nullptr;
+#ifdef HAVE_ZSTD
+    FILE* zf = nullptr;
+    ZSTD_DCtx* dctx = nullptr;
+    std::vector<char> zin, zout;
+    ZSTD_inBuffer ib{nullptr, 0, 0};
+    bool zeof = false;
+#endif
+    std::string pending;
+    size_t pos = 0;
+    bool ok = false;
+
+    static bool ends_with(const std::string& s, const std::string& suffix) {
+        return s.size() >= suffix.size() && s.compare(s.size() - suffix.size(), suffix.size(), suffix) == 0;
+    }
+
+    // дочитывает очередной распакованный блок в pending; false — данные кончились,
+    // повреждённый поток — исключение (его получит collect() через future файла)
+    bool fill() {
+        if (pos > 0) {
+            pending.erase(0, pos);
+            pos = 0;
+        }
+        char buf[1 << 16];
+        if (gz) {
+            int n = gzread(gz, buf, sizeof(buf));
+            if (n < 0) {
+                int err;
+                throw std::runtime_error(std::string("gzip read error: ") + gzerror(gz, &err));
+            }
+            if (n == 0) return false;
+            pending.append(buf, n);
+            return true;
+        }
+#ifdef HAVE_ZSTD
+        while (true) {
+            if (ib.pos == ib.size) {
+                if (zeof) return false;
+                size_t n = fread(zin.data(), 1, zin.size(), zf);
+                if (n == 0) { zeof = true; return false; }
+                ib = {zin.data(), n, 0};
+            }
+            ZSTD_outBuffer ob{zout.data(), zout.size(), 0};
+            size_t ret = ZSTD_decompressStream(dctx, &ob, &ib);
+            if (ZSTD_isError(ret)) throw std::runtime_error(std::string("zstd read error: ") + ZSTD_getErrorName(ret));
+            if (ob.pos) {
+                pending.append(zout.data(), ob.pos);
+                return true;
+            }
+        }
+#endif
+        return false;
+    }
+
+public:
+    explicit LineReader(const fs::path& path) {
+        std::string p = path.string();
+        if (ends_with(p, ".gz")) {
+            gz = gzopen(p.c_str(), "rb");
+            ok = gz != nullptr;
+            if (ok) gzbuffer(gz, 1 << 17);
+        } else if (ends_with(p, ".zst")) {
+#ifdef HAVE_ZSTD
+            zf = fopen(p.c_str(), "rb");
+            ok = zf != nullptr;
+            if (ok) {
+                dctx = ZSTD_createDCtx();
+                zin.resize(ZSTD_DStreamInSize());
+                zout.resize(ZSTD_DStreamOutSize());
+            }
+#else
+            std::cerr << "zstd support not compiled in: " << p << std::endl;
+#endif
+        } else {
+            plain.open(path);
+            ok = plain.is_open();
+        }
+    }
+
+    ~LineReader() {
+        if (gz) gzclose(gz);
+#ifdef HAVE_ZSTD
+        if (dctx) ZSTD_freeDCtx(dctx);
+        if (zf) fclose(zf);
+#endif
+    }
+
+    explicit operator bool() const { return ok; }
+
+    bool getline(std::string& line) {
+        if (plain.is_open()) return static_cast<bool>(std::getline(plain, line));
+        while (true) {
+            size_t nl = pending.find('\n', pos);
+            if (nl != std::string::npos) {
+                line.assign(pending, pos, nl - pos);
+                pos = nl + 1;
+                return true;
+            }
+            if (!fill()) {
+                if (pos >= pending.size()) return false;
+                line.assign(pending, pos, std::string::npos);
+                pos = pending.size();
+                return true;
+            }
+        }
+    }
+};
+
+// Файлы ротации по порядку: app.log.2.gz, app.log.1, app.log — от старых к живому,
+// чтобы id новых шаблонов не зависели от того, в какой момент лог провернулся.
+std::pair<std::string, long long> rotation_key(const fs::path& path) {
+    std::string name = path.string();
+    for (const char* ext : {".gz", ".zst"}) {
+        std::string e(ext);
+        if (name.size() > e.size() && name.compare(name.size() - e.size(), e.size(), e) == 0) {
+            name.resize(name.size() - e.size());
+            break;
+        }
+    }
+    size_t dot = name.find_last_of('.');
+    std::string suffix = dot == std::string::npos ? "" : name.substr(dot + 1);
+    if (!suffix.empty() && suffix.size() < 18 && std::all_of(suffix.begin(), suffix.end(), ::isdigit))
+        return {name.substr(0, dot), -std::stoll(suffix)};
+    return {name, 1};
+}
+
+bool is_log_file(const fs::path& path) {
+    std::string base = rotation_key(path).first;
+    return base.size() > 4 && base.compare(base.size() - 4, 4, ".log") == 0;
+}
+
 class LogAggregator {
     std::string workingPath;
     std::string destinationPath;
     unsigned int BUF_SIZE;
+    unsigned int threads;
+
+    static void write_csv_row(std::ostream& out, unsigned int id, const std::string& t) {
+        out << id << ",";
+        bool need_quotes = (t.find(',') != std::string::npos) || (t.find('"') != std::string::npos);
+        if (need_quotes) {
+            std::string esc;
+            esc.reserve(t.size() + 8);
+            for (char c : t) esc.push_back(c == '"' ? '\'' : c);
+            out << "\"" << esc << "\"\n";
+        } else {
+            out << t << "\n";
+        }
+    }
 
     template<typename Key, typename Value>
     void save_Map_state(const std::map<Key, Value>& dictionary, const fs::path& filePath) {
-        std::ofstream csvFile(filePath, std::ios::trunc);
+        // словарь пишется во временный файл и подменяется целиком: server.py не увидит недописанный CSV
+        fs::path tmpPath = filePath.string() + ".tmp";
+        std::ofstream csvFile(tmpPath, std::ios::trunc);
         if (!csvFile.is_open()) {
-            std::cerr << "Err open file for saving " << filePath << std::endl;
+            std::cerr << "Err open file for saving " << tmpPath << std::endl;
             return;
         }
         csvFile << "id,template\n";
-        for (const auto& pair : dictionary) {
-            csvFile << pair.second << ",";
-            std::string t = pair.first;
-            bool need_quotes = (t.find(',') != std::string::npos) || (t.find('"') != std::string::npos);
-            if (need_quotes) {
-                std::string esc;
-                esc.reserve(t.size() + 8);
-                for (char c : t) esc.push_back(c == '"' ? '\'' : c);
-                csvFile << "\"" << esc << "\"\n";
-            } else {
-                csvFile << t << "\n";
-            }
-        }
+        for (const auto& pair : dictionary) write_csv_row(csvFile, pair.second, pair.first);
         csvFile.close();
+        fs::rename(tmpPath, filePath);
     }
 
-    static std::string text_preprocess(const std::string& text) {
+    // Каждый лог (в т.ч. сжатый) обрабатывается независимо: по буферам BUF_SIZE строк собирается
+    // отсортированное множество шаблонов, и в результат попадают только шаблоны,
+    // впервые встреченные в этом файле, в том же порядке, в каком их увидел бы
+    // последовательный проход. Поэтому слияние в порядке файлов даёт те же id.
+    std::vector<std::string> scan_file(const fs::path& path) const {
+        std::vector<std::string> fresh;
+        LineReader ifs(path);
+        if (!ifs) {
+            std::cerr << "Read err " << path << std::endl;
+            return fresh;
+        }
+        std::unordered_set<std::string> seen;
+        std::set<std::string> unic;
+        std::string line;
+        unsigned int in_buf = 0;
+        auto flush = [&]() {
+            for (const auto& t : unic)
+                if (seen.insert(t).second) fresh.push_back(t);
+            unic.clear();
+            in_buf = 0;
+        };
+        while (ifs.getline(line)) {
+            std::string p = text_preprocess(line);
+            if (!p.empty()) unic.insert(std::move(p));
+            if (++in_buf == BUF_SIZE) flush();
+        }
+        flush();
+        return fresh;
+    }
+
+public:
+    // Эталонная реализация на std::regex (была основной) — оставлена для бенчмарка и сверки.
+    static std::string text_preprocess_regex(const std::string& text) {
         std::regex id_re("\\S*\\d+\\S*");
         std::string temp = std::regex_replace(text, id_re, "");
 
@@ -62,9 +246,40 @@ class LogAggregator {
         return result.substr(start, end - start + 1);
     }
 
-public:
-    LogAggregator(const std::string& workingFolder, const std::string& destinationFolder)
-        : workingPath(workingFolder), destinationPath(destinationFolder), BUF_SIZE(10000) {
+    // Однопроходный сканер с тем же результатом: токены с цифрами выбрасываются
+    // целиком, пунктуация режет токен на слова, слова в нижнем регистре через один пробел.
+    static std::string text_preprocess(const std::string& text) {
+        std::string result;
+        result.reserve(text.size());
+        const size_t n = text.size();
+        size_t i = 0;
+        while (i < n) {
+            while (i < n && std::isspace(static_cast<unsigned char>(text[i]))) i++;
+            size_t begin = i;
+            bool has_digit = false;
+            while (i < n && !std::isspace(static_cast<unsigned char>(text[i]))) {
+                if (std::isdigit(static_cast<unsigned char>(text[i]))) has_digit = true;
+                i++;
+            }
+            if (has_digit) continue;
+            bool in_word = false;
+            for (size_t k = begin; k < i; k++) {
+                unsigned char uc = static_cast<unsigned char>(text[k]);
+                if (std::ispunct(uc)) {
+                    in_word = false;
+                    continue;
+                }
+                if (!in_word && !result.empty()) result.push_back(' ');
+                in_word = true;
+                result.push_back(static_cast<char>(std::tolower(uc)));
+            }
+        }
+        return result;
+    }
+
+    LogAggregator(const std::string& workingFolder, const std::string& destinationFolder, unsigned int threads = 0)
+        : workingPath(workingFolder), destinationPath(destinationFolder), BUF_SIZE(10000),
+          threads(threads ? threads : std::max(1u, std::thread::hardware_concurrency())) {
         if (!fs::exists(destinationPath)) fs::create_directories(destinationPath);
     }
 
@@ -73,67 +288,111 @@ public:
         unsigned int id = 0;
         std::map<std::string, unsigned int> temp_id;
 
+        // порядок файлов фиксируем, иначе id зависели бы от порядка directory_iterator
+        std::vector<fs::path> files;
         for (const auto& entry : fs::directory_iterator(workingPath)) {
-            if (entry.is_regular_file() && entry.path().extension() == ".log") {
-                std::ifstream ifs(entry.path());
-                if (!ifs) {
-                    std::cerr << "Read err " << entry.path() << std::endl;
-                    continue;
-                }
-                std::string line;
-                std::vector<std::string> buffer;
-                buffer.reserve(BUF_SIZE);
-
-                while (std::getline(ifs, line)) {
-                    buffer.push_back(line);
-                    if (buffer.size() == BUF_SIZE) {
-                        std::set<std::string> unic;
-                        for (const auto& l : buffer) {
-                            std::string p = text_preprocess(l);
-                            if (!p.empty()) unic.insert(p);
-                        }
-                        bool map_upd = false;
-                        for (const auto& t : unic) {
-                            if (temp_id.find(t) == temp_id.end()) {
-                                temp_id[t] = id++;
-                                map_upd = true;
-                            }
-                        }
-                        if (map_upd) save_Map_state(temp_id, dictFile);
-                        buffer.clear();
-                    }
-                }
-                if (!buffer.empty()) {
-                    std::set<std::string> unic;
-                    for (const auto& l : buffer) {
-                        std::string p = text_preprocess(l);
-                        if (!p.empty()) unic.insert(p);
-                    }
-                    bool map_upd = false;
-                    for (const auto& t : unic) {
-                        if (temp_id.find(t) == temp_id.end()) {
-                            temp_id[t] = id++;
-                            map_upd = true;
-                        }
+            if (entry.is_regular_file() && is_log_file(entry.path())) files.push_back(entry.path());
+        }
+        std::sort(files.begin(), files.end(), [](const fs::path& a, const fs::path& b) {
+            auto ka = rotation_key(a), kb = rotation_key(b);
+            return ka != kb ? ka < kb : a < b;
+        });
+
+        // ошибка чтения файла (битый .gz/.zst, нехватка памяти) уходит в его future,
+        // иначе поток слияния ждал бы результат вечно
+        std::vector<std::promise<std::vector<std::string>>> results(files.size());
+        std::atomic<size_t> next{0};
+        std::vector<std::thread> pool;
+        for (unsigned int t = 0; t < std::min<size_t>(threads, files.size()); t++) {
+            pool.emplace_back([&]() {
+                for (size_t i = next++; i < files.size(); i = next++) {
+                    try {
+                        results[i].set_value(scan_file(files[i]));
+                    } catch (...) {
+                        results[i].set_exception(std::current_exception());
                     }
-                    if (map_upd) save_Map_state(temp_id, dictFile);
-                    buffer.clear();
                 }
+            });
+        }
+
+        // словарь пишется один раз в конце; при ошибке в любом файле прежний CSV не трогаем
+        std::exception_ptr error;
+        for (size_t i = 0; i < results.size(); i++) {
+            std::vector<std::string> fresh;
+            try {
+                fresh = results[i].get_future().get();
+            } catch (...) {
+                if (!error) error = std::current_exception();
+                continue;
+            }
+            for (auto& t : fresh) {
+                if (temp_id.emplace(std::move(t), id).second) id++;
             }
         }
+        for (auto& th : pool) th.join();
+        if (error) std::rethrow_exception(error);
+
+        save_Map_state(temp_id, dictFile);
     }
 };
 
+// Бенчмарк: лог повторяется scale раз в памяти, обе реализации прогоняются по всем
+// строкам, результаты сверяются построчно.
+int bench(const std::string& path, int scale) {
+    std::ifstream ifs(path);
+    if (!ifs) {
+        std::cerr << "Read err " << path << std::endl;
+        return 2;
+    }
+    std::vector<std::string> sample, lines;
+    std::string line;
+    while (std::getline(ifs, line)) sample.push_back(line);
+    lines.reserve(sample.size() * scale);
+    for (int i = 0; i < scale; i++) lines.insert(lines.end(), sample.begin(), sample.end());
+
+    auto run = [&](auto fn, std::vector<std::string>& out) {
+        out.clear();
+        out.reserve(lines.size());
+        auto t0 = std::chrono::steady_clock::now();
+        for (const auto& l : lines) out.push_back(fn(l));
+        return std::chrono::duration<double>(std::chrono::steady_clock::now() - t0).count();
+    };
+    std::vector<std::string> ref, fast;
+    double t_regex = run(LogAggregator::text_preprocess_regex, ref);
+    double t_fast = run(LogAggregator::text_preprocess, fast);
+
+    size_t mismatches = 0;
+    for (size_t i = 0; i < lines.size(); i++) {
+        if (ref[i] != fast[i]) {
+            if (mismatches++ < 5) std::cerr << "mismatch: [" << lines[i] << "]\n";
+        }
+    }
+    std::cout << "lines=" << lines.size() << "\n"
+              << "regex: " << t_regex << " s, " << static_cast<long long>(lines.size() / t_regex) << " lines/s\n"
+              << "scanner: " << t_fast << " s, " << static_cast<long long>(lines.size() / t_fast) << " lines/s\n"
+              << "speedup: x" << t_regex / t_fast << "\n"
+              << "mismatches: " << mismatches << std::endl;
+    return mismatches ? 3 : 0;
+}
+
 int main(int argc, char* argv[]) {
-    if (argc != 3) {
-        std::cerr << "Usage: " << argv[0] << " <dir_from> <dir_to>\n";
+    if (argc >= 3 && std::string(argv[1]) == "--bench") {
+        return bench(argv[2], argc >= 4 ? std::stoi(argv[3]) : 100);
+    }
+    if (argc != 3 && argc != 4) {
+        std::cerr << "Usage: " << argv[0] << " <dir_from> <dir_to> [threads]\n"
+                  << "       " << argv[0] << " --bench <file.log> [scale]\n";
         return 1;
     }
     std::string workingFolder = argv[1];
     std::string destinationFolder = argv[2];
-    LogAggregator Agg(workingFolder, destinationFolder);
-    Agg.collect();
+    LogAggregator Agg(workingFolder, destinationFolder, argc == 4 ? std::stoul(argv[3]) : 0);
+    try {
+        Agg.collect();
+    } catch (const std::exception& e) {
+        std::cerr << "Aggregation failed: " << e.what() << std::endl;
+        return 2;
+    }
     std::cout << "Done!" << std::endl;
     return 0;
 }
-
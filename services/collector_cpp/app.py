@@ -1,8 +1,12 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Header
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List
-import os, json, itertools, subprocess
+import os, re, glob, json, itertools, subprocess, threading
+import numpy as np
 from config import load_config
+from shards import ShardStore
+from follow import Follower
 
 
 cfg = load_config()
@@ -13,12 +17,57 @@ DATASET_PATH = cfg["dataset_path"]
 ENCODING     = cfg.get("encoding", "utf-8")
 OUT_DIR      = cfg.get("out_dir", "/app/out")
 BATCH_SIZE   = int(cfg.get("batch_size", 1000))
+MINER_CFG    = cfg.get("miner", {})
+STREAM_CHUNK = int(cfg.get("stream_chunk_rows", 10000))
+FOLLOW_CFG   = cfg.get("follow", {})
+STORAGE_URL  = FOLLOW_CFG.get("storage_url") or os.environ.get("STORAGE_URL", "http://storage:8002")
 
 
 BIN_PATH = "/app/bin/bgl_template_miner"
 META_PATH = os.path.join(OUT_DIR, "meta.json")
 TPL_PATH  = os.path.join(OUT_DIR, "templates.json")
 VEC_PATH  = os.path.join(OUT_DIR, "vectors.jsonl")
+DF_PATH   = os.path.join(OUT_DIR, "df.json")
+STATE_PATH = os.path.join(OUT_DIR, "state.txt")
+SHARDS = ShardStore(os.path.join(OUT_DIR, "shards"))
+# /build и режим слежения не должны запускать майнер одновременно
+MINER_LOCK = threading.Lock()
+
+NDJSON_MEDIA = "application/x-ndjson"
+ARROW_MEDIA  = "application/vnd.apache.arrow.stream"
+
+
+def rotation_key(path: str):
+    """
+    Порядок файлов ротации: BGL.log.2.gz, BGL.log.1.zst, BGL.log — от старых к живому.
+    Расширение сжатия отбрасывается, числовой суффикс ротации сортируется по убыванию.
+    """
+    name = re.sub(r"\.(gz|zst)$", "", path)
+    m = re.match(r"^(.*?)(?:\.(\d+))?$", name)
+    return m.group(1), (-int(m.group(2)) if m.group(2) else 1), path
+
+def resolve_log_files(spec) -> list[str]:
+    """
+    dataset_path — путь, glob-шаблон или список из них. line_id идут сквозь
+    упорядоченный набор, поэтому порядок фиксируется rotation_key.
+    """
+    files = set()
+    for item in ([spec] if isinstance(spec, str) else spec):
+        files.update(p for p in glob.glob(item) if os.path.isfile(p))
+    if not files:
+        raise HTTPException(status_code=500, detail=f"No log files match {spec!r}")
+    return sorted(files, key=rotation_key)
+
+def miner_args() -> list[str]:
+    """Опции майнера из секции miner конфига (режим exact|drain и параметры дерева)."""
+    args = ["--mode", str(MINER_CFG.get("mode", "exact"))]
+    for key, opt in (("depth", "--depth"), ("sim_threshold", "--sim"),
+                     ("max_children", "--max-children"), ("skip_fields", "--skip-fields"),
+                     ("threads", "--threads"), ("shard_rows", "--shard-rows"),
+                     ("block_mb", "--block-mb")):
+        if key in MINER_CFG:
+            args += [opt, str(MINER_CFG[key])]
+    return args
 
 
 class VectorItem(BaseModel):
@@ -37,23 +86,204 @@ class BatchVectors(BaseModel):
     data: List[VectorItem]
 
 
+def is_built() -> bool:
+    return os.path.exists(VEC_PATH) and os.path.exists(META_PATH) and os.path.exists(TPL_PATH)
+
+def run_miner(append: bool = False):
+    """
+    /app/bin/bgl_template_miner <in_log> <encoding> <out_dir> [--input <log>]... [--mode ...] [--append]
+    С --append майнер продолжает с сохранённого в state.txt смещения и дописывает
+    только новые строки; если лог подменён или укоротился — сам делает полную сборку.
+    Сжатые .gz/.zst файлы майнер распаковывает сам, параллельно по файлам.
+    """
+    os.makedirs(OUT_DIR, exist_ok=True)
+    files = resolve_log_files(DATASET_PATH)
+    cmd = [BIN_PATH, files[0], ENCODING, OUT_DIR] + miner_args()
+    for path in files[1:]:
+        cmd += ["--input", path]
+    if append:
+        cmd.append("--append")
+    try:
+        with MINER_LOCK:
+            subprocess.run(cmd, check=True)
+    except subprocess.CalledProcessError as e:
+        raise HTTPException(status_code=500, detail=f"C++ builder failed: {e}")
+
 def ensure_built():
     """
     Гарантируем, что артефакты (templates.json, meta.json, vectors.jsonl) собраны.
-    Если их нет — запускаем: /app/bin/bgl_template_miner <in_log> <encoding> <out_dir>
+    Если их нет — запускаем полную сборку.
     """
-    if not (os.path.exists(VEC_PATH) and os.path.exists(META_PATH) and os.path.exists(TPL_PATH)):
-        os.makedirs(OUT_DIR, exist_ok=True)
-        cmd = [BIN_PATH, DATASET_PATH, ENCODING, OUT_DIR]
-        try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            raise HTTPException(status_code=500, detail=f"C++ builder failed: {e}")
+    if not is_built():
+        run_miner()
 
 def read_meta():
     with open(META_PATH, "r", encoding="utf-8") as f:
         return json.load(f)
 
+
+_IDF_CACHE: dict = {"mtime": None, "idf": None}
+
+def current_idf() -> np.ndarray | None:
+    """
+    IDF по df.json (перечитывается только при изменении файла).
+    None — артефакты старого формата, где values уже содержат tf*idf.
+    """
+    if not os.path.exists(DF_PATH):
+        return None
+    mtime = os.path.getmtime(DF_PATH)
+    if _IDF_CACHE["mtime"] != mtime:
+        with open(DF_PATH, "r", encoding="utf-8") as f:
+            obj = json.load(f)
+        df = np.asarray(obj["df"], dtype=np.float64)
+        _IDF_CACHE["idf"] = np.log(obj["num_docs"] / np.maximum(df, 1.0))
+        _IDF_CACHE["mtime"] = mtime
+    return _IDF_CACHE["idf"]
+
+def apply_idf(obj: dict, idf: np.ndarray | None) -> dict:
+    """Вектора в vectors.jsonl хранят сырые tf; вес и актуальный dim подставляются при чтении."""
+    if idf is None:
+        return obj
+    obj["dim"] = len(idf)
+    obj["values"] = [v * float(idf[i]) for i, v in zip(obj["indices"], obj["values"])]
+    return obj
+
+def shard_block(start: int, stop: int, idf: np.ndarray | None) -> dict:
+    """Срез из бинарных шардов: memmap + векторное применение IDF, без построчного json.loads."""
+    b = SHARDS.slice(start, stop)
+    data = b["data"].astype(np.float64)
+    if idf is not None:
+        data *= idf[b["indices"]]
+    b["data"] = data
+    b["dim"] = len(idf) if idf is not None else int(SHARDS.manifest.get("dim", 0))
+    tags = SHARDS.alert_tags
+    b["alert_tag"] = [tags[t] for t in b["alert_tag"].tolist()]
+    return b
+
+def rows_block(rows: list[dict]) -> dict:
+    """Те же колонки, что у shard_block, из уже разобранных строк vectors.jsonl."""
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(r["indices"]) for r in rows], out=indptr[1:])
+    return {
+        "indptr": indptr,
+        "indices": np.fromiter((i for r in rows for i in r["indices"]), dtype=np.int32),
+        "data": np.fromiter((v for r in rows for v in r["values"]), dtype=np.float64),
+        "is_alert": np.array([r["is_alert"] for r in rows], dtype=np.uint8),
+        "template_id": np.array([r["template_id"] for r in rows], dtype=np.int32),
+        "line_id": np.array([r["line_id"] for r in rows], dtype=np.int64),
+        "alert_tag": [r["alert_tag"] for r in rows],
+        "dim": rows[0]["dim"] if rows else 0,
+    }
+
+def iter_blocks(offset: int, limit: int, idf: np.ndarray | None):
+    """Блоки по STREAM_CHUNK строк: память не зависит от limit."""
+    stop = offset + limit
+    if SHARDS.available():
+        pos = offset
+        while pos < stop:
+            b = shard_block(pos, min(pos + STREAM_CHUNK, stop), idf)
+            n = len(b["line_id"])
+            if n == 0:
+                break
+            yield b
+            pos += n
+        return
+    # артефакты без шардов: построчное чтение vectors.jsonl
+    rows = []
+    for _, line in iter_slice(VEC_PATH, offset, stop):
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        rows.append(apply_idf(json.loads(line), idf))
+        if len(rows) == STREAM_CHUNK:
+            yield rows_block(rows)
+            rows = []
+    if rows:
+        yield rows_block(rows)
+
+def block_rows(b: dict):
+    indptr = b["indptr"].tolist()
+    indices, values = b["indices"].tolist(), b["data"].tolist()
+    dim = b["dim"]
+    for r, (lid, tag, al, tid) in enumerate(zip(b["line_id"].tolist(), b["alert_tag"],
+                                                b["is_alert"].tolist(), b["template_id"].tolist())):
+        lo, hi = indptr[r], indptr[r + 1]
+        yield {"line_id": lid, "alert_tag": tag, "is_alert": bool(al), "template_id": tid,
+               "dim": dim, "indices": indices[lo:hi], "values": values[lo:hi]}
+
+def ndjson_stream(blocks):
+    for b in blocks:
+        yield "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in block_rows(b)).encode()
+
+class _ChunkSink:
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def arrow_stream(blocks):
+    """Arrow IPC stream: по одному record batch на блок."""
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ("line_id", pa.int64()), ("alert_tag", pa.string()), ("is_alert", pa.bool_()),
+        ("template_id", pa.int32()), ("dim", pa.int32()),
+        ("indices", pa.list_(pa.int32())), ("values", pa.list_(pa.float64())),
+    ])
+    chunks: list[bytes] = []
+    sink = pa.PythonFile(_ChunkSink(chunks), mode="w")
+    writer = pa.ipc.new_stream(sink, schema)
+    for b in blocks:
+        offsets = pa.array(b["indptr"].astype(np.int32))
+        batch = pa.record_batch([
+            pa.array(b["line_id"]), pa.array(b["alert_tag"], pa.string()),
+            pa.array(b["is_alert"].astype(bool)), pa.array(b["template_id"].astype(np.int32)),
+            pa.array(np.full(len(b["line_id"]), b["dim"], dtype=np.int32)),
+            pa.ListArray.from_arrays(offsets, pa.array(b["indices"].astype(np.int32))),
+            pa.ListArray.from_arrays(offsets, pa.array(b["data"])),
+        ], schema=schema)
+        writer.write_batch(batch)
+        yield b"".join(chunks)
+        chunks.clear()
+    writer.close()
+    yield b"".join(chunks)
+
+def response_format(fmt: str | None, accept: str | None) -> str:
+    """format= важнее Accept; по умолчанию — обычный JSON-ответ."""
+    if fmt:
+        return fmt
+    accept = accept or ""
+    if ARROW_MEDIA in accept:
+        return "arrow"
+    if NDJSON_MEDIA in accept:
+        return "ndjson"
+    return "json"
+
+_META_CACHE: dict = {"mtime": None, "meta": {}}
+
+def total_rows() -> int | None:
+    """Общее число строк из закэшированного манифеста шардов или meta.json (по mtime)."""
+    if SHARDS.available():
+        SHARDS.refresh()
+        return SHARDS.num_rows
+    try:
+        mtime = os.path.getmtime(META_PATH)
+        if _META_CACHE["mtime"] != mtime:
+            _META_CACHE["meta"] = read_meta()
+            _META_CACHE["mtime"] = mtime
+        return _META_CACHE["meta"].get("num_docs")
+    except Exception:
+        return None
+
 def iter_slice(path: str, start: int, stop: int):
     with open(path, "r", encoding="utf-8", errors="replace") as f:
         for idx, line in itertools.islice(enumerate(f), start, stop):
@@ -62,48 +292,71 @@ def iter_slice(path: str, start: int, stop: int):
 
 @app.get("/health")
 def health():
-    built = os.path.exists(VEC_PATH) and os.path.exists(META_PATH) and os.path.exists(TPL_PATH)
+    built = is_built()
     meta = {}
     if built:
         try:
             meta = read_meta()
         except Exception:
             meta = {}
+    try:
+        files = resolve_log_files(DATASET_PATH)
+    except HTTPException:
+        files = []
     return {
         "status": "ok",
         "built": built,
         "dataset_path": DATASET_PATH,
+        "dataset_files": files,
         "meta": meta
     }
 
 @app.post("/build")
-def build():
-    ensure_built()
+def build(full: bool = Query(False, description="Пересобрать всё с нуля вместо досборки")):
+    """Первая сборка — полная, дальше обрабатываются только дописанные в лог байты."""
+    if is_built() and os.path.exists(STATE_PATH) and not full:
+        run_miner(append=True)
+    else:
+        run_miner()
     h = health()
     return {"status": "built", "meta": h.get("meta", {}), "dataset_path": h.get("dataset_path")}
 
+@app.get("/idf")
+def idf():
+    """Текущие веса шаблонов (IDF по df.json) — для компактного хранения в storage."""
+    ensure_built()
+    w = current_idf()
+    if w is None:
+        raise HTTPException(404, "df.json not found: artifacts were built by an old miner")
+    return {"dim": len(w), "weights": w.tolist()}
+
 @app.get("/collect_vectors", response_model=BatchVectors)
-def collect_vectors(offset: int = Query(0, ge=0), limit: int = Query(BATCH_SIZE, gt=0)):
+def collect_vectors(offset: int = Query(0, ge=0), limit: int = Query(BATCH_SIZE, gt=0),
+                    format: str | None = Query(None, pattern="^(json|ndjson|arrow)$"),
+                    accept: str | None = Header(None)):
     """
     Возвращает батч векторизованных событий
-    При первом вызове соберёт артефакты
+    При первом вызове соберёт артефакты; если есть бинарные шарды — читает из них.
+    format=ndjson|arrow (или Accept: application/x-ndjson / application/vnd.apache.arrow.stream)
+    отдаёт строки потоком по мере чтения, без Pydantic-моделей; total — в заголовке X-Total-Count.
     """
     ensure_built()
-    items: list[VectorItem] = []
-
-    for _, line in iter_slice(VEC_PATH, offset, offset + limit):
-        line = line.rstrip("\r\n")
-        if not line:
-            continue
-        obj = json.loads(line)
-        items.append(VectorItem(**obj))
+    idf = current_idf()
+    total = total_rows()
 
-    total = None
-    try:
-        total = read_meta().get("num_docs")
-    except Exception:
-        total = None
+    fmt = response_format(format, accept)
+    if fmt != "json":
+        headers = {"X-Total-Count": str(total)} if total is not None else {}
+        blocks = iter_blocks(offset, limit, idf)
+        if fmt == "arrow":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise HTTPException(406, "pyarrow is not installed, use format=ndjson")
+            return StreamingResponse(arrow_stream(blocks), media_type=ARROW_MEDIA, headers=headers)
+        return StreamingResponse(ndjson_stream(blocks), media_type=NDJSON_MEDIA, headers=headers)
 
+    items = [VectorItem(**row) for b in iter_blocks(offset, limit, idf) for row in block_rows(b)]
     return BatchVectors(
         start=offset,
         end=offset + len(items),
@@ -111,3 +364,68 @@ def collect_vectors(offset: int = Query(0, ge=0), limit: int = Query(BATCH_SIZE,
         data=items
     )
 
+
+# ================= follow: живой хвост лога -> storage =================
+def follow_build():
+    # всегда --append: без state майнер сам делает полную сборку, но недописанную
+    # последнюю строку живого лога оставляет до следующего запуска
+    run_miner(append=True)
+
+def follow_rows(start: int, stop: int) -> list[dict]:
+    return list(block_rows(shard_block(start, stop, current_idf())))
+
+def follow_meta() -> dict:
+    return read_meta() if os.path.exists(META_PATH) else {}
+
+def follow_idf() -> list[float] | None:
+    w = current_idf()
+    return None if w is None else w.tolist()
+
+FOLLOWER = Follower(
+    build=follow_build,
+    total_rows=total_rows,
+    read_rows=follow_rows,
+    build_info=follow_meta,
+    storage_url=STORAGE_URL,
+    checkpoint_path=os.path.join(OUT_DIR, "follow_checkpoint.json"),
+    template_idf=follow_idf,
+    batch_rows=int(FOLLOW_CFG.get("batch_rows", 500)),
+    max_latency_ms=int(FOLLOW_CFG.get("max_latency_ms", 1000)),
+    poll_interval_s=float(FOLLOW_CFG.get("poll_interval_s", 1.0)),
+    queue_batches=int(FOLLOW_CFG.get("queue_batches", 16)),
+    max_backoff_s=float(FOLLOW_CFG.get("max_backoff_s", 30.0)),
+)
+
+@app.on_event("startup")
+def follow_autostart():
+    if FOLLOW_CFG.get("autostart", False):
+        os.makedirs(OUT_DIR, exist_ok=True)
+        FOLLOWER.start()
+
+@app.on_event("shutdown")
+def follow_shutdown():
+    FOLLOWER.stop()
+
+@app.post("/follow/start")
+def follow_start(from_line: int | None = Query(None, ge=0, description="Начать с этого line_id вместо checkpoint")):
+    """
+    Запускает слежение за логом: новые строки майнятся, векторизуются и пачками
+    уходят в storage. Повторный вызов при работающем слежении ничего не меняет.
+    """
+    if FOLLOWER.running:
+        return {"status": "already running", **FOLLOWER.status()}
+    os.makedirs(OUT_DIR, exist_ok=True)
+    if from_line is not None:
+        FOLLOWER.save_checkpoint(from_line)
+    FOLLOWER.start()
+    return {"status": "started", **FOLLOWER.status()}
+
+@app.post("/follow/stop")
+def follow_stop():
+    """Неотправленные батчи не коммитятся: после старта чтение продолжится с checkpoint."""
+    FOLLOWER.stop()
+    return {"status": "stopped", **FOLLOWER.status()}
+
+@app.get("/follow/status")
+def follow_status():
+    return FOLLOWER.status()
@@ -1,6 +1,16 @@
 #include <bits/stdc++.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include <zlib.h>
+#ifdef HAVE_ZSTD
+#include <zstd.h>
+#endif
 using namespace std;
 
+static_assert(__BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__, "binary shards are written little-endian");
+
 /*
  BGL format example:
  "-" 2006-03-02-00.17.11.137476  "node" "R08-M0-N4-C:J44-U11" memLog [6874.691561] L4 FetchError on ... 
@@ -33,6 +43,22 @@ vector<string> split(const string &s) {
     return out;
 }
 
+bool has_digit(const string &tok) {
+    for (char c : tok) if (isdigit((unsigned char)c)) return true;
+    return false;
+}
+
+string json_escape(const string &s) {
+    string out;
+    out.reserve(s.size());
+    for (char c : s) {
+        if (c == '"' || c == '\\') { out += '\\'; out += c; }
+        else if ((unsigned char)c < 0x20) out += ' ';
+        else out += c;
+    }
+    return out;
+}
+
 string join(const vector<string> &v) {
     string s;
     for (size_t i=0;i<v.size();i++){
@@ -42,70 +68,906 @@ string join(const vector<string> &v) {
     return s;
 }
 
+/*
+ Drain-подобный майнер шаблонов (He et al., "Drain: An Online Log Parsing Approach
+ with Fixed Depth Tree"):
+   root -> длина строки -> первые (depth - 2) токенов -> список кластеров.
+ Первые skip_fields токенов (в BGL это заголовок: epoch, дата, узел, время, узел)
+ целиком переменные — они маскируются и в сравнении не участвуют.
+ Остальные токены с цифрами тоже маскируются в <*> (адреса, счётчики, core.N),
+ поэтому они не раздувают дерево. В листе строка сравнивается с шаблонами
+ кластеров (доля совпавших позиций), при sim >= sim_threshold она вливается
+ в лучший кластер, а несовпавшие позиции шаблона заменяются на <*>.
+ Иначе создаётся новый кластер.
+*/
+struct DrainNode {
+    unordered_map<string,int> children;   // token -> node index
+    vector<int> clusters;                 // template ids (только в листьях)
+};
+
+class DrainTree {
+public:
+    DrainTree(int depth, double sim_threshold, size_t max_children, size_t skip_fields)
+        : prefix_depth(max(depth - 2, 1)), sim_threshold(sim_threshold),
+          max_children(max_children), skip_fields(skip_fields) {
+        nodes.emplace_back();   // root
+    }
+
+    // возвращает id кластера (шаблона); templates дополняется/обновляется на месте
+    int add(const vector<string> &toks, vector<Template> &templates) {
+        size_t skip = min(skip_fields, toks.size());
+        int leaf = route(toks, skip);
+        int best = -1;
+        double best_sim = -1.0;
+        size_t best_wild = 0;
+        for (int cid : nodes[leaf].clusters) {
+            const auto &tpl = templates[cid].tokens;
+            size_t same = 0, wild = 0;
+            for (size_t i = skip; i < tpl.size(); i++) {
+                if (tpl[i] == toks[i]) same++;
+                else if (tpl[i] == "<*>") wild++;
+            }
+            size_t len = toks.size() - skip;
+            double sim = len == 0 ? 1.0 : (double)same / len;
+            if (sim > best_sim || (sim == best_sim && wild > best_wild)) {
+                best = cid; best_sim = sim; best_wild = wild;
+            }
+        }
+        if (best >= 0 && best_sim >= sim_threshold) {
+            auto &tpl = templates[best].tokens;
+            for (size_t i = 0; i < tpl.size(); i++)
+                if (tpl[i] != toks[i]) tpl[i] = "<*>";
+            return best;
+        }
+        int id = templates.size();
+        templates.push_back({toks});
+        for (size_t i = 0; i < skip; i++) templates[id].tokens[i] = "<*>";
+        nodes[leaf].clusters.push_back(id);
+        return id;
+    }
+
+    // восстановление дерева по сохранённым шаблонам (инкрементальный режим)
+    void restore(const vector<Template> &templates) {
+        for (size_t id = 0; id < templates.size(); id++) {
+            const auto &toks = templates[id].tokens;
+            nodes[route(toks, min(skip_fields, toks.size()))].clusters.push_back(id);
+        }
+    }
+
+private:
+    int prefix_depth;
+    double sim_threshold;
+    size_t max_children;
+    size_t skip_fields;
+    vector<DrainNode> nodes;
+
+    int child(int parent, const string &key) {
+        auto it = nodes[parent].children.find(key);
+        if (it != nodes[parent].children.end()) return it->second;
+        string k = key;
+        if (k != "<*>" && nodes[parent].children.size() + 1 >= max_children) {
+            // узел переполнен: всё новое уходит в общую ветку <*>
+            k = "<*>";
+            auto wit = nodes[parent].children.find(k);
+            if (wit != nodes[parent].children.end()) return wit->second;
+        }
+        int idx = nodes.size();
+        nodes.emplace_back();
+        nodes[parent].children[k] = idx;
+        return idx;
+    }
+
+    int route(const vector<string> &toks, size_t skip) {
+        int cur = child(0, to_string(toks.size()));
+        size_t n = min(toks.size(), skip + prefix_depth);
+        for (size_t i = skip; i < n; i++) cur = child(cur, toks[i]);
+        return cur;
+    }
+};
+
+/*
+ Блок входного файла (mmap или распакованная порция) режется на диапазоны байт,
+ выровненные по '\n'. Каждый поток в своём диапазоне токенизирует строки
+ и копит локальный словарь сигнатур (нормализованная строка -> локальный id
+ в порядке первого появления) и id сигнатуры для каждой строки.
+ Затем локальные словари сливаются в порядке диапазонов, поэтому глобальный
+ порядок первого появления (а значит и id шаблонов) не зависит от числа потоков.
+ Строки не ссылаются на содержимое блока: после майнинга блок освобождается.
+*/
+struct LineRef {
+    uint64_t pos;           // смещение начала строки в файле
+    int tag;                // локальный id первого токена строки
+    int sig;                // локальный id сигнатуры
+};
+
+struct Chunk {
+    const char *data = "";              // блок, которому принадлежит диапазон (до конца майнинга)
+    size_t base = 0;                    // смещение блока в файле
+    size_t begin = 0, end = 0;
+    unordered_map<string,int> sig_id;
+    vector<string> sigs;                // локальный id -> сигнатура
+    vector<long long> sig_df;           // локальный id -> число строк
+    unordered_map<string,int> tag_id;
+    vector<string> tags;                // локальный id -> первый токен строки
+    vector<LineRef> lines;
+    long long num_docs = 0;
+};
+
+static inline bool is_space(char c) {
+    return c == ' ' || c == '\t' || c == '\n' || c == '\v' || c == '\f' || c == '\r';
+}
+
+void mine_chunk(Chunk &ch, bool mask_digits) {
+    const char *data = ch.data;
+    string sig, tok;
+    size_t pos = ch.begin;
+    while (pos < ch.end) {
+        const char *nl = (const char *)memchr(data + pos, '\n', ch.end - pos);
+        size_t line_end = nl ? (size_t)(nl - data) : ch.end;
+        const char *p = data + pos, *e = data + line_end;
+        uint64_t line_pos = ch.base + (p - data);
+        pos = line_end + 1;
+        if (p == e) continue;
+        ch.num_docs++;
+
+        while (p < e && is_space(*p)) p++;
+        if (p == e) continue;
+        const char *alert = p;
+        while (p < e && !is_space(*p)) p++;
+        uint32_t alert_len = p - alert;
+
+        // normalize tokens → template signature
+        sig.clear();
+        while (true) {
+            while (p < e && is_space(*p)) p++;
+            if (p == e) break;
+            const char *t = p;
+            while (p < e && !is_space(*p)) p++;
+            tok.assign(t, p - t);
+            tok = normalize_token(tok);
+            if (mask_digits && has_digit(tok)) tok = "<*>";
+            if (!sig.empty()) sig += ' ';
+            sig += tok;
+        }
+
+        int id;
+        auto it = ch.sig_id.find(sig);
+        if (it == ch.sig_id.end()) {
+            id = ch.sigs.size();
+            ch.sig_id.emplace(sig, id);
+            ch.sigs.push_back(sig);
+            ch.sig_df.push_back(0);
+        } else {
+            id = it->second;
+        }
+        ch.sig_df[id]++;
+        tok.assign(alert, alert_len);
+        auto tit = ch.tag_id.find(tok);
+        int tag;
+        if (tit == ch.tag_id.end()) {
+            tag = ch.tags.size();
+            ch.tag_id.emplace(tok, tag);
+            ch.tags.push_back(tok);
+        } else {
+            tag = tit->second;
+        }
+        ch.lines.push_back({line_pos, tag, id});
+    }
+}
+
+// границы диапазонов [begin, end): begin + i*len/n, сдвинутые вперёд до начала следующей строки
+vector<Chunk> split_ranges(const char *data, size_t begin, size_t end, int n) {
+    size_t len = end - begin;
+    vector<size_t> bounds{begin};
+    for (int i = 1; i < n; i++) {
+        size_t b = max(begin + len * i / n, bounds.back());
+        const char *nl = b < end ? (const char *)memchr(data + b, '\n', end - b) : nullptr;
+        bounds.push_back(nl ? (size_t)(nl - data) + 1 : end);
+    }
+    bounds.push_back(end);
+    vector<Chunk> chunks(n);
+    for (int i = 0; i < n; i++) {
+        chunks[i].data = data;
+        chunks[i].begin = bounds[i];
+        chunks[i].end = bounds[i + 1];
+    }
+    return chunks;
+}
+
+/*
+ Входы: упорядоченный набор файлов (ротация: BGL.log.2.gz, BGL.log.1, BGL.log).
+ Несжатые файлы отображаются в память (mmap), .gz (zlib, в т.ч. многочленные)
+ и .zst (libzstd, при сборке с -DHAVE_ZSTD) распаковываются потоково блоками
+ по --block-mb, обрезанными по '\n'. Файлы обрабатываются по одному, блок
+ освобождается после майнинга, так что память не растёт с объёмом набора.
+ line_id сквозные по всему набору.
+*/
+struct Source {
+    string path;
+    long long file_size = 0;            // размер на диске (для сжатых — сжатый)
+    const char *data = "";
+    size_t size = 0;
+    string buf;                         // распакованное содержимое (сжатый живой файл)
+    void *map = nullptr;
+    bool loaded = false;
+
+    void unload() {
+        if (map) munmap(map, size);
+        map = nullptr;
+        string().swap(buf);
+        data = "";
+        loaded = false;
+    }
+    ~Source() { if (map) munmap(map, size); }
+};
+
+bool ends_with(const string &s, const string &suffix) {
+    return s.size() >= suffix.size() && s.compare(s.size() - suffix.size(), suffix.size(), suffix) == 0;
+}
+
+bool compressed(const string &path) {
+    return ends_with(path, ".gz") || ends_with(path, ".zst");
+}
+
+// потоковая распаковка .gz / .zst: read() дописывает в out до want байт
+struct Decoder {
+    gzFile gz = nullptr;
+#ifdef HAVE_ZSTD
+    FILE *zf = nullptr;
+    ZSTD_DCtx *dctx = nullptr;
+    vector<char> in;
+    ZSTD_inBuffer ib{nullptr, 0, 0};
+    size_t ret = 0;                     // 0 — кадр завершён
+    bool pending = false;               // выходной буфер был заполнен целиком
+#endif
+    bool eof = false;
+
+    bool open(const string &path) {
+        if (ends_with(path, ".gz")) {
+            gz = gzopen(path.c_str(), "rb");
+            if (!gz) return false;
+            gzbuffer(gz, 1 << 17);
+            return true;
+        }
+#ifdef HAVE_ZSTD
+        zf = fopen(path.c_str(), "rb");
+        if (!zf) return false;
+        dctx = ZSTD_createDCtx();
+        in.resize(ZSTD_DStreamInSize());
+        return true;
+#else
+        cerr << "zstd support not compiled in: " << path << "\n";
+        return false;
+#endif
+    }
+
+    bool read(string &out, size_t want) {
+        while (!eof && out.size() < want) {
+            size_t old = out.size();
+            if (gz) {
+                out.resize(old + min<size_t>(want - old, 1 << 20));
+                int n = gzread(gz, &out[old], out.size() - old);
+                out.resize(old + max(n, 0));
+                if (n < 0) return false;
+                if (n == 0) {
+                    eof = true;
+                    int err;
+                    gzerror(gz, &err);
+                    return err == Z_OK;     // Z_BUF_ERROR — файл обрезан
+                }
+                continue;
+            }
+#ifdef HAVE_ZSTD
+            if (ib.pos == ib.size && !pending) {
+                size_t n = fread(in.data(), 1, in.size(), zf);
+                if (n == 0) {
+                    eof = true;
+                    return ret == 0;        // обрыв посреди кадра — ошибка
+                }
+                ib = {in.data(), n, 0};
+            }
+            out.resize(old + ZSTD_DStreamOutSize());
+            ZSTD_outBuffer ob{&out[old], out.size() - old, 0};
+            ret = ZSTD_decompressStream(dctx, &ob, &ib);
+            out.resize(old + ob.pos);
+            if (ZSTD_isError(ret)) return false;
+            pending = ob.pos == ob.size;
+#endif
+        }
+        return true;
+    }
+
+    ~Decoder() {
+        if (gz) gzclose(gz);
+#ifdef HAVE_ZSTD
+        if (dctx) ZSTD_freeDCtx(dctx);
+        if (zf) fclose(zf);
+#endif
+    }
+};
+
+// файл целиком: mmap, сжатый — распаковка в память (нужно только живому файлу)
+bool load_source(Source &src) {
+    if (src.loaded) return true;
+    src.loaded = true;
+    if (compressed(src.path)) {
+        Decoder dec;
+        if (!dec.open(src.path) || !dec.read(src.buf, SIZE_MAX)) return false;
+        src.size = src.buf.size();
+        src.data = src.buf.data();
+        return true;
+    }
+    int fd = open(src.path.c_str(), O_RDONLY);
+    if (fd < 0) return false;
+    struct stat fst;
+    fstat(fd, &fst);
+    src.size = fst.st_size;
+    if (src.size > 0) {
+        void *m = mmap(nullptr, src.size, PROT_READ, MAP_PRIVATE, fd, 0);
+        close(fd);
+        if (m == MAP_FAILED) return false;
+        madvise(m, src.size, MADV_SEQUENTIAL);
+        src.map = m;
+        src.data = (const char *)m;
+    } else {
+        close(fd);
+    }
+    return true;
+}
+
+/*
+ Состояние майнера (out_dir/state.txt) для инкрементальной досборки (--append):
+ словарь шаблонов с DF, сигнатуры (drain), число документов/строк, смещение
+ последнего обработанного байта и контрольная сумма префикса последнего
+ («живого») файла набора, а также пути и размеры предыдущих («закрытых») файлов.
+ Досборка продолжает живой файл, только если закрытые файлы те же; если набор
+ изменился (ротация), файл укоротился, подменён (не сошлась сумма) или изменились
+ параметры майнера — делается полная пересборка.
+ Вектора пишутся с сырыми счётчиками (tf), IDF применяется при чтении по df.json,
+ поэтому старые строки vectors.jsonl при дрейфе IDF переписывать не нужно.
+*/
+struct ShardInfo {
+    string name;
+    long long start = 0, rows = 0, nnz = 0;
+};
+
+// закрытый файл набора; len/checksum/rows — по распакованному содержимому
+struct SealedFile {
+    long long file_size = 0;
+    string path;
+    size_t len = 0;
+    uint64_t checksum = 0;
+    long long rows = 0;
+};
+
+struct MinerState {
+    string params;                      // режим и параметры дерева одной строкой
+    string build_id;                    // меняется при каждой полной сборке
+    vector<SealedFile> sealed;          // закрытые файлы набора в порядке line_id
+    string live;                        // последний файл набора, к нему относится offset
+    size_t offset = 0;
+    uint64_t checksum = 0;
+    long long num_docs = 0;
+    long long num_lines = 0;            // следующий line_id
+    long long jsonl_bytes = 0;          // длина vectors.jsonl на момент сохранения
+    vector<Template> templates;
+    vector<long long> docfreq;
+    vector<string> sigs;                // drain: сигнатура -> шаблон
+    vector<int> sig_tid;
+    vector<string> alert_tags;          // id -> первый токен строки ("-", "KERNDTLB", ...)
+    vector<ShardInfo> shards;
+};
+
+uint64_t fnv1a(const char *p, size_t n, uint64_t h) {
+    for (size_t i = 0; i < n; i++) { h ^= (unsigned char)p[i]; h *= 1099511628211ULL; }
+    return h;
+}
+
+// сумма по началу файла и по хвосту обработанной части (до 64 KiB каждый)
+uint64_t prefix_checksum(const char *data, size_t offset) {
+    const size_t W = 1 << 16;
+    uint64_t h = fnv1a(data, min(offset, W), 14695981039346656037ULL);
+    size_t from = offset > W ? offset - W : 0;
+    h = fnv1a(data + from, offset - from, h);
+    return h ^ offset;
+}
+
+// то же по файлу, читаемому блоками: head — первые до 64 KiB файла, tail — до 64 KiB
+// перед блоком data, который начинается со смещения base; base <= offset <= конец блока
+uint64_t block_checksum(const string &head, const string &tail, size_t base, const char *data, size_t offset) {
+    const size_t W = 1 << 16;
+    uint64_t h = fnv1a(head.data(), min(offset, W), 14695981039346656037ULL);
+    size_t from = offset > W ? offset - W : 0;
+    if (from < base) {
+        h = fnv1a(tail.data() + tail.size() - (base - from), base - from, h);
+        from = base;
+    }
+    h = fnv1a(data + (from - base), offset - from, h);
+    return h ^ offset;
+}
+
+bool load_state(const string &file, MinerState &st) {
+    ifstream in(file);
+    string line, key;
+    if (!getline(in, line) || line != "bgl_template_miner_state 6") return false;
+    if (!getline(in, st.params)) return false;
+    if (!getline(in, line) || line.rfind("build ", 0) != 0) return false;
+    st.build_id = line.substr(6);
+    size_t n_sealed = 0, n_tpl = 0, n_sig = 0;
+    in >> key >> n_sealed;
+    getline(in, line);
+    for (size_t i = 0; i < n_sealed && getline(in, line); i++) {
+        SealedFile f;
+        istringstream ls(line);
+        if (!(ls >> f.file_size >> f.len >> f.checksum >> f.rows)) return false;
+        ls.get();
+        getline(ls, f.path);
+        st.sealed.push_back(f);
+    }
+    if (!getline(in, line) || line.rfind("live ", 0) != 0) return false;
+    st.live = line.substr(5);
+    in >> key >> st.offset >> key >> st.checksum >> key >> st.num_docs
+       >> key >> st.num_lines >> key >> st.jsonl_bytes >> key >> n_tpl;
+    getline(in, line);
+    for (size_t i = 0; i < n_tpl && getline(in, line); i++) {
+        size_t tab = line.find('\t');
+        if (tab == string::npos) return false;
+        st.docfreq.push_back(stoll(line.substr(0, tab)));
+        st.templates.push_back({split(line.substr(tab + 1))});
+    }
+    in >> key >> n_sig;
+    getline(in, line);
+    for (size_t i = 0; i < n_sig && getline(in, line); i++) {
+        size_t tab = line.find('\t');
+        if (tab == string::npos) return false;
+        st.sig_tid.push_back(stoi(line.substr(0, tab)));
+        st.sigs.push_back(line.substr(tab + 1));
+    }
+    size_t n_tags = 0, n_shards = 0;
+    in >> key >> n_tags;
+    getline(in, line);
+    for (size_t i = 0; i < n_tags && getline(in, line); i++) st.alert_tags.push_back(line);
+    in >> key >> n_shards;
+    for (size_t i = 0; i < n_shards; i++) {
+        ShardInfo sh;
+        if (!(in >> sh.name >> sh.start >> sh.rows >> sh.nnz)) return false;
+        st.shards.push_back(sh);
+    }
+    return (bool)in && st.templates.size() == n_tpl && st.sigs.size() == n_sig
+        && st.alert_tags.size() == n_tags;
+}
+
+void save_state(const string &file, const MinerState &st, bool drain) {
+    string tmp = file + ".tmp";
+    {
+        ofstream out(tmp, ios::trunc);
+        out << "bgl_template_miner_state 6\n" << st.params << "\n";
+        out << "build " << st.build_id << "\n";
+        out << "sealed " << st.sealed.size() << "\n";
+        for (const auto &f : st.sealed)
+            out << f.file_size << " " << f.len << " " << f.checksum << " " << f.rows << " " << f.path << "\n";
+        out << "live " << st.live << "\n";
+        out << "offset " << st.offset << "\nchecksum " << st.checksum
+            << "\nnum_docs " << st.num_docs << "\nnum_lines " << st.num_lines
+            << "\njsonl_bytes " << st.jsonl_bytes
+            << "\ntemplates " << st.templates.size() << "\n";
+        for (size_t i = 0; i < st.templates.size(); i++)
+            out << st.docfreq[i] << "\t" << join(st.templates[i].tokens) << "\n";
+        // в exact сигнатура совпадает с шаблоном — восстанавливается из templates
+        size_t n_sig = drain ? st.sigs.size() : 0;
+        out << "signatures " << n_sig << "\n";
+        for (size_t i = 0; i < n_sig; i++) out << st.sig_tid[i] << "\t" << st.sigs[i] << "\n";
+        out << "alert_tags " << st.alert_tags.size() << "\n";
+        for (const auto &t : st.alert_tags) out << t << "\n";
+        out << "shards " << st.shards.size() << "\n";
+        for (const auto &sh : st.shards)
+            out << sh.name << " " << sh.start << " " << sh.rows << " " << sh.nnz << "\n";
+    }
+    rename(tmp.c_str(), file.c_str());
+}
+
+/*
+ Бинарные CSR-шарды (out_dir/shards): на каждый шард — набор little-endian
+ массивов без заголовка, читаемых через numpy.memmap:
+   indptr (<i8, rows+1), indices (<i4, nnz), data (<f4, nnz, сырые tf),
+   is_alert (|u1), template_id (<i4), line_id (<i8), alert_tag (<i4, id из alert_tags).
+ Новые строки дописываются в последний шард, пока в нём меньше shard_rows строк.
+ manifest.json описывает шарды (start/rows/nnz) и пишется последним, атомарно.
+*/
+static const vector<pair<string,string>> SHARD_ARRAYS = {
+    {"indptr", "<i8"}, {"indices", "<i4"}, {"data", "<f4"}, {"is_alert", "|u1"},
+    {"template_id", "<i4"}, {"line_id", "<i8"}, {"alert_tag", "<i4"},
+};
+
+class ShardWriter {
+public:
+    ShardWriter(const string &dir, vector<ShardInfo> &shards, long long shard_rows)
+        : dir(dir), shards(shards), shard_rows(max(shard_rows, 1LL)) {}
+
+    ~ShardWriter() { close_files(); }
+
+    void add(long long line_id, int tid, bool is_alert, int alert_tag) {
+        if (files.empty() || shards.back().rows >= shard_rows) open_shard();
+        ShardInfo &sh = shards.back();
+        int32_t idx = tid, tpl = tid, tag = alert_tag;
+        float val = 1.0f;
+        uint8_t alert = is_alert;
+        int64_t lid = line_id;
+        sh.rows++;
+        sh.nnz++;
+        int64_t ptr = sh.nnz;
+        fwrite(&ptr, 8, 1, files[0]);
+        fwrite(&idx, 4, 1, files[1]);
+        fwrite(&val, 4, 1, files[2]);
+        fwrite(&alert, 1, 1, files[3]);
+        fwrite(&tpl, 4, 1, files[4]);
+        fwrite(&lid, 8, 1, files[5]);
+        fwrite(&tag, 4, 1, files[6]);
+    }
+
+    void close_files() {
+        for (FILE *f : files) fclose(f);
+        files.clear();
+    }
+
+private:
+    string dir;
+    vector<ShardInfo> &shards;
+    long long shard_rows;
+    vector<FILE*> files;
+
+    string array_path(const string &name, const string &arr) {
+        return dir + "/" + name + "." + arr + ".bin";
+    }
+
+    void open_shard() {
+        close_files();
+        bool reuse = !shards.empty() && shards.back().rows < shard_rows;
+        if (!reuse) {
+            ShardInfo sh;
+            char name[32];
+            snprintf(name, sizeof(name), "shard_%05zu", shards.size());
+            sh.name = name;
+            sh.start = shards.empty() ? 0 : shards.back().start + shards.back().rows;
+            shards.push_back(sh);
+        }
+        const ShardInfo &sh = shards.back();
+        // длины массивов по state: всё, что дописано после последнего сохранения, отрезается
+        const long long sizes[] = {(sh.rows + 1) * 8, sh.nnz * 4, sh.nnz * 4, sh.rows,
+                                   sh.rows * 4, sh.rows * 8, sh.rows * 4};
+        for (size_t i = 0; i < SHARD_ARRAYS.size(); i++) {
+            string p = array_path(sh.name, SHARD_ARRAYS[i].first);
+            FILE *f = fopen(p.c_str(), reuse ? "r+b" : "wb");
+            if (!f) { cerr << "Failed to open " << p << "\n"; exit(2); }
+            if (reuse) {
+                if (ftruncate(fileno(f), sizes[i]) != 0) { cerr << "Failed to truncate " << p << "\n"; exit(2); }
+                fseek(f, 0, SEEK_END);
+            } else if (i == 0) {
+                int64_t zero = 0;
+                fwrite(&zero, 8, 1, f);
+            }
+            files.push_back(f);
+        }
+    }
+};
+
+void save_manifest(const string &dir, const MinerState &st, int dim) {
+    string tmp = dir + "/manifest.json.tmp";
+    {
+        ofstream jm(tmp, ios::trunc);
+        long long rows = st.shards.empty() ? 0 : st.shards.back().start + st.shards.back().rows;
+        jm << "{\n  \"version\": 1,\n  \"build_id\": \"" << st.build_id << "\",\n  \"weighting\": \"tf\",\n";
+        jm << "  \"num_rows\": " << rows << ",\n  \"dim\": " << dim << ",\n";
+        jm << "  \"dtypes\": {";
+        for (size_t i = 0; i < SHARD_ARRAYS.size(); i++)
+            jm << (i ? ", " : "") << "\"" << SHARD_ARRAYS[i].first << "\": \"" << SHARD_ARRAYS[i].second << "\"";
+        jm << "},\n  \"alert_tags\": [";
+        for (size_t i = 0; i < st.alert_tags.size(); i++)
+            jm << (i ? "," : "") << "\"" << json_escape(st.alert_tags[i]) << "\"";
+        jm << "],\n  \"shards\": [\n";
+        for (size_t i = 0; i < st.shards.size(); i++) {
+            const auto &sh = st.shards[i];
+            jm << "    {\"name\": \"" << sh.name << "\", \"start\": " << sh.start
+               << ", \"rows\": " << sh.rows << ", \"nnz\": " << sh.nnz << "}"
+               << (i + 1 < st.shards.size() ? "," : "") << "\n";
+        }
+        jm << "  ]\n}\n";
+    }
+    rename(tmp.c_str(), (dir + "/manifest.json").c_str());
+}
+
 int main(int argc, char **argv) {
     if (argc < 4) {
-        cerr << "Usage: <bgl.log> <encoding> <out_dir>\n";
+        cerr << "Usage: <bgl.log> <encoding> <out_dir> [--input <file>]... [--mode exact|drain] [--depth N] [--sim X] [--max-children N] [--skip-fields N] [--threads N] [--shard-rows N] [--block-mb X] [--append]\n";
         return 1;
     }
-    string path = argv[1];
+    vector<string> inputs{argv[1]};         // порядок важен: от старых файлов к живому
     string outdir = argv[3];
 
+    string mode = "exact";
+    int depth = 5;
+    double sim_threshold = 0.5;
+    size_t max_children = 100;
+    size_t skip_fields = 5;
+    int threads = 1;
+    long long shard_rows = 1 << 20;
+    size_t block_bytes = 64 << 20;          // порция распаковки сжатых файлов
+    bool append = false;
+    for (int i = 4; i < argc; i++) {
+        string key = argv[i];
+        if (key == "--append") { append = true; continue; }
+        if (i + 1 >= argc) { cerr << "Missing value for " << key << "\n"; return 1; }
+        string val = argv[++i];
+        if (key == "--input") inputs.push_back(val);
+        else if (key == "--mode") mode = val;
+        else if (key == "--depth") depth = stoi(val);
+        else if (key == "--sim") sim_threshold = stod(val);
+        else if (key == "--max-children") max_children = stoul(val);
+        else if (key == "--skip-fields") skip_fields = stoul(val);
+        else if (key == "--threads") threads = stoi(val);
+        else if (key == "--shard-rows") shard_rows = stoll(val);
+        else if (key == "--block-mb") block_bytes = max<size_t>(1 << 12, stod(val) * (1 << 20));
+        else { cerr << "Unknown option " << key << "\n"; return 1; }
+    }
+    if (mode != "exact" && mode != "drain") {
+        cerr << "Unknown mode " << mode << "\n";
+        return 1;
+    }
+    bool drain = (mode == "drain");
+    if (threads <= 0) threads = max(1u, thread::hardware_concurrency());
+
     system((string("mkdir -p ") + outdir).c_str());
 
-    // ================= PASS 1: build templates & DF =================
+    auto t_start = chrono::steady_clock::now();
 
-    unordered_map<string,int> template_id;      // template_string -> id
-    vector<Template> templates;                 // id -> template vector
-    unordered_map<int,int> docfreq;             // template_id -> df count
-    long long num_docs = 0;
+    // размеры на диске: по ним узнаём, что закрытые файлы набора не менялись
+    vector<Source> sources(inputs.size());
+    for (size_t i = 0; i < inputs.size(); i++) {
+        struct stat fst;
+        if (stat(inputs[i].c_str(), &fst) != 0) {
+            cerr << "Failed to open input log " << inputs[i] << "\n";
+            return 2;
+        }
+        sources[i].path = inputs[i];
+        sources[i].file_size = fst.st_size;
+    }
+    Source &live = sources.back();
+    auto same_sealed = [&](const vector<SealedFile> &prev) {
+        if (prev.size() + 1 != sources.size()) return false;
+        for (size_t i = 0; i < prev.size(); i++)
+            if (prev[i].file_size != sources[i].file_size || prev[i].path != sources[i].path) return false;
+        return true;
+    };
 
-    {
-        ifstream fin(path);
-        if (!fin.is_open()) {
-            cerr << "Failed to open input log\n";
+    // ================= STATE: продолжаем с сохранённого смещения =================
+    string state_path = outdir + "/state.txt";
+    ostringstream params_os;
+    params_os << "mode " << mode;
+    if (drain) params_os << " depth " << depth << " sim " << sim_threshold
+                         << " max_children " << max_children << " skip_fields " << skip_fields;
+
+    MinerState st, prev;
+    bool resumed = false;
+    bool have_prev = load_state(state_path, prev);
+    // прежняя сборка: по ней считается, сколько строк нового набора уже были прочитаны
+    string prev_build = have_prev ? prev.build_id : "";
+    long long prev_rows = have_prev ? prev.num_lines : 0;
+    size_t prev_offset = prev.offset;
+    uint64_t prev_checksum = prev.checksum;
+    if (append) {
+        if (!have_prev) {
+            cerr << "[append] no valid state, full rebuild\n";
+        } else if (prev.params != params_os.str()) {
+            cerr << "[append] miner params changed, full rebuild\n";
+        } else if (!same_sealed(prev.sealed) || prev.live != live.path) {
+            cerr << "[append] input file set changed (rotation), full rebuild\n";
+        } else if (!load_source(live)) {
+            cerr << "Failed to read input " << live.path << "\n";
             return 2;
+        } else if (prev.offset > live.size || prefix_checksum(live.data, prev.offset) != prev.checksum) {
+            cerr << "[append] input truncated or replaced, full rebuild\n";
+        } else if (prev.offset > 0 && prev.offset < live.size && live.data[prev.offset - 1] != '\n') {
+            // прежняя (полная) сборка закончилась на строке без '\n', а лог вырос:
+            // продолжение той строки нельзя отличить от новой
+            cerr << "[append] previous build ended mid-line, full rebuild\n";
+        } else {
+            st = move(prev);
+            resumed = true;
         }
-        string line;
-        while (getline(fin, line)) {
-            if (line.empty()) continue;
-            num_docs++;
+    }
+    st.params = params_os.str();
+    if (!resumed) {
+        // новая сборка нумерует строки заново: читатели по build_id сбрасывают кэши и курсоры
+        char id[40];
+        snprintf(id, sizeof(id), "%llx-%x",
+                 (unsigned long long)chrono::system_clock::now().time_since_epoch().count(), (unsigned)getpid());
+        st.build_id = id;
+    }
+    st.live = live.path;
+    if (resumed && !drain) {
+        for (size_t i = 0; i < st.templates.size(); i++) {
+            st.sigs.push_back(join(st.templates[i].tokens));
+            st.sig_tid.push_back(i);
+        }
+    }
 
-            // extract tokens
-            auto toks = split(line);
-            if (toks.empty()) continue;
+    // в --append (досборка, слежение) обрабатываем только завершённые строки живого
+    // файла: хвост без '\n' ещё дописывается и ждёт следующего запуска, в том числе
+    // когда досборка откатилась к полной. Обычная полная сборка читает файл целиком.
+    if (!load_source(live)) {
+        cerr << "Failed to read input " << live.path << "\n";
+        return 2;
+    }
+    size_t begin = resumed ? st.offset : 0;
+    size_t end = live.size;
+    if (append) {
+        while (end > begin && live.data[end - 1] != '\n') end--;
+    }
 
-            // remove alert token
-            string alert = toks[0];
-            vector<string> msg(toks.begin() + 1, toks.end());
+    // части прежней сборки (закрытые файлы и прочитанный префикс живого) для carried, см. ниже
+    struct Part { size_t len; uint64_t checksum; long long until; };
+    vector<Part> parts;
+    if (!resumed && have_prev) {
+        long long until = 0;
+        for (const auto &f : prev.sealed) parts.push_back({f.len, f.checksum, until += f.rows});
+        if (prev_offset > 0) parts.push_back({prev_offset, prev_checksum, prev_rows});
+    }
 
-            // normalize tokens → template signature
-            vector<string> norm;
-            for (auto &t : msg) norm.push_back(normalize_token(t));
+    // ================= PASS 1 (parallel): signatures per range =================
+    // файлы по одному, сжатые — блоками; диапазоны идут в порядке файлов, внутри файла —
+    // по смещению. Пока блок в памяти, по нему считаются строки файла, сумма закрытого
+    // файла и совпадения с частями прежней сборки; потом блок освобождается
+    vector<Chunk> chunks;
+    vector<long long> src_rows(sources.size(), 0);
+    // part_rows[i][k] — строк файла i до конца части k, если файл начинается с неё, иначе -1
+    vector<vector<long long>> part_rows(sources.size(), vector<long long>(parts.size(), -1));
+    string head, tail;
+    auto mine_block = [&](size_t i, const char *data, size_t n, size_t base, size_t b, size_t e, uint64_t *sum) {
+        const size_t W = 1 << 16;
+        size_t first = chunks.size();
+        int k = max<int>(1, min<size_t>(threads, (e - b) >> 16));
+        for (auto &ch : split_ranges(data, b, e, k)) {
+            ch.base = base;
+            chunks.push_back(move(ch));
+        }
+        atomic<size_t> next{first};
+        vector<thread> pool;
+        for (int t = 0; t < k; t++) {
+            pool.emplace_back([&]() {
+                for (size_t c = next++; c < chunks.size(); c = next++) mine_chunk(chunks[c], drain);
+            });
+        }
+        for (auto &t : pool) t.join();
 
-            string tpl = join(norm);
+        if (head.size() < W) head.append(data, min(n, W - head.size()));
+        for (size_t p = 0; p < parts.size(); p++) {
+            size_t len = parts[p].len;
+            if (len <= base || len > base + n) continue;
+            if (block_checksum(head, tail, base, data, len) != parts[p].checksum) continue;
+            long long rows = src_rows[i];
+            for (size_t c = first; c < chunks.size(); c++)
+                for (const auto &ln : chunks[c].lines) rows += ln.pos < len;
+            part_rows[i][p] = rows;
+        }
+        if (sum) *sum = block_checksum(head, tail, base, data, base + n);
+        for (size_t c = first; c < chunks.size(); c++) {
+            src_rows[i] += chunks[c].lines.size();
+            chunks[c].data = "";
+        }
+        tail.append(data + n - min(n, W), min(n, W));
+        if (tail.size() > W) tail.erase(0, tail.size() - W);
+    };
+    for (size_t i = resumed ? sources.size() - 1 : 0; i < sources.size(); i++) {
+        Source &src = sources[i];
+        head.clear();
+        tail.clear();
+        uint64_t sum = 0;
+        size_t size = 0;
+        if (&src == &live || !compressed(src.path)) {
+            if (!load_source(src)) {
+                cerr << "Failed to read input " << src.path << "\n";
+                return 2;
+            }
+            size = src.size;
+            if (&src == &live) mine_block(i, src.data, size, 0, begin, end, nullptr);
+            else mine_block(i, src.data, size, 0, 0, size, &sum);
+            if (&src != &live) src.unload();
+        } else {
+            Decoder dec;
+            string block;
+            bool ok = dec.open(src.path);
+            while (ok) {
+                // блок из целых строк; неполная последняя строка переходит в следующий
+                size_t want = block_bytes, n = 0;
+                while ((ok = dec.read(block, want)) && !dec.eof && (n = block.rfind('\n') + 1) == 0)
+                    want += block_bytes;
+                if (!ok) break;
+                if (dec.eof) n = block.size();
+                mine_block(i, block.data(), n, size, 0, n, &sum);
+                size += n;
+                block.erase(0, n);
+                if (dec.eof) break;
+            }
+            if (!ok) {
+                cerr << "Failed to read input " << src.path << "\n";
+                return 2;
+            }
+        }
+        if (!resumed && &src != &live) st.sealed.push_back({src.file_size, src.path, size, sum, src_rows[i]});
+    }
 
-            int id;
-            auto it = template_id.find(tpl);
-            if (it == template_id.end()) {
-                id = templates.size();
-                template_id[tpl] = id;
-                templates.push_back({norm});
+    // ================= MERGE: deterministic global ids =================
+    unordered_map<string,int> sig_global;       // signature -> global id
+    for (size_t g = 0; g < st.sigs.size(); g++) sig_global.emplace(st.sigs[g], g);
+    size_t known_sigs = st.sigs.size();
+    vector<long long> sig_df(known_sigs, 0);    // DF сигнатур в этом запуске
+    vector<vector<int>> remap(chunks.size());
+    long long new_docs = 0;
+    for (size_t c = 0; c < chunks.size(); c++) {
+        auto &ch = chunks[c];
+        new_docs += ch.num_docs;
+        remap[c].resize(ch.sigs.size());
+        for (size_t l = 0; l < ch.sigs.size(); l++) {
+            auto it = sig_global.find(ch.sigs[l]);
+            int g;
+            if (it == sig_global.end()) {
+                g = st.sigs.size();
+                sig_global.emplace(ch.sigs[l], g);
+                st.sigs.push_back(ch.sigs[l]);
+                sig_df.push_back(0);
             } else {
-                id = it->second;
+                g = it->second;
             }
-            docfreq[id]++;
+            sig_df[g] += ch.sig_df[l];
+            remap[c][l] = g;
         }
+        ch.sig_id.clear();
     }
 
-    int dim = templates.size();
+    // сигнатура -> шаблон: в exact это тождество, в drain — кластер дерева
+    // (новые сигнатуры подаются в дерево в порядке первого появления)
+    DrainTree tree(depth, sim_threshold, max_children, skip_fields);
+    if (drain) tree.restore(st.templates);
+    for (size_t g = known_sigs; g < st.sigs.size(); g++) {
+        if (drain) {
+            st.sig_tid.push_back(tree.add(split(st.sigs[g]), st.templates));
+        } else {
+            st.sig_tid.push_back(g);
+            st.templates.push_back({split(st.sigs[g])});
+        }
+    }
+    const auto &templates = st.templates;
+    const auto &sig_tid = st.sig_tid;
 
-    // compute IDF
-    vector<double> idf(dim,0.0);
-    for (int i=0;i<dim;i++){
-        double df = (docfreq.count(i) ? docfreq[i] : 1);
-        idf[i] = log((double)num_docs / df);
+    // carried — сколько первых строк этой сборки уже были в прежней: они совпадают со
+    // строками прежней сборки [carried_until - carried, carried_until). При досборке это
+    // все прежние строки; при полной пересборке ищется последний файл прежнего набора
+    // (или прочитанный префикс прежнего живого), который остался в новом наборе —
+    // ротация переименованием или copytruncate. По этим числам follow продолжает
+    // line_id без пропусков и повторов.
+    long long carried = 0, carried_until = 0;
+    if (resumed) {
+        carried = carried_until = prev_rows;
+    } else if (have_prev) {
+        bool found = false;
+        for (size_t k = parts.size(); k-- > 0 && !found;) {
+            for (size_t i = sources.size(); i-- > 0;) {
+                if (part_rows[i][k] < 0) continue;
+                for (size_t j = 0; j < i; j++) carried += src_rows[j];
+                carried += part_rows[i][k];
+                carried_until = parts[k].until;
+                carried = min(carried, carried_until);
+                found = true;
+                break;
+            }
+        }
     }
 
+    int dim = templates.size();
+    st.docfreq.resize(dim, 0);
+    for (size_t g = 0; g < st.sigs.size(); g++) st.docfreq[sig_tid[g]] += sig_df[g];
+    st.num_docs += new_docs;
+
     // save templates.json
     {
         ofstream jt(outdir + "/templates.json");
@@ -113,7 +975,7 @@ int main(int argc, char **argv) {
         for (size_t i=0;i<templates.size();i++){
             jt << "  {\"id\": " << i << ", \"tokens\": [";
             for (size_t j=0;j<templates[i].tokens.size();j++){
-                jt << "\"" << templates[i].tokens[j] << "\"";
+                jt << "\"" << json_escape(templates[i].tokens[j]) << "\"";
                 if (j + 1 < templates[i].tokens.size()) jt << ",";
             }
             jt << "]}";
@@ -123,74 +985,112 @@ int main(int argc, char **argv) {
         jt << "]\n";
     }
 
-    // save meta.json
+    // save df.json: IDF = log(num_docs / df) считается читателем
     {
-        ofstream jm(outdir + "/meta.json");
-        jm << "{\n";
-        jm << "  \"num_docs\": " << num_docs << ",\n";
-        jm << "  \"vocab_size\": " << dim << ",\n";
-        jm << "  \"templates\": " << dim << "\n";
-        jm << "}\n";
+        ofstream jd(outdir + "/df.json");
+        jd << "{\"num_docs\": " << st.num_docs << ", \"df\": [";
+        for (int i = 0; i < dim; i++) jd << (i ? "," : "") << st.docfreq[i];
+        jd << "]}\n";
     }
 
-    // ================= PASS 2: write vectors.jsonl =================
+    // ================= PASS 2: write vectors.jsonl + CSR shards from cached ids =================
+    // only 1 nonzero, tf = 1 (IDF применяется при чтении);
+    // хвост строки для каждого шаблона форматируется один раз
+    string shard_dir = outdir + "/shards";
+    if (!resumed) filesystem::remove_all(shard_dir);
+    filesystem::create_directories(shard_dir);
+    unordered_map<string,int> tag_id;
+    for (size_t i = 0; i < st.alert_tags.size(); i++) tag_id.emplace(st.alert_tags[i], i);
     {
-        ifstream fin(path);
-        ofstream jout(outdir + "/vectors.jsonl");
-
-        string line;
-        long long line_id = 0;
-        while (getline(fin, line)) {
-            if (line.empty()) continue;
-            auto toks = split(line);
-            if (toks.empty()) continue;
-
-            string alert = toks[0];
-            bool is_alert = (alert != "-");
-            vector<string> msg(toks.begin() + 1, toks.end());
-
-            // normalize
-            vector<string> norm;
-            for (auto &t : msg) norm.push_back(normalize_token(t));
-            string tpl = join(norm);
-
-            auto it = template_id.find(tpl);
-            int tid = (it == template_id.end() ? -1 : it->second);
-
-            // build vector: only 1 nonzero = tf*idf = 1*idf
-            vector<int> indices;
-            vector<double> vals;
-
-            if (tid >= 0) {
-                indices.push_back(tid);
-                vals.push_back(idf[tid]);
-            }
+        ShardWriter shards(shard_dir, st.shards, shard_rows);
+        vector<string> tail(dim);
+        for (int t = 0; t < dim; t++) {
+            ostringstream os;
+            os << "\"template_id\":" << t << ",\"dim\":" << dim
+               << ",\"indices\":[" << t << "],\"values\":[1]}\n";
+            tail[t] = os.str();
+        }
 
-            // output JSONL
-            jout << "{";
-            jout << "\"line_id\":" << line_id << ",";
-            jout << "\"alert_tag\":\"" << alert << "\",";
-            jout << "\"is_alert\":" << (is_alert?"true":"false") << ",";
-            jout << "\"template_id\":" << tid << ",";
-            jout << "\"dim\":" << dim << ",";
-            jout << "\"indices\":[";
-            for (size_t i=0;i<indices.size();i++){
-                jout << indices[i];
-                if (i + 1 < indices.size()) jout << ",";
+        // как и шарды, vectors.jsonl обрезается до длины из state: строки, дописанные
+        // запуском, который упал до save_state, не дублируются
+        string jpath = outdir + "/vectors.jsonl";
+        FILE *jout = fopen(jpath.c_str(), resumed ? "r+b" : "wb");
+        if (!jout) {
+            cerr << "Failed to open vectors.jsonl\n";
+            return 2;
+        }
+        if (resumed) {
+            if (ftruncate(fileno(jout), st.jsonl_bytes) != 0) {
+                cerr << "Failed to truncate " << jpath << "\n";
+                return 2;
             }
-            jout << "],\"values\":[";
-            for (size_t i=0;i<vals.size();i++){
-                jout << vals[i];
-                if (i + 1 < vals.size()) jout << ",";
+            fseek(jout, 0, SEEK_END);
+        }
+        string buf;
+        buf.reserve(1 << 21);
+        char head[64];
+        for (size_t c = 0; c < chunks.size(); c++) {
+            for (const auto &ln : chunks[c].lines) {
+                int tid = sig_tid[remap[c][ln.sig]];
+                const string &alert = chunks[c].tags[ln.tag];
+                bool is_alert = alert != "-";
+                auto tit = tag_id.find(alert);
+                if (tit == tag_id.end()) {
+                    tit = tag_id.emplace(alert, st.alert_tags.size()).first;
+                    st.alert_tags.push_back(alert);
+                }
+                shards.add(st.num_lines, tid, is_alert, tit->second);
+                int n = snprintf(head, sizeof(head), "{\"line_id\":%lld,\"alert_tag\":\"", st.num_lines);
+                buf.append(head, n);
+                buf += json_escape(alert);
+                buf += is_alert ? "\",\"is_alert\":true," : "\",\"is_alert\":false,";
+                buf += tail[tid];
+                st.num_lines++;
+                if (buf.size() >= (1 << 20)) {
+                    fwrite(buf.data(), 1, buf.size(), jout);
+                    buf.clear();
+                }
             }
-            jout << "]}";
-            jout << "\n";
-
-            line_id++;
         }
+        fwrite(buf.data(), 1, buf.size(), jout);
+        st.jsonl_bytes = ftell(jout);
+        fclose(jout);
     }
 
-    cerr << "[OK] templates=" << templates.size() << " docs=" << num_docs << "\n";
+    st.offset = end;
+    st.checksum = prefix_checksum(live.data, end);
+    save_state(state_path, st, drain);
+    save_manifest(shard_dir, st, dim);
+
+    double elapsed = chrono::duration<double>(chrono::steady_clock::now() - t_start).count();
+    double lines_per_sec = elapsed > 0 ? new_docs / elapsed : 0.0;
+
+    // save meta.json
+    {
+        ofstream jm(outdir + "/meta.json");
+        jm << "{\n";
+        jm << "  \"num_docs\": " << st.num_docs << ",\n";
+        jm << "  \"vocab_size\": " << dim << ",\n";
+        jm << "  \"templates\": " << dim << ",\n";
+        jm << "  \"mode\": \"" << mode << "\",\n";
+        jm << "  \"weighting\": \"tf\",\n";
+        jm << "  \"build_id\": \"" << st.build_id << "\",\n";
+        jm << "  \"incremental\": " << (resumed ? "true" : "false") << ",\n";
+        jm << "  \"prev_build_id\": \"" << prev_build << "\",\n";
+        jm << "  \"prev_rows\": " << prev_rows << ",\n";
+        jm << "  \"carried_rows\": " << carried << ",\n";
+        jm << "  \"carried_until\": " << carried_until << ",\n";
+        jm << "  \"new_docs\": " << new_docs << ",\n";
+        jm << "  \"offset\": " << end << ",\n";
+        jm << "  \"inputs\": " << sources.size() << ",\n";
+        jm << "  \"threads\": " << threads << ",\n";
+        jm << "  \"lines_per_sec\": " << (long long)lines_per_sec << "\n";
+        jm << "}\n";
+    }
+
+    cerr << "[OK] templates=" << templates.size() << " docs=" << st.num_docs
+         << " new=" << new_docs << (resumed ? " (append)" : " (full)")
+         << " threads=" << threads << " sec=" << elapsed
+         << " lines/sec=" << (long long)lines_per_sec << "\n";
     return 0;
 }
-
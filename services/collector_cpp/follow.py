@@ -0,0 +1,231 @@
+import os, json, time, queue, threading
+import requests
+
+
+class Follower:
+    """
+    Режим слежения за логом: раз в poll_interval_s досборка майнером (--append)
+    и чтение новых строк из шардов начиная с курсора. Строки копятся в микро-батч,
+    который уходит в storage (/bgl/vectors/bulk), как только набралось batch_rows
+    строк или с первой строки прошло max_latency_ms.
+
+    Читатель и отправитель связаны очередью на queue_batches батчей: если storage
+    не успевает или недоступен, очередь заполняется и читатель перестаёт брать
+    новые строки (и запускать майнер), пока отправитель не разгребёт её.
+    Отправка повторяется с экспоненциальной паузой до успеха при ошибках соединения
+    и ответах 5xx (а также 408/429); прочие 4xx — отказ storage принять батч, повтор
+    его не исправит: слежение останавливается с last_error, checkpoint остаётся перед
+    батчем. После успеха
+    line_id следующей строки атомарно пишется в checkpoint, и после рестарта
+    чтение продолжается с него (строки не теряются, но возможен повтор батча,
+    отправленного перед падением).
+
+    Полная пересборка майнером (ротация, подмена лога) нумерует строки заново, поэтому
+    line_id в storage = base + номер строки текущей сборки. По meta.json новой сборки
+    (prev_build_id, carried_rows, carried_until) курсор переносится на первую ещё не
+    прочитанную строку, а base — так, чтобы line_id продолжились без пропусков и повторов.
+
+    После каждой досборки, если веса шаблонов изменились, читатель отправляет их в
+    storage (PUT /bgl/template_idf) раньше новых строк: компактное хранение собирает
+    вектора по этим весам, а шаблонам без веса достаётся 1.0.
+    """
+
+    def __init__(self, build, total_rows, read_rows, build_info, storage_url: str, checkpoint_path: str,
+                 template_idf=None, batch_rows: int = 500, max_latency_ms: int = 1000, poll_interval_s: float = 1.0,
+                 queue_batches: int = 16, max_backoff_s: float = 30.0, timeout_s: float = 30.0):
+        self.build = build              # досборка майнером
+        self.total_rows = total_rows    # сколько строк сейчас в шардах
+        self.read_rows = read_rows      # (start, stop) -> список dict для /bgl/vectors/bulk
+        self.build_info = build_info    # meta.json последней сборки
+        self.template_idf = template_idf  # () -> список весов шаблонов или None
+        self.bulk_url = storage_url.rstrip("/") + "/bgl/vectors/bulk"
+        self.idf_url = storage_url.rstrip("/") + "/bgl/template_idf"
+        self._idf_pushed = None         # веса, которые storage уже получил
+        self.checkpoint_path = checkpoint_path
+        self.batch_rows = max(int(batch_rows), 1)
+        self.max_latency = max_latency_ms / 1000.0
+        self.poll_interval = poll_interval_s
+        self.max_backoff = max_backoff_s
+        self.timeout = timeout_s
+        self.queue: queue.Queue = queue.Queue(max(int(queue_batches), 1))
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self.build_id = None            # сборка, к которой относится cursor
+        self.base = 0                   # line_id в storage = base + номер строки сборки
+        self.cursor = 0                 # следующая строка сборки для чтения
+        self.committed = 0              # следующий line_id после последнего успешного батча
+        self.stats = {"batches": 0, "rows": 0, "retries": 0, "resets": 0, "idf_pushes": 0,
+                      "last_error": None, "last_push": None, "lag_ms": None}
+
+    # ---------- checkpoint ----------
+    def load_checkpoint(self) -> dict:
+        """
+        {"next_line_id", "build_id", "row"}; без build_id (checkpoint старого формата или
+        /follow/start?from_line) строка row относится к текущей сборке.
+        """
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                ck = json.load(f)
+            next_line_id = int(ck["next_line_id"])
+            return {"next_line_id": next_line_id, "build_id": ck.get("build_id"),
+                    "row": int(ck.get("row", next_line_id))}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {"next_line_id": 0, "build_id": None, "row": 0}
+
+    def save_checkpoint(self, next_line_id: int, build_id: str | None = None, row: int | None = None):
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"next_line_id": next_line_id, "build_id": build_id,
+                       "row": next_line_id if row is None else row, "updated": time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path)
+
+    # ---------- управление ----------
+    @property
+    def running(self) -> bool:
+        return any(t.is_alive() for t in self._threads)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self.queue = queue.Queue(self.queue.maxsize)
+        ck = self.load_checkpoint()
+        self.build_id, self.cursor, self.committed = ck["build_id"], ck["row"], ck["next_line_id"]
+        self.base = ck["next_line_id"] - ck["row"]
+        self._threads = [threading.Thread(target=self._read_loop, name="follow-reader", daemon=True),
+                         threading.Thread(target=self._send_loop, name="follow-sender", daemon=True)]
+        for t in self._threads:
+            t.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+
+    def status(self) -> dict:
+        return {"running": self.running, "build_id": self.build_id, "cursor": self.cursor,
+                "next_line_id": self.base + self.cursor, "committed": self.committed,
+                "queued_batches": self.queue.qsize(), "queue_capacity": self.queue.maxsize,
+                "storage": self.bulk_url, **self.stats}
+
+    # ---------- читатель ----------
+    def _put(self, item) -> bool:
+        # блокирующая постановка в очередь = backpressure; stop прерывает ожидание
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _sync_build(self):
+        """Переносит cursor/base на текущую сборку майнера, если она сменилась."""
+        meta = self.build_info() or {}
+        build_id = meta.get("build_id")
+        if build_id == self.build_id:
+            return
+        if self.build_id is None:
+            # первый запуск: строки с cursor текущей сборки ещё не отправлялись
+            cursor = self.cursor
+        elif meta.get("prev_build_id") == self.build_id:
+            # первые carried_rows строк новой сборки = строки прежней [until - carried, until):
+            # непрочитанный остаток прежней сборки лежит прямо перед carried_rows
+            carried, until = int(meta.get("carried_rows", 0)), int(meta.get("carried_until", 0))
+            cursor = max(carried - max(until - self.cursor, 0), 0)
+        else:
+            # связь со сборкой checkpoint потеряна (несколько пересборок без слежения):
+            # всё содержимое считаем новым, line_id продолжаются
+            cursor = 0
+        if self.build_id is not None:
+            self.stats["resets"] += 1
+        self.base += self.cursor - cursor
+        self.cursor = cursor
+        self.build_id = build_id
+
+    def _push_idf(self):
+        weights = self.template_idf() if self.template_idf is not None else None
+        if weights is None or weights == self._idf_pushed:
+            return
+        try:
+            r = requests.put(self.idf_url, json={"weights": weights}, timeout=self.timeout)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            # следующая досборка повторит отправку
+            self.stats["last_error"] = f"idf: {e}"
+            return
+        self._idf_pushed = weights
+        self.stats["idf_pushes"] += 1
+
+    def _read_loop(self):
+        pending: list[dict] = []
+        first_at = None
+        while not self._stop.is_set():
+            try:
+                self.build()
+                self._sync_build()
+                self._push_idf()
+                total = self.total_rows() or 0
+                while self.cursor < total and not self._stop.is_set():
+                    stop = min(self.cursor + self.batch_rows - len(pending), total)
+                    rows = self.read_rows(self.cursor, stop)
+                    if not rows:
+                        break
+                    if not pending:
+                        first_at = time.monotonic()
+                    for row in rows:
+                        row["line_id"] += self.base
+                    pending.extend(rows)
+                    self.cursor += len(rows)
+                    if len(pending) >= self.batch_rows:
+                        if not self._put((first_at, self._position(), pending)):
+                            return
+                        pending, first_at = [], None
+                if pending and time.monotonic() - first_at >= self.max_latency:
+                    if not self._put((first_at, self._position(), pending)):
+                        return
+                    pending, first_at = [], None
+            except Exception as e:
+                self.stats["last_error"] = f"read: {e}"
+            wait = self.poll_interval
+            if pending:
+                wait = min(wait, max(self.max_latency - (time.monotonic() - first_at), 0.0))
+            self._stop.wait(wait)
+
+    def _position(self) -> dict:
+        return {"next_line_id": self.base + self.cursor, "build_id": self.build_id, "row": self.cursor}
+
+    # ---------- отправитель ----------
+    def _send_loop(self):
+        session = requests.Session()
+        while not self._stop.is_set():
+            try:
+                first_at, end, rows = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            backoff = 0.5
+            while not self._stop.is_set():
+                try:
+                    r = session.post(self.bulk_url, json=rows, timeout=self.timeout)
+                    if 400 <= r.status_code < 500 and r.status_code not in (408, 429):
+                        self.stats["last_error"] = (f"push rejected: HTTP {r.status_code} "
+                                                    f"{r.text[:500]}; following stopped")
+                        self._stop.set()
+                        return
+                    r.raise_for_status()
+                    break
+                except requests.RequestException as e:
+                    self.stats["retries"] += 1
+                    self.stats["last_error"] = f"push: {e}"
+                    self._stop.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+            else:
+                return
+            self.committed = end["next_line_id"]
+            self.save_checkpoint(**end)
+            self.stats["batches"] += 1
+            self.stats["rows"] += len(rows)
+            self.stats["last_push"] = time.time()
+            self.stats["lag_ms"] = int((time.monotonic() - first_at) * 1000)
@@ -1,5 +1,7 @@
 import os
 import subprocess
+import threading
+from collections import OrderedDict
 from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
 from typing import List, Optional
@@ -14,13 +16,104 @@ OUT_DIR = cfg.get("out_dir", "/app/data/BGL/out")
 DATASET_FILE = cfg.get("dataset_file", "/app/data/BGL/BGL.log")
 ENCODING = cfg.get("encoding", "utf-8")
 TFIDF_PARAMS = cfg.get("tfidf", {})
+ROW_CACHE_SIZE = int(cfg.get("row_cache_size", 100000))
 
 BIN_PATH = "/app/aggregator"
+DICT_PATH = os.path.join(OUT_DIR, "dict_templ.csv")
+
+
+def _file_sig(path: str):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class ResidentVectors:
+    """
+    Шаблоны из dict_templ.csv и обученный TF-IDF держим в памяти процесса.
+    Перечитываются только при изменении файлов (mtime + размер), тогда же
+    сбрасывается ограниченный LRU-кэш разрежённых строк по templ_id.
+    """
+
+    def __init__(self, max_rows: int):
+        self.lock = threading.Lock()
+        self.max_rows = max_rows
+        self.dict_sig = None
+        self.df = None
+        self.store = None
+        self.tfidf_sig = None
+        self.observed = False
+        self.rows: OrderedDict[int, tuple[list[int], list[float]]] = OrderedDict()
+
+    def templates(self):
+        sig = _file_sig(DICT_PATH)
+        with self.lock:
+            if sig != self.dict_sig:
+                self.df = load_templates_csv(DICT_PATH)
+                self.dict_sig = sig
+                self.rows.clear()
+                self.observed = False
+            return self.df
+
+    def vectorizer(self, texts) -> TFIDFStore:
+        with self.lock:
+            if TFIDF_PARAMS.get("mode") == "hashing":
+                # обучения нет: новые шаблоны только пополняют онлайн-DF
+                if self.store is None:
+                    self.store = TFIDFStore(OUT_DIR, TFIDF_PARAMS)
+                    self.store.fit_or_load(texts)
+                elif not self.observed and self.store.observe(texts):
+                    self.rows.clear()
+                self.observed = True
+                return self.store
+            path = os.path.join(OUT_DIR, "tfidf.joblib")
+            sig = _file_sig(path) if os.path.exists(path) else None
+            if self.store is None or sig != self.tfidf_sig:
+                store = TFIDFStore(OUT_DIR, TFIDF_PARAMS)
+                store.fit_or_load(texts)
+                self.store = store
+                self.tfidf_sig = _file_sig(path)
+                self.rows.clear()
+            return self.store
+
+    def transform(self, ids: list[int], texts: list[str]) -> list[tuple[list[int], list[float]]]:
+        with self.lock:
+            store = self.store
+            out = [self.rows.get(i) for i in ids]
+            for i, r in zip(ids, out):
+                if r is not None:
+                    self.rows.move_to_end(i)
+        miss = [k for k, r in enumerate(out) if r is None]
+        if miss:
+            X = store.transform([texts[k] for k in miss]).tocsr()
+            X.sort_indices()
+            for row, k in enumerate(miss):
+                lo, hi = X.indptr[row], X.indptr[row + 1]
+                out[k] = (X.indices[lo:hi].tolist(), X.data[lo:hi].astype(float).tolist())
+            with self.lock:
+                if store is self.store:
+                    for k in miss:
+                        self.rows[ids[k]] = out[k]
+                    while len(self.rows) > self.max_rows:
+                        self.rows.popitem(last=False)
+        return out
+
+
+RESIDENT = ResidentVectors(ROW_CACHE_SIZE)
+
+
+@app.on_event("shutdown")
+def save_counters():
+    # hashing-режим: онлайн-DF сохраняется по таймеру, остаток — при остановке
+    with RESIDENT.lock:
+        if RESIDENT.store is not None:
+            RESIDENT.store.flush()
+
 
 class VectorRow(BaseModel):
     templ_id: int
     template: str
-    vector: List[float]
+    indices: List[int]
+    values: List[float]
 
 class VectorBatch(BaseModel):
     start: int
@@ -41,31 +134,31 @@ def collect_templates():
         r = subprocess.run([BIN_PATH, LOG_DIR, OUT_DIR], check=True, capture_output=True, text=True)
     except subprocess.CalledProcessError as e:
         raise HTTPException(500, f"aggregator error: {e.stderr}")
-    dict_path = os.path.join(OUT_DIR, "dict_templ.csv")
-    if not os.path.exists(dict_path):
+    if not os.path.exists(DICT_PATH):
         raise HTTPException(500, "dict_templ.csv not found after aggregation")
-    df = load_templates_csv(dict_path)
-    return {"templates": len(df), "dict_path": dict_path}
+    df = RESIDENT.templates()
+    return {"templates": len(df), "dict_path": DICT_PATH}
 
 @app.get("/collect_vectors", response_model=VectorBatch)
 def collect_vectors(offset: int = Query(0, ge=0), limit: int = Query(1000, gt=0)):
-    dict_path = os.path.join(OUT_DIR, "dict_templ.csv")
-    if not os.path.exists(dict_path):
+    """
+    Разрежённые TF-IDF вектора шаблонов (indices/values, как у основного коллектора).
+    Шаблоны, векторизатор и уже посчитанные строки берутся из памяти процесса.
+    """
+    if not os.path.exists(DICT_PATH):
         raise HTTPException(400, "Run /collect_templates first")
-    df = load_templates_csv(dict_path)
+    df = RESIDENT.templates()
     total = len(df)
-
-    store = TFIDFStore(OUT_DIR, TFIDF_PARAMS)
-    status = store.fit_or_load(df["template"].tolist())
+    store = RESIDENT.vectorizer(df["template"].tolist())
 
     start = min(offset, total)
     end = min(offset + limit, total)
     sl = df.iloc[start:end]
+    ids, templates = sl["id"].tolist(), sl["template"].tolist()
 
-    X = store.transform(sl["template"].tolist())
-    dim = X.shape[1]
+    dim = store.dim
     rows: List[VectorRow] = []
-    for templ_id, templ, row in zip(sl["id"].tolist(), sl["template"].tolist(), X.toarray()):
-        rows.append(VectorRow(templ_id=templ_id, template=templ, vector=row.astype(float).tolist()))
+    for templ_id, templ, (indices, values) in zip(ids, templates, RESIDENT.transform(ids, templates)):
+        rows.append(VectorRow(templ_id=templ_id, template=templ, indices=indices, values=values))
     return VectorBatch(start=start, end=end, total=total, dim=dim, rows=rows)
 
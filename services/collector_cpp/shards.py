@@ -0,0 +1,105 @@
+import os
+import json
+import bisect
+import numpy as np
+
+
+class ShardStore:
+    """
+    Чтение бинарных CSR-шардов bgl_template_miner (out_dir/shards) через numpy.memmap.
+    manifest.json перечитывается только при изменении, массивы шардов отображаются
+    в память лениво, поэтому срез offset/limit стоит O(limit) и не зависит от offset.
+    """
+
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        self.manifest_path = os.path.join(shard_dir, "manifest.json")
+        self.manifest: dict = {}
+        self._mtime = None
+        self._starts: list[int] = []
+        self._maps: dict[str, dict] = {}
+
+    def available(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def refresh(self):
+        mtime = os.stat(self.manifest_path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("build_id") != self.manifest.get("build_id"):
+            # полная пересборка: файлы шардов удалены и созданы заново, старые отображения
+            # указывают на отвязанные inode
+            self._maps = {}
+        else:
+            # после досборки меняется только последний шард: остальные отображения переиспользуем
+            rows = {sh["name"]: (sh["rows"], sh["nnz"]) for sh in manifest["shards"]}
+            self._maps = {k: v for k, v in self._maps.items() if v["_size"] == rows.get(k)}
+        self.manifest = manifest
+        self._starts = [sh["start"] for sh in manifest["shards"]]
+        self._mtime = mtime
+
+    @property
+    def num_rows(self) -> int:
+        return int(self.manifest.get("num_rows", 0))
+
+    @property
+    def alert_tags(self) -> list[str]:
+        return self.manifest.get("alert_tags", [])
+
+    def _open(self, sh: dict) -> dict:
+        m = self._maps.get(sh["name"])
+        if m is not None:
+            return m
+        m = {"_size": (sh["rows"], sh["nnz"])}
+        lengths = {"indptr": sh["rows"] + 1, "indices": sh["nnz"], "data": sh["nnz"]}
+        for arr, dtype in self.manifest["dtypes"].items():
+            n = lengths.get(arr, sh["rows"])
+            path = os.path.join(self.shard_dir, f"{sh['name']}.{arr}.bin")
+            m[arr] = np.memmap(path, dtype=np.dtype(dtype), mode="r", shape=(n,)) if n else np.empty(0, dtype)
+        self._maps[sh["name"]] = m
+        return m
+
+    def slice(self, start: int, stop: int) -> dict:
+        """
+        Строки [start, stop) одним CSR-блоком: indptr от нуля, остальные массивы — по строкам.
+        """
+        self.refresh()
+        stop = min(stop, self.num_rows)
+        parts = []
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        shards = self.manifest["shards"]
+        while start < stop and i < len(shards):
+            sh = shards[i]
+            lo, hi = start - sh["start"], min(stop - sh["start"], sh["rows"])
+            m = self._open(sh)
+            a, b = int(m["indptr"][lo]), int(m["indptr"][hi])
+            parts.append({
+                "indptr": np.asarray(m["indptr"][lo:hi + 1]) - a,
+                "indices": m["indices"][a:b],
+                "data": m["data"][a:b],
+                "is_alert": m["is_alert"][lo:hi],
+                "template_id": m["template_id"][lo:hi],
+                "line_id": m["line_id"][lo:hi],
+                "alert_tag": m["alert_tag"][lo:hi],
+            })
+            start = sh["start"] + hi
+            i += 1
+        return _concat(parts)
+
+
+def _concat(parts: list[dict]) -> dict:
+    if not parts:
+        return {
+            "indptr": np.zeros(1, np.int64), "indices": np.empty(0, np.int32),
+            "data": np.empty(0, np.float32), "is_alert": np.empty(0, np.uint8),
+            "template_id": np.empty(0, np.int32), "line_id": np.empty(0, np.int64),
+            "alert_tag": np.empty(0, np.int32),
+        }
+    out = {k: np.concatenate([p[k] for p in parts]) for k in parts[0] if k != "indptr"}
+    indptr = [parts[0]["indptr"]]
+    for p in parts[1:]:
+        indptr.append(p["indptr"][1:] + indptr[-1][-1])
+    out["indptr"] = np.concatenate(indptr)
+    return out
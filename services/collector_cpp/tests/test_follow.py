@@ -0,0 +1,169 @@
+import os, sys, json, time, shutil, threading, subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from follow import Follower
+from shards import ShardStore
+
+
+@pytest.fixture(scope="module")
+def miner(tmp_path_factory):
+    if shutil.which("g++") is None:
+        pytest.skip("g++ is not available")
+    out = str(tmp_path_factory.mktemp("bin") / "bgl_template_miner")
+    src = os.path.join(os.path.dirname(HERE), "cppsrc", "main.cpp")
+    subprocess.run(["g++", "-O1", "-std=c++17", "-pthread", "-o", out, src, "-lz"], check=True)
+    return out
+
+
+@pytest.fixture
+def storage():
+    received, idf_puts, status = [], [], [200]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if status[0] == 200:
+                received.extend(json.loads(body))
+            self.send_response(status[0])
+            self.end_headers()
+
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            idf_puts.append(json.loads(body)["weights"])
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", received, idf_puts, status
+    server.shutdown()
+
+
+def make_follower(miner, log_dir, out_dir, storage_url):
+    shards = ShardStore(os.path.join(out_dir, "shards"))
+    meta_path = os.path.join(out_dir, "meta.json")
+
+    def build():
+        files = [p for p in (os.path.join(log_dir, "BGL.log.1"), os.path.join(log_dir, "BGL.log"))
+                 if os.path.exists(p)]
+        cmd = [miner, files[0], "utf-8", out_dir, "--threads", "2", "--shard-rows", "3"]
+        for p in files[1:]:
+            cmd += ["--input", p]
+        subprocess.run(cmd + ["--append"], check=True, capture_output=True)
+
+    def total_rows():
+        shards.refresh()
+        return shards.num_rows
+
+    def read_rows(start, stop):
+        b = shards.slice(start, stop)
+        tags = shards.alert_tags
+        return [{"line_id": int(lid), "alert_tag": tags[t]}
+                for lid, t in zip(b["line_id"].tolist(), b["alert_tag"].tolist())]
+
+    def build_info():
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def template_idf():
+        with open(os.path.join(out_dir, "df.json"), "r", encoding="utf-8") as f:
+            obj = json.load(f)
+        return [obj["num_docs"] / max(d, 1) for d in obj["df"]]
+
+    return Follower(build, total_rows, read_rows, build_info, storage_url,
+                    os.path.join(out_dir, "follow_checkpoint.json"), template_idf=template_idf,
+                    batch_rows=2, max_latency_ms=0, poll_interval_s=0.02)
+
+
+def write_lines(path, first, count, mode="a"):
+    with open(path, mode, encoding="utf-8") as f:
+        for i in range(first, first + count):
+            f.write(f"L{i} node kernel message {i}\n")
+    return first + count
+
+
+def wait_for(received, n, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while len(received) < n and time.monotonic() < deadline:
+        time.sleep(0.02)
+    time.sleep(0.2)     # лишние (повторные) строки тоже должны успеть прийти
+
+
+def test_rotation_keeps_every_line_once(miner, storage, tmp_path):
+    url, received, _, _ = storage
+    log_dir, out_dir = str(tmp_path / "logs"), str(tmp_path / "out")
+    os.makedirs(log_dir)
+    live = os.path.join(log_dir, "BGL.log")
+    follower = make_follower(miner, log_dir, out_dir, url)
+
+    n = write_lines(live, 0, 5)
+    follower.start()
+    wait_for(received, n)
+
+    # ротация переименованием: строки, дописанные в старый файл перед ротацией,
+    # ещё не прочитаны (слежение остановлено и продолжит с checkpoint)
+    follower.stop()
+    n = write_lines(live, n, 2)
+    os.rename(live, live + ".1")
+    n = write_lines(live, n, 3)
+    follower.start()
+    wait_for(received, n)
+
+    # copytruncate: живой файл усечён и пишется заново
+    n = write_lines(live, n, 2, mode="w")
+    wait_for(received, n)
+    follower.stop()
+
+    assert [r["line_id"] for r in received] == list(range(n))
+    assert [r["alert_tag"] for r in received] == [f"L{i}" for i in range(n)]
+    assert follower.stats["resets"] == 2
+
+
+def test_template_idf_is_pushed_after_builds(miner, storage, tmp_path):
+    url, received, idf_puts, _ = storage
+    log_dir, out_dir = str(tmp_path / "logs"), str(tmp_path / "out")
+    os.makedirs(log_dir)
+    live = os.path.join(log_dir, "BGL.log")
+    follower = make_follower(miner, log_dir, out_dir, url)
+
+    n = write_lines(live, 0, 3)
+    follower.start()
+    wait_for(received, n)
+    with open(live, "a", encoding="utf-8") as f:
+        f.write("L3 other template\n")
+    wait_for(received, n + 1)
+    follower.stop()
+
+    # веса уходят после досборок, которые их изменили; холостые опросы ничего не шлют
+    assert [len(w) for w in idf_puts] == [1, 2]
+    assert follower.stats["idf_pushes"] == 2
+
+
+def test_rejected_batch_stops_following(miner, storage, tmp_path):
+    url, received, _, status = storage
+    log_dir, out_dir = str(tmp_path / "logs"), str(tmp_path / "out")
+    os.makedirs(log_dir)
+    live = os.path.join(log_dir, "BGL.log")
+    follower = make_follower(miner, log_dir, out_dir, url)
+
+    write_lines(live, 0, 4)
+    status[0] = 422
+    follower.start()
+    deadline = time.monotonic() + 20.0
+    while follower.running and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+    # 4xx не повторяется: слежение остановлено, checkpoint не сдвинут
+    assert not follower.running
+    assert "HTTP 422" in follower.stats["last_error"]
+    assert follower.stats["retries"] == 0 and follower.stats["batches"] == 0
+    assert not received
+    assert follower.load_checkpoint()["next_line_id"] == 0
@@ -1,22 +1,61 @@
 import os
+import time
+import hashlib
+import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
 from joblib import dump, load
 
 class TFIDFStore:
+    """
+    mode=tfidf   — TfidfVectorizer, обучается один раз на всех шаблонах (tfidf.joblib).
+    mode=hashing — HashingVectorizer на n_features признаков без обучения; IDF считается
+                   онлайн по счётчикам DF, которые лежат рядом в hashing_df.npz.
+                   Уже учтённые документы отмечаются в битовой карте фиксированного
+                   размера (seen_bits бит), счётчики сохраняются не чаще раза в
+                   save_interval_s и при остановке сервиса (flush).
+    """
+
     def __init__(self, out_dir: str, tfidf_params: dict):
         self.out_dir = out_dir
         self.tfidf_path = os.path.join(out_dir, "tfidf.joblib")
+        self.df_path = os.path.join(out_dir, "hashing_df.npz")
+        self.mode = tfidf_params.get("mode", "tfidf")
         self.params = dict(
             max_features=tfidf_params.get("max_features", 20000),
             ngram_range=tuple(tfidf_params.get("ngram_range", [1, 2])),
             min_df=tfidf_params.get("min_df", 1),
             max_df=tfidf_params.get("max_df", 1.0),
         )
+        self.n_features = int(tfidf_params.get("n_features", 2 ** 20))
+        self.seen_bits = int(tfidf_params.get("seen_bits", 2 ** 26))
+        self.save_interval = float(tfidf_params.get("save_interval_s", 60.0))
         os.makedirs(out_dir, exist_ok=True)
         self.vectorizer = None
+        # онлайн-DF для hashing-режима
+        self.doc_freq = None
+        self.num_docs = 0
+        # бит на документ по хэшу; коллизия лишь пропускает документ в DF
+        self.seen = np.zeros((self.seen_bits + 7) // 8, dtype=np.uint8)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    @property
+    def dim(self) -> int:
+        if self.mode == "hashing":
+            return self.n_features
+        return len(self.vectorizer.vocabulary_)
 
     def fit_or_load(self, texts):
+        if self.mode == "hashing":
+            self.vectorizer = HashingVectorizer(
+                n_features=self.n_features, ngram_range=self.params["ngram_range"],
+                alternate_sign=False, norm=None,
+            )
+            status = self._load_counters()
+            self.observe(texts)
+            return status
         if os.path.exists(self.tfidf_path):
             self.vectorizer = load(self.tfidf_path)
             return "loaded"
@@ -26,12 +65,73 @@ class TFIDFStore:
         self.vectorizer = vec
         return "fitted"
 
+    def observe(self, texts) -> int:
+        """
+        Учитывает в DF ещё не виденные документы (hashing-режим).
+        Возвращает число новых документов; IDF меняется только если оно > 0.
+        """
+        if self.mode != "hashing":
+            return 0
+        new = []
+        for t in texts:
+            h = int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "little")
+            byte, bit = divmod(h % self.seen_bits, 8)
+            if not self.seen[byte] >> bit & 1:
+                self.seen[byte] |= 1 << bit
+                new.append(t)
+        if not new:
+            return 0
+        X = self.vectorizer.transform(new).tocsc()
+        self.doc_freq += np.diff(X.indptr)
+        self.num_docs += len(new)
+        self._dirty = True
+        self.flush(force=False)
+        return len(new)
+
+    def flush(self, force: bool = True):
+        """Сохраняет изменённые счётчики; без force — только если с прошлого сохранения прошло save_interval_s."""
+        if not self._dirty:
+            return
+        if not force and time.monotonic() - self._saved_at < self.save_interval:
+            return
+        self._save_counters()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
     def transform(self, texts):
         if self.vectorizer is None:
             raise RuntimeError("Vectorizer not initialized")
         X = self.vectorizer.transform(texts)
+        if self.mode == "hashing":
+            # та же формула, что у TfidfTransformer(smooth_idf=True) + l2-нормировка
+            idf = np.log((1.0 + self.num_docs) / (1.0 + self.doc_freq)) + 1.0
+            X = normalize(X.multiply(idf).tocsr(), norm="l2", copy=False)
         return X
 
+    def _load_counters(self) -> str:
+        if os.path.exists(self.df_path):
+            obj = np.load(self.df_path)
+            if obj["doc_freq"].shape[0] == self.n_features:
+                self.doc_freq = obj["doc_freq"].astype(np.int64)
+                self.num_docs = int(obj["num_docs"])
+                if "seen_bitmap" in obj and obj["seen_bitmap"].shape == self.seen.shape:
+                    self.seen = obj["seen_bitmap"]
+                elif "seen" in obj:
+                    # старый формат: множество хэшей -> биты
+                    pos = obj["seen"].astype(np.uint64) % np.uint64(self.seen_bits)
+                    np.bitwise_or.at(self.seen, (pos // 8).astype(np.int64),
+                                     (1 << (pos % 8)).astype(np.uint8))
+                return "loaded"
+        self.doc_freq = np.zeros(self.n_features, dtype=np.int64)
+        self.num_docs = 0
+        self.seen[:] = 0
+        return "fitted"
+
+    def _save_counters(self):
+        tmp = self.df_path + ".tmp.npz"
+        np.savez(tmp, doc_freq=self.doc_freq, num_docs=np.int64(self.num_docs), seen_bitmap=self.seen)
+        os.replace(tmp, self.df_path)
+
 def load_templates_csv(csv_path: str):
     # CSV: id,template
     df = pd.read_csv(csv_path)
@@ -41,4 +141,3 @@ def load_templates_csv(csv_path: str):
     df["id"] = df["id"].astype(int)
     df = df.sort_values("id").reset_index(drop=True)
     return df
-
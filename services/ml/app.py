@@ -1,4 +1,4 @@
-import os
+import os, json, time, uuid
 from typing import List
 
 import numpy as np
@@ -6,9 +6,13 @@ import scipy.sparse as sp
 import requests
 
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field, field_validator, ConfigDict
 from config import load_config
-from ml_core import OCSVMModel, OCSVMModelRaw
+from ml_core import OCSVMModel, ChunkScorer, ScoreMemo, make_vector_model
+from dataset import load_csr
+from jobs import TrainJobs
+from csr_io import CSRFormatError, NPZ_MEDIA, ARROW_MEDIA, csr_from_arrays, from_b64, from_npz, from_arrow
 
 
 _cfg = load_config() if os.path.exists(os.environ.get("CONFIG_PATH", "/app/configs/ml.yaml")) else {}
@@ -26,7 +30,13 @@ OCSVM_CFG = _cfg.get("ocsvm", {
     "gamma": "scale",
     "nu": 0.05,
 })
+# exact — OneClassSVM (libsvm); approx — Nystroem/RFF + SGDOneClassSVM (см. ml_core.ApproxOCSVMModel)
+ENGINE = _cfg.get("engine", "exact")
+APPROX_CFG = _cfg.get("approx", {})
+ONLINE_CFG = _cfg.get("online", {})
 MODEL_DIR = _cfg.get("model_dir", "/app/models")
+# /train_vectors/from_storage: строк на одну пачку копирования в CSR-буфер
+DATASET_CHUNK_ROWS = int(_cfg.get("dataset_chunk_rows", 10000))
 MODEL_NAME_TXT = _cfg.get("model_name", "ocsvm_text.joblib")
 
 app = FastAPI(title="ML Service (vectors-friendly)")
@@ -36,7 +46,24 @@ STORAGE_URL = os.environ.get("STORAGE_URL", "http://storage:8002")
 # Оставлена ради совместимости, нодо будет снести потом
 MODEL_TXT = OCSVMModel(TFIDF_CFG, OCSVM_CFG, MODEL_DIR, MODEL_NAME_TXT)
 
-MODEL_VEC = OCSVMModelRaw(OCSVM_CFG, MODEL_DIR, "ocsvm_raw_vectors.joblib")
+MODEL_VEC = make_vector_model(ENGINE, OCSVM_CFG, APPROX_CFG, MODEL_DIR, ONLINE_CFG)
+VEC_MODEL_NAME = "ocsvm_vectors" if ENGINE == "exact" else f"ocsvm_{ENGINE}_vectors"
+
+# /predict_vectors: большие входы считаются чанками параллельно
+SCORING_CFG = _cfg.get("scoring", {})
+MODEL_VEC.scorer = ChunkScorer(
+    workers=SCORING_CFG.get("workers", 0),
+    chunk_rows=SCORING_CFG.get("chunk_rows", 20000),
+    backend=SCORING_CFG.get("backend", "process"),
+)
+# кэш оценок по шаблону (one-hot) или хэшу строки; сбрасывается при смене модели
+MEMO_CFG = _cfg.get("score_cache", {})
+if MEMO_CFG.get("enabled", True):
+    MODEL_VEC.memo = ScoreMemo(MEMO_CFG.get("max_entries", 100000))
+
+# Очередь задач обучения: процессы, не больше max_concurrent одновременно
+JOBS_CFG = _cfg.get("jobs", {})
+JOBS_DIR = os.path.join(MODEL_DIR, "jobs")
 
 
 class SparseVector(BaseModel):
@@ -70,6 +97,22 @@ class PredictVectorsRequest(BaseModel):
     vectors: List[SparseVector]
 
 
+class DatasetDescriptor(BaseModel):
+    """Набор для обучения в storage: latest — первые n строк (после after_id), иначе /bgl/vectors/sample."""
+    model_config = ConfigDict(extra="forbid")
+    n: int = Field(50000, ge=1)
+    sample: str = Field("latest", pattern="^(latest|uniform|stratified|window)$")
+    seed: int = 0
+    per_template_cap: int | None = Field(None, ge=1)
+    last_lines: int | None = Field(None, ge=1)
+    from_line: int | None = Field(None, ge=0)
+    to_line: int | None = Field(None, ge=0)
+    after_id: int | None = Field(None, ge=0)
+    only_non_alert: bool = True
+    nnz_per_row: int = Field(1, ge=1)   # оценка для предвыделения буфера
+    dim: int | None = Field(None, ge=1)  # None — максимальная dim среди строк выборки
+
+
 def to_csr(vectors: List[SparseVector]):
     if not vectors:
         raise HTTPException(400, "vectors is empty")
@@ -82,17 +125,48 @@ def to_csr(vectors: List[SparseVector]):
             raise HTTPException(400, f"all vectors must share the same dim (got {v.dim} vs {dim} at row {i})")
         if len(v.indices) != len(v.values):
             raise HTTPException(400, f"indices/values length mismatch at row {i}")
-        for idx in v.indices:
-            if idx < 0 or idx >= dim:
-                raise HTTPException(400, f"index {idx} out of bounds [0,{dim}) at row {i}")
         indices.extend(v.indices)
         data.extend(v.values)
         indptr.append(indptr[-1] + len(v.indices))
-    X = sp.csr_matrix(
-        (np.array(data, dtype=float), np.array(indices, dtype=int), np.array(indptr, dtype=int)),
-        shape=(len(vectors), dim)
-    )
-    return X
+    # границы индексов проверяются целиком в csr_from_arrays
+    try:
+        return csr_from_arrays(np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64),
+                               np.array(data, dtype=np.float32), (len(vectors), dim))
+    except CSRFormatError as e:
+        raise HTTPException(400, str(e))
+
+
+async def read_matrix(request: Request, schema) -> sp.csr_matrix:
+    """
+    Тело /train_vectors и /predict_vectors: бинарный CSR (см. csr_io) по Content-Type
+    или JSON — {"csr": {...}} в base64, либо прежний список SparseVector.
+    """
+    ctype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    body = await request.body()
+    try:
+        if ctype == NPZ_MEDIA:
+            return from_npz(body)
+        if ctype == ARROW_MEDIA:
+            return from_arrow(body)
+        try:
+            payload = json.loads(body)
+        except ValueError as e:
+            raise HTTPException(400, f"Invalid JSON: {e}")
+        if isinstance(payload, dict) and "csr" in payload:
+            return from_b64(payload["csr"])
+    except CSRFormatError as e:
+        raise HTTPException(400, str(e))
+
+    if isinstance(payload, list):
+        payload = {"vectors": payload}
+    elif not (isinstance(payload, dict) and "vectors" in payload):
+        raise HTTPException(400, "Body must be a list of vectors or an object with 'vectors' or 'csr' key")
+
+    try:
+        req = schema(**payload)
+    except Exception as e:
+        raise HTTPException(422, f"Invalid payload for vectors: {e}")
+    return to_csr(req.vectors)
 
 
 def _register_model(name: str, version: str, path: str, notes: str = ""):
@@ -106,6 +180,26 @@ def _register_model(name: str, version: str, path: str, notes: str = ""):
         pass
 
 
+JOBS = TrainJobs(
+    ENGINE, {"ocsvm": OCSVM_CFG, "approx": APPROX_CFG, "online": ONLINE_CFG}, MODEL_DIR,
+    on_done=lambda job: _register_model(VEC_MODEL_NAME, job.result["version"], job.result["path"], job.notes),
+    max_concurrent=JOBS_CFG.get("max_concurrent", 1),
+    max_queued=JOBS_CFG.get("max_queued", 16),
+    keep_finished=JOBS_CFG.get("keep_finished", 100),
+)
+
+
+
+@app.on_event("startup")
+def warm_up():
+    # модели читаются с диска при старте, а не первым запросом
+    for model in (MODEL_TXT, MODEL_VEC):
+        try:
+            model.ensure_loaded()
+            model.warm_up()
+        except Exception:
+            pass
+
 
 @app.get("/health")
 def health():
@@ -116,14 +210,32 @@ def health():
 def summary():
     exists_txt = os.path.exists(MODEL_TXT.model_path)
     exists_vec = os.path.exists(MODEL_VEC.model_path)
+    if exists_vec:
+        # версия — у модели на диске, даже если её ещё не запрашивали
+        try:
+            MODEL_VEC.ensure_loaded()
+        except Exception:
+            pass
     return {
         "text_model_path": MODEL_TXT.model_path,
         "text_exists": exists_txt,
         "vec_model_path": MODEL_VEC.model_path,
         "vec_exists": exists_vec,
+        "vec_engine": ENGINE,
+        "vec_model_name": VEC_MODEL_NAME,
+        "vec_model_version": MODEL_VEC.model_version,
+        "resident": {"text": MODEL_TXT.cache_info(), "vectors": MODEL_VEC.cache_info()},
+        "score_cache": MODEL_VEC.memo.stats() if MODEL_VEC.memo else None,
     }
 
 
+@app.get("/score_cache")
+def score_cache():
+    if MODEL_VEC.memo is None:
+        return {"enabled": False}
+    return {"enabled": True, **MODEL_VEC.memo.stats()}
+
+
 # ТЕКСТЫ (совместимость)
 class TrainText(BaseModel):
     texts: List[str]
@@ -137,10 +249,10 @@ class PredictText(BaseModel):
 def train_text(req: TrainText):
     if not req.texts:
         raise HTTPException(400, "texts is empty")
-    stats = MODEL_TXT.fit(req.texts)
-    path = MODEL_TXT.save()
-    _register_model("ocsvm_tfidf", "v1", path, "trained on texts")
-    return {"status": "trained", "path": path, "stats": stats}
+    state, stats = MODEL_TXT.fit(req.texts)
+    path = MODEL_TXT.save(state)
+    _register_model("ocsvm_tfidf", state["version"], path, "trained on texts")
+    return {"status": "trained", "path": path, "model_version": state["version"], "stats": stats}
 
 
 @app.post("/predict")
@@ -148,7 +260,7 @@ def predict_text(req: PredictText):
     if not req.texts:
         raise HTTPException(400, "texts is empty")
     try:
-        MODEL_TXT.load()
+        MODEL_TXT.ensure_loaded()
     except Exception:
         raise HTTPException(400, "model (text) not trained yet")
     labels, scores = MODEL_TXT.predict(req.texts)
@@ -158,55 +270,126 @@ def predict_text(req: PredictText):
 # ВЕКТОРА
 @app.post("/train_vectors")
 async def train_vectors(request: Request):
+    X = await read_matrix(request, TrainVectorsRequest)
+    # обучение в пуле потоков: event loop продолжает обслуживать предсказания
+    return await run_in_threadpool(train_matrix, X, f"trained on sparse vectors ({ENGINE})")
+
+
+def train_matrix(X, notes: str) -> dict:
+    state, stats = MODEL_VEC.fit(X)
+    path = MODEL_VEC.save(state)
+    _register_model(VEC_MODEL_NAME, state["version"], path, notes)
+    return {"status": "trained", "path": path, "model": VEC_MODEL_NAME, "model_version": state["version"],
+            "stats": stats}
+
+
+@app.post("/train_vectors/from_storage")
+def train_vectors_from_storage(desc: DatasetDescriptor):
+    """
+    Обучение на наборе из storage по описанию: строки читаются потоком прямо
+    из storage в CSR-буфер (dataset.load_csr), без пересылки через web.
+    """
+    t0 = time.time()
     try:
-        body = await request.json()
-    except Exception as e:
-        raise HTTPException(400, f"Invalid JSON: {e}")
-
-    if isinstance(body, list):
-        payload = {"vectors": body}
-    elif isinstance(body, dict) and "vectors" in body:
-        payload = body
-    else:
-        raise HTTPException(400, "Body must be a list of vectors or an object with 'vectors' key")
-
-    try:
-        req = TrainVectorsRequest(**payload)
-    except Exception as e:
-        raise HTTPException(422, f"Invalid payload for vectors: {e}")
-
-    X = to_csr(req.vectors)
-    stats = MODEL_VEC.fit(X)
-    path = MODEL_VEC.save()
-    _register_model("ocsvm_vectors", "v1", path, "trained on sparse vectors")
-    return {"status": "trained", "path": path, "stats": stats}
+        X = load_csr(STORAGE_URL, desc.model_dump(), DATASET_CHUNK_ROWS)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except requests.RequestException as e:
+        raise HTTPException(502, f"storage: {e}")
+    load_sec = time.time() - t0
+    out = train_matrix(X, f"trained on storage dataset {desc.sample}, n={X.shape[0]} ({ENGINE})")
+    out["dataset"] = {"rows": int(X.shape[0]), "dim": int(X.shape[1]), "nnz": int(X.nnz),
+                      "load_sec": round(load_sec, 3)}
+    return out
 
 
 @app.post("/predict_vectors")
 async def predict_vectors(request: Request):
+    X = await read_matrix(request, PredictVectorsRequest)
     try:
-        body = await request.json()
-    except Exception as e:
-        raise HTTPException(400, f"Invalid JSON: {e}")
-
-    if isinstance(body, list):
-        payload = {"vectors": body}
-    elif isinstance(body, dict) and "vectors" in body:
-        payload = body
-    else:
-        raise HTTPException(400, "Body must be a list of vectors or an object with 'vectors' key")
-
-    try:
-        req = PredictVectorsRequest(**payload)
-    except Exception as e:
-        raise HTTPException(422, f"Invalid payload for vectors: {e}")
-
-    try:
-        MODEL_VEC.load()
+        MODEL_VEC.ensure_loaded()
     except Exception:
         raise HTTPException(400, "model (vectors) not trained yet")
 
-    X = to_csr(req.vectors)
-    labels, scores = MODEL_VEC.predict(X)
-    return {"labels": labels, "scores": scores}
+    # версия — та, под которой web сохранит оценки в storage
+    version = MODEL_VEC.model_version
+    labels, scores = await run_in_threadpool(MODEL_VEC.predict, X)
+    return {"labels": labels, "scores": scores, "model": VEC_MODEL_NAME, "model_version": version}
+
+
+@app.post("/update_vectors")
+async def update_vectors(request: Request):
+    """
+    Дообучение онлайн-модели (engine: online) батчем новых нормальных строк —
+    тело в тех же форматах, что у /train_vectors. Модель обновляется чанками
+    и сохраняется атомарно; без обученной модели батч становится первым обучением.
+    """
+    if not hasattr(MODEL_VEC, "update"):
+        raise HTTPException(400, f"engine {ENGINE!r} does not support incremental updates, use engine: online")
+    X = await read_matrix(request, TrainVectorsRequest)
+    try:
+        stats = await run_in_threadpool(MODEL_VEC.update, X)
+    except ValueError as e:
+        raise HTTPException(409, str(e))
+    n_seen = stats.get("n_seen", stats["n_samples"])
+    version = stats["model_version"]
+    _register_model(VEC_MODEL_NAME, version, stats["path"], f"online update, n_seen={n_seen}")
+    return {"status": "updated", "model": VEC_MODEL_NAME, **stats}
 
+
+# ЗАДАЧИ ОБУЧЕНИЯ
+def _submit(kind: str, source: dict, notes: str) -> dict:
+    try:
+        job = JOBS.submit(kind, source, notes)
+    except OverflowError as e:
+        if source.get("npz_path"):
+            os.remove(source["npz_path"])
+        raise HTTPException(429, str(e))
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.post("/jobs/train")
+def submit_train_job(desc: DatasetDescriptor):
+    """Обучение на наборе из storage в фоновом процессе; ответ — id задачи."""
+    source = {"storage_url": STORAGE_URL, "desc": desc.model_dump(), "chunk_rows": DATASET_CHUNK_ROWS}
+    return _submit("storage", source, f"job: storage dataset {desc.sample}, n={desc.n} ({ENGINE})")
+
+
+@app.post("/jobs/train_vectors")
+async def submit_train_vectors_job(request: Request):
+    """То же для тела в форматах /train_vectors: матрица передаётся процессу через npz-файл."""
+    X = await read_matrix(request, TrainVectorsRequest)
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    path = os.path.join(JOBS_DIR, f"{uuid.uuid4().hex}.npz")
+    await run_in_threadpool(sp.save_npz, path, X, False)
+    return _submit("body", {"npz_path": path, "rows": int(X.shape[0])},
+                   f"job: sparse vectors, n={X.shape[0]} ({ENGINE})")
+
+
+@app.get("/jobs")
+def list_jobs():
+    return JOBS.list()
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(404, "job not found")
+    return job.info()
+
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = JOBS.cancel(job_id)
+    if job is None:
+        raise HTTPException(404, "job not found")
+    return job.info()
+
+
+@app.on_event("shutdown")
+def stop_jobs():
+    for info in JOBS.list():
+        if info["status"] in ("queued", "running"):
+            JOBS.cancel(info["id"])
+    MODEL_VEC.scorer.close()
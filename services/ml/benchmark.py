@@ -0,0 +1,75 @@
+"""
+Сравнение движков на данных storage: время обучения, время предсказания и AUPRC
+(положительный класс — is_alert, чем меньше score, тем аномальнее). Обучение — на
+non-alert выборке /bgl/vectors/sample, оценка — на первых --test строках с метками:
+
+    python benchmark.py --storage http://storage:8002 --train 50000 --test 20000
+
+Параметры моделей берутся из configs/ml.yaml (секции ocsvm и approx).
+"""
+import argparse, json, os, tempfile, time
+import numpy as np
+import requests
+from sklearn.metrics import average_precision_score
+from config import load_config
+from csr_io import csr_from_arrays
+from ml_core import make_vector_model
+
+
+def fetch(url: str, params: dict):
+    """NDJSON storage -> (CSR, is_alert)."""
+    indptr, indices, data, labels, dim = [0], [], [], [], 0
+    with requests.get(url, params={**params, "format": "ndjson"}, stream=True, timeout=7200) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line:
+                continue
+            row = json.loads(line)
+            # словарь шаблонов растёт с логом: матрица по максимальной dim, как dataset.load_csr
+            dim = max(dim, int(row["dim"]))
+            indices.extend(row["indices"])
+            data.extend(row["values"])
+            indptr.append(len(indices))
+            labels.append(bool(row["is_alert"]))
+    if not labels:
+        raise SystemExit(f"no rows from {url}")
+    X = csr_from_arrays(np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64),
+                        np.array(data, dtype=np.float32), (len(labels), dim))
+    return X, np.array(labels)
+
+def main():
+    ap = argparse.ArgumentParser(description="OCSVM engines benchmark")
+    ap.add_argument("--storage", default=os.environ.get("STORAGE_URL", "http://localhost:8002"))
+    ap.add_argument("--train", type=int, default=50000)
+    ap.add_argument("--test", type=int, default=20000)
+    ap.add_argument("--sample", default="uniform", help="mode /bgl/vectors/sample")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--engines", default="exact,approx")
+    args = ap.parse_args()
+
+    cfg = load_config() if os.path.exists(os.environ.get("CONFIG_PATH", "/app/configs/ml.yaml")) else {}
+    X_train, _ = fetch(f"{args.storage}/bgl/vectors/sample",
+                       {"n": args.train, "mode": args.sample, "seed": args.seed, "only_non_alert": True})
+    X_test, y_test = fetch(f"{args.storage}/bgl/vectors", {"limit": args.test, "only_non_alert": False})
+    if X_test.shape[1] != X_train.shape[1]:
+        # словарь шаблонов мог вырасти между строками: приводим к dim обучающей выборки
+        X_test.resize(X_test.shape[0], X_train.shape[1])
+    print(f"train {X_train.shape}, test {X_test.shape}, alerts {int(y_test.sum())}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in args.engines.split(","):
+            model = make_vector_model(engine, cfg.get("ocsvm", {}), cfg.get("approx", {}), tmp)
+            state, stats = model.fit(X_train)
+            model.save(state)
+            t0 = time.time()
+            _, scores = model.predict(X_test)
+            predict_sec = time.time() - t0
+            auprc = average_precision_score(y_test, -np.asarray(scores)) if y_test.any() else None
+            print(json.dumps({"engine": engine, "fit_sec": round(stats["train_time_sec"], 3),
+                              "predict_sec": round(predict_sec, 3),
+                              "rows_per_sec": int(X_test.shape[0] / max(predict_sec, 1e-9)),
+                              "auprc": None if auprc is None else round(float(auprc), 4)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Бинарные форматы входа для /train_vectors и /predict_vectors — вместо списка
+SparseVector из JSON. Массивы разбираются и проверяются целиком средствами NumPy,
+матрица собирается без копирования в int32/float32:
+
+  application/json                     {"csr": {"shape": [n, dim], "indptr": b64,
+                                                "indices": b64, "data": b64}}
+                                       (little-endian int32 / int32 / float32)
+  application/x-npz                    файл scipy.sparse.save_npz (формат csr)
+  application/vnd.apache.arrow.stream  схема /collect_vectors?format=arrow коллектора
+                                       (dim, indices list<int32>, values list<float32>)
+"""
+import io, base64
+import numpy as np
+import scipy.sparse as sp
+
+NPZ_MEDIA = "application/x-npz"
+ARROW_MEDIA = "application/vnd.apache.arrow.stream"
+
+
+class CSRFormatError(ValueError):
+    pass
+
+
+def csr_from_arrays(indptr, indices, data, shape) -> sp.csr_matrix:
+    try:
+        n, dim = (int(x) for x in shape)
+    except (TypeError, ValueError):
+        raise CSRFormatError("shape must be [n_rows, dim]")
+    indptr = np.asarray(indptr)
+    indices = np.asarray(indices)
+    data = np.asarray(data)
+    if n < 1 or dim < 1:
+        raise CSRFormatError(f"empty matrix shape {(n, dim)}")
+    if indptr.ndim != 1 or indptr.shape[0] != n + 1:
+        raise CSRFormatError(f"indptr must have n_rows+1={n + 1} elements, got {indptr.shape[0]}")
+    if indices.ndim != 1 or data.ndim != 1 or indices.shape[0] != data.shape[0]:
+        raise CSRFormatError("indices/data length mismatch")
+    if not (np.issubdtype(indptr.dtype, np.integer) and np.issubdtype(indices.dtype, np.integer)):
+        raise CSRFormatError("indptr/indices must be integer arrays")
+    if indptr[0] != 0 or indptr[-1] != indices.shape[0]:
+        raise CSRFormatError("indptr must start at 0 and end at len(indices)")
+    if (np.diff(indptr) < 0).any():
+        raise CSRFormatError("indptr must be non-decreasing")
+    if indices.size:
+        bad = (indices < 0) | (indices >= dim)
+        if bad.any():
+            pos = int(np.argmax(bad))
+            row = int(np.searchsorted(indptr, pos, side="right")) - 1
+            raise CSRFormatError(f"index {int(indices[pos])} out of bounds [0,{dim}) at row {row}")
+    data = data.astype(np.float32, copy=False)
+    if not np.isfinite(data).all():
+        raise CSRFormatError("values contain non-finite numbers")
+    return sp.csr_matrix((data, indices.astype(np.int32, copy=False), indptr.astype(np.int32, copy=False)),
+                         shape=(n, dim), copy=False)
+
+
+def _b64(value, dtype) -> np.ndarray:
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (TypeError, ValueError) as e:
+        raise CSRFormatError(f"bad base64: {e}")
+    if len(raw) % np.dtype(dtype).itemsize:
+        raise CSRFormatError(f"base64 payload is not a whole number of {np.dtype(dtype).name}")
+    return np.frombuffer(raw, dtype=dtype)
+
+def from_b64(csr: dict) -> sp.csr_matrix:
+    try:
+        return csr_from_arrays(_b64(csr["indptr"], "<i4"), _b64(csr["indices"], "<i4"),
+                               _b64(csr["data"], "<f4"), csr["shape"])
+    except (KeyError, TypeError) as e:
+        raise CSRFormatError(f"csr must contain shape, indptr, indices, data: {e}")
+
+def from_npz(body: bytes) -> sp.csr_matrix:
+    try:
+        with np.load(io.BytesIO(body), allow_pickle=False) as f:
+            fmt = f["format"].item() if "format" in f else b"csr"
+            if (fmt.decode() if isinstance(fmt, bytes) else fmt) != "csr":
+                raise CSRFormatError(f"npz must hold a csr matrix, got {fmt!r}")
+            return csr_from_arrays(f["indptr"], f["indices"], f["data"], f["shape"])
+    except (OSError, KeyError, ValueError) as e:
+        if isinstance(e, CSRFormatError):
+            raise
+        raise CSRFormatError(f"bad npz: {e}")
+
+def from_arrow(body: bytes) -> sp.csr_matrix:
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise CSRFormatError("pyarrow is not installed, Arrow bodies are not supported")
+    try:
+        table = pa.ipc.open_stream(body).read_all().combine_chunks()
+    except pa.ArrowInvalid as e:
+        raise CSRFormatError(f"bad Arrow stream: {e}")
+    if table.num_rows == 0:
+        raise CSRFormatError("vectors is empty")
+    dims = table.column("dim").to_numpy()
+    if (dims != dims[0]).any():
+        raise CSRFormatError("all vectors must share the same dim")
+    ind, val = table.column("indices").chunk(0), table.column("values").chunk(0)
+    offsets = ind.offsets.to_numpy()
+    if not np.array_equal(offsets, val.offsets.to_numpy()):
+        raise CSRFormatError("indices/values length mismatch")
+    # offsets списка могут не начинаться с 0 (срез батча) — сдвигаем вместе с данными
+    lo, hi = int(offsets[0]), int(offsets[-1])
+    return csr_from_arrays(offsets - lo, ind.values.to_numpy()[lo:hi],
+                           val.values.to_numpy(zero_copy_only=False)[lo:hi], (table.num_rows, int(dims[0])))
@@ -0,0 +1,106 @@
+"""
+Обучающая выборка напрямую из storage: ML получает только описание набора
+(фильтры, режим выборки, диапазон id/строк), сам читает NDJSON из серверного
+курсора storage и складывает строки в заранее выделенный CSR-буфер int32/float32.
+Данные не проходят через web и не превращаются в списки Python-объектов.
+"""
+import json
+import numpy as np
+import requests
+import scipy.sparse as sp
+
+from csr_io import csr_from_arrays
+
+
+def storage_request(storage_url: str, desc: dict) -> tuple[str, dict]:
+    """Описание набора -> (url, params) для GET /bgl/vectors или /bgl/vectors/sample."""
+    storage_url = storage_url.rstrip("/")
+    n = int(desc["n"])
+    only_non_alert = desc.get("only_non_alert", True)
+    if desc.get("sample", "latest") == "latest":
+        params = {"limit": n, "offset": 0, "only_non_alert": only_non_alert, "format": "ndjson"}
+        if desc.get("after_id") is not None:
+            params["after_id"] = desc["after_id"]
+        return f"{storage_url}/bgl/vectors", params
+    params = {"n": n, "mode": desc["sample"], "seed": desc.get("seed", 0),
+              "only_non_alert": only_non_alert, "format": "ndjson"}
+    for key in ("per_template_cap", "last_lines", "from_line", "to_line"):
+        if desc.get(key) is not None:
+            params[key] = desc[key]
+    return f"{storage_url}/bgl/vectors/sample", params
+
+
+class CSRBuffer:
+    """
+    CSR с заранее выделенными массивами: indptr — ровно на n строк, indices/data —
+    на n * nnz_per_row (для one-hot векторов шаблонов этого хватает без роста;
+    иначе ёмкость удваивается). Строки копируются в буфер пачками по chunk_rows.
+    """
+
+    def __init__(self, max_rows: int, nnz_per_row: int = 1):
+        self.indptr = np.zeros(max_rows + 1, dtype=np.int32)
+        self.indices = np.empty(max(max_rows * nnz_per_row, 1), dtype=np.int32)
+        self.data = np.empty(self.indices.shape[0], dtype=np.float32)
+        self.rows = 0
+        self.nnz = 0
+        self.dim = None
+
+    def _reserve(self, nnz: int):
+        if nnz <= self.indices.shape[0]:
+            return
+        cap = max(nnz, 2 * self.indices.shape[0])
+        self.indices = np.resize(self.indices, cap)
+        self.data = np.resize(self.data, cap)
+
+    def extend(self, lengths: list[int], indices: list[int], values: list[float]):
+        if self.rows + len(lengths) > self.indptr.shape[0] - 1:
+            raise ValueError("storage returned more rows than requested")
+        end = self.nnz + len(indices)
+        self._reserve(end)
+        self.indices[self.nnz:end] = indices
+        self.data[self.nnz:end] = values
+        self.indptr[self.rows + 1:self.rows + 1 + len(lengths)] = self.nnz + np.cumsum(lengths)
+        self.rows += len(lengths)
+        self.nnz = end
+
+    def matrix(self) -> sp.csr_matrix:
+        if self.rows == 0:
+            raise ValueError("dataset is empty")
+        indices, data = self.indices[:self.nnz], self.data[:self.nnz]
+        if self.nnz < self.indices.shape[0] // 2:
+            # не держим удвоенный буфер на всё время обучения
+            indices, data = indices.copy(), data.copy()
+        return csr_from_arrays(self.indptr[:self.rows + 1], indices, data, (self.rows, self.dim))
+
+
+def load_csr(storage_url: str, desc: dict, chunk_rows: int = 10000, timeout: float = 7200) -> sp.csr_matrix:
+    """
+    Словарь шаблонов растёт вместе с логом, поэтому у строк выборки разная dim:
+    матрица собирается по максимальной dim (старые строки дополняются нулями),
+    desc["dim"] задаёт размерность явно — лишние столбцы отбрасываются.
+    """
+    url, params = storage_request(storage_url, desc)
+    buf = CSRBuffer(int(desc["n"]), int(desc.get("nnz_per_row", 1)))
+    buf.dim = 0
+    lengths, indices, values = [], [], []
+    with requests.get(url, params=params, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        for line in r.iter_lines(chunk_size=1 << 16):
+            if not line:
+                continue
+            row = json.loads(line)
+            buf.dim = max(buf.dim, int(row["dim"]))
+            if len(row["indices"]) != len(row["values"]):
+                raise ValueError(f"indices/values length mismatch at line_id {row.get('line_id')}")
+            lengths.append(len(row["indices"]))
+            indices.extend(row["indices"])
+            values.extend(row["values"])
+            if len(lengths) >= chunk_rows:
+                buf.extend(lengths, indices, values)
+                lengths, indices, values = [], [], []
+    if lengths:
+        buf.extend(lengths, indices, values)
+    X = buf.matrix()
+    if desc.get("dim") and int(desc["dim"]) != X.shape[1]:
+        X.resize(X.shape[0], int(desc["dim"]))
+    return X
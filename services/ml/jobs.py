@@ -0,0 +1,166 @@
+"""
+Очередь задач обучения. Каждая задача — отдельный процесс (spawn), одновременно
+работают не больше max_concurrent, остальные ждут в очереди; сервис при этом
+продолжает отвечать на /predict_vectors. Процесс сам читает данные (описание набора
+из storage или npz-файл тела запроса), обучает модель и атомарно сохраняет
+артефакт — резидентная модель сервиса подхватит его через ensure_loaded().
+Прогресс и результат приходят по multiprocessing.Queue; отмена снимает задачу
+из очереди или завершает процесс.
+"""
+import os, time, uuid, queue, threading
+import multiprocessing as mp
+from typing import Any, Callable, Dict
+
+_CTX = mp.get_context("spawn")
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+def _train_worker(out, engine: str, params: Dict[str, Any], model_dir: str, source: Dict[str, Any]):
+    # выполняется в дочернем процессе: только ml_core/dataset, без FastAPI-приложения
+    try:
+        import scipy.sparse as sp
+        from ml_core import make_vector_model
+        from dataset import load_csr
+
+        out.put(("progress", "loading", 0.05))
+        if source.get("npz_path"):
+            X = sp.load_npz(source["npz_path"]).tocsr()
+        else:
+            X = load_csr(source["storage_url"], source["desc"], source.get("chunk_rows", 10000))
+        out.put(("progress", "fitting", 0.3))
+        model = make_vector_model(engine, params.get("ocsvm", {}), params.get("approx", {}), model_dir,
+                                  params.get("online", {}))
+        state, stats = model.fit(X)
+        out.put(("progress", "saving", 0.9))
+        path = model.save(state)
+        out.put(("result", {"path": path, "version": state["version"], "stats": stats,
+                            "dataset": {"rows": int(X.shape[0]), "dim": int(X.shape[1]), "nnz": int(X.nnz)}}))
+    except BaseException as e:
+        out.put(("error", f"{type(e).__name__}: {e}"))
+
+
+class Job:
+    def __init__(self, kind: str, source: Dict[str, Any], notes: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.source = source
+        self.notes = notes
+        self.status = QUEUED
+        self.stage = None
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel = threading.Event()
+        self.process = None
+
+    def info(self) -> Dict[str, Any]:
+        src = {k: v for k, v in self.source.items() if k != "npz_path"}
+        return {"id": self.id, "kind": self.kind, "status": self.status, "stage": self.stage,
+                "progress": round(self.progress, 3), "cancel_requested": self.cancel.is_set(),
+                "source": src, "result": self.result, "error": self.error,
+                "created": self.created, "started": self.started, "finished": self.finished}
+
+
+class TrainJobs:
+    def __init__(self, engine: str, params: Dict[str, Any], model_dir: str,
+                 on_done: Callable[[Job], None], max_concurrent: int = 1, max_queued: int = 16,
+                 keep_finished: int = 100):
+        self.engine = engine
+        self.params = params
+        self.model_dir = model_dir
+        self.on_done = on_done
+        self.slots = threading.BoundedSemaphore(max(int(max_concurrent), 1))
+        self.max_concurrent = max(int(max_concurrent), 1)
+        self.max_queued = max(int(max_queued), 1)
+        self.keep_finished = max(int(keep_finished), 1)
+        self.jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def _active(self) -> int:
+        return sum(j.status in (QUEUED, RUNNING) for j in self.jobs.values())
+
+    def submit(self, kind: str, source: Dict[str, Any], notes: str = "") -> Job:
+        with self._lock:
+            if self._active() >= self.max_concurrent + self.max_queued:
+                raise OverflowError("training queue is full")
+            job = Job(kind, source, notes)
+            self.jobs[job.id] = job
+            self._prune()
+        threading.Thread(target=self._run, args=(job,), name=f"job-{job.id}", daemon=True).start()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def list(self) -> list[Dict[str, Any]]:
+        return [j.info() for j in sorted(self.jobs.values(), key=lambda j: j.created, reverse=True)]
+
+    def cancel(self, job_id: str) -> Job | None:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job.cancel.set()
+        proc = job.process
+        if proc is not None and proc.is_alive():
+            proc.terminate()
+        return job
+
+    def _prune(self):
+        done = [j for j in self.jobs.values() if j.status not in (QUEUED, RUNNING)]
+        for j in sorted(done, key=lambda j: j.created)[:max(len(done) - self.keep_finished, 0)]:
+            del self.jobs[j.id]
+
+    def _finish(self, job: Job, status: str, error: str | None = None):
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        npz = job.source.get("npz_path")
+        if npz and os.path.exists(npz):
+            os.remove(npz)
+
+    def _run(self, job: Job):
+        # ожидание слота; отмена снимает задачу из очереди
+        while not self.slots.acquire(timeout=0.5):
+            if job.cancel.is_set():
+                return self._finish(job, CANCELLED)
+        try:
+            if job.cancel.is_set():
+                return self._finish(job, CANCELLED)
+            job.status, job.started = RUNNING, time.time()
+            try:
+                out = _CTX.Queue()
+                job.process = _CTX.Process(target=_train_worker, name=f"train-{job.id}", daemon=True,
+                                           args=(out, self.engine, self.params, self.model_dir, job.source))
+                job.process.start()
+            except Exception as e:
+                # процесс не создан (нет памяти/дескрипторов): задача не должна висеть в RUNNING
+                job.process = None
+                return self._finish(job, FAILED, f"failed to start worker: {e}")
+            result, error = None, None
+            while True:
+                try:
+                    msg = out.get(timeout=0.5)
+                except queue.Empty:
+                    if not job.process.is_alive():
+                        break
+                    continue
+                if msg[0] == "progress":
+                    job.stage, job.progress = msg[1], msg[2]
+                elif msg[0] == "result":
+                    result = msg[1]
+                else:
+                    error = msg[1]
+            job.process.join()
+            if job.cancel.is_set() and result is None:
+                return self._finish(job, CANCELLED)
+            if result is None:
+                return self._finish(job, FAILED, error or f"worker exited with code {job.process.exitcode}")
+            job.result, job.stage, job.progress = result, "done", 1.0
+            self._finish(job, DONE)
+            self.on_done(job)
+        finally:
+            self.slots.release()
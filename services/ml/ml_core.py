@@ -1,13 +1,251 @@
 import os
+import copy
 import time
+import hashlib
+import uuid
+import threading
+import multiprocessing as mp
 import joblib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from itertools import repeat
 from typing import Any, Dict, List, Tuple
 
+from sklearn.base import clone
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.kernel_approximation import Nystroem, RBFSampler
+from sklearn.linear_model import SGDOneClassSVM
+from sklearn.pipeline import Pipeline
 from sklearn.svm import OneClassSVM
 
 
-class OCSVMModel:
+class ResidentArtifact:
+    """
+    Модель держится в памяти между запросами. ensure_loaded() сверяет артефакт на диске
+    по (inode, mtime, size) и перечитывает его только при изменении; новая модель
+    собирается целиком и подменяется одним присваиванием self.state, поэтому запросы,
+    начатые на старой модели, на ней и заканчиваются. save() пишет через временный
+    файл и os.replace — загрузка не увидит недописанный артефакт.
+
+    fit() не трогает объект модели: обученное состояние возвращается вызывающему
+    и явно передаётся в save(state), поэтому параллельные обучения на одном
+    экземпляре не сохраняют чужую модель.
+
+    Каждое сохранение записывает в состояние свою model_version: под ней оценки
+    модели хранятся в storage, после переобучения старые оценки не затираются.
+    """
+
+    def _init_resident(self, model_dir: str, model_name: str):
+        self.model_dir = model_dir
+        os.makedirs(self.model_dir, exist_ok=True)
+        self.model_path = os.path.join(self.model_dir, model_name)
+        self.state: Dict[str, Any] | None = None   # содержимое артефакта
+        self.loaded_key = None
+        self.version = 0                           # растёт при каждой подмене модели
+        self._load_lock = threading.Lock()
+
+    def _artifact_key(self, path: str | None = None):
+        st = os.stat(path or self.model_path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _swap(self, state: Dict[str, Any], key=None):
+        self.state = state
+        self.loaded_key = key
+        self.version += 1
+
+    def ensure_loaded(self) -> bool:
+        """True, если модель была (пере)загружена с диска."""
+        key = self._artifact_key()
+        if key == self.loaded_key:
+            return False
+        with self._load_lock:
+            key = self._artifact_key()
+            if key == self.loaded_key:
+                return False
+            self._swap(joblib.load(self.model_path), key)
+            return True
+
+    def load(self) -> bool:
+        self.ensure_loaded()
+        return True
+
+    def _dump(self, state: Dict[str, Any], base: Dict[str, Any] | None = None) -> str:
+        """
+        base — состояние, от которого посчитан state (дообучение): если резидентную
+        модель успели подменить, сохранение отменяется, а не затирает новую модель.
+        """
+        state["version"] = time.strftime("%Y%m%d-%H%M%S", time.gmtime()) + "-" + uuid.uuid4().hex[:6]
+        # своё имя временного файла у каждого процесса: задачи обучения пишут параллельно
+        tmp = f"{self.model_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        joblib.dump(state, tmp)
+        # rename сохраняет inode/mtime/size: ключ берётся у своего файла, а не у того,
+        # что мог положить другой процесс сразу после замены
+        key = self._artifact_key(tmp)
+        with self._load_lock:
+            if base is not None and (self.state is not base or self._artifact_key() != self.loaded_key):
+                os.remove(tmp)
+                raise ValueError("model was replaced during the update, resend the batch")
+            os.replace(tmp, self.model_path)
+            self._swap(state, key)
+        return self.model_path
+
+    @property
+    def model_version(self) -> str | None:
+        """Версия резидентного артефакта; у артефактов без неё — по mtime файла."""
+        state, key = self.state, self.loaded_key
+        if state is None:
+            return None
+        return state.get("version") or (f"mtime-{key[1]}" if key else None)
+
+    def cache_info(self) -> Dict[str, Any]:
+        return {"path": self.model_path, "loaded": self.state is not None, "version": self.version,
+                "model_version": self.model_version,
+                "mtime_ns": self.loaded_key[1] if self.loaded_key else None,
+                "size": self.loaded_key[2] if self.loaded_key else None}
+
+
+# модель в процессе-воркере ChunkScorer: path -> (ключ артефакта, модель)
+_WORKER_MODELS: Dict[str, Any] = {}
+
+def _score_chunk(path: str, key, X) -> np.ndarray:
+    cached = _WORKER_MODELS.get(path)
+    if cached is None or cached[0] != key:
+        cached = _WORKER_MODELS[path] = (key, joblib.load(path)["model"])
+    return cached[1].decision_function(X)
+
+
+class ChunkScorer:
+    """
+    decision_function по чанкам из chunk_rows строк в workers потоках (thread) или
+    процессах (process — для libsvm; процесс грузит артефакт один раз и перечитывает
+    его при смене ключа). Входы не больше одного чанка считаются на месте.
+    """
+
+    def __init__(self, workers: int = 0, chunk_rows: int = 20000, backend: str = "process"):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"unknown scoring backend {backend!r}, expected thread|process")
+        self.workers = int(workers) or os.cpu_count() or 1
+        self.chunk_rows = max(int(chunk_rows), 1)
+        self.backend = backend
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                if self.backend == "process":
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=mp.get_context("spawn"))
+                else:
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="score")
+            return self._pool
+
+    def decision(self, model, path: str, key, X) -> np.ndarray:
+        n, step = X.shape[0], self.chunk_rows
+        if self.workers <= 1 or n <= step:
+            return model.decision_function(X)
+        chunks = (X[lo:lo + step] for lo in range(0, n, step))
+        if self.backend == "process":
+            parts = self._executor().map(_score_chunk, repeat(path), repeat(key), chunks)
+        else:
+            parts = self._executor().map(model.decision_function, chunks)
+        return np.concatenate(list(parts))
+
+    def warm_up(self, path: str, key, n_features: int):
+        # процессы пула стартуют и загружают модель заранее, а не первым большим запросом
+        if self.backend == "process" and self.workers > 1:
+            import scipy.sparse as sp
+            probe = sp.csr_matrix((1, n_features))
+            list(self._executor().map(_score_chunk, repeat(path, self.workers), repeat(key, self.workers),
+                                      repeat(probe, self.workers)))
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+class ScoreMemo:
+    """
+    LRU-кэш оценок по содержимому строки. Вектор шаблона one-hot (indices=[template_id],
+    values=[idf]), поэтому его оценка зависит только от пары (индекс, значение) —
+    она и есть ключ, упакованный в int64; прочие строки ключуются хэшем
+    indices+values. Ядро считается только для различных строк, которых нет в кэше,
+    т.е. O(числа шаблонов), а не O(числа событий). Кэш привязан к версии модели
+    и размерности входа и сбрасывается при смене любой из них.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max(int(max_entries), 1)
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = None
+        self.dim = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @staticmethod
+    def row_keys(X) -> np.ndarray:
+        nnz = np.diff(X.indptr)
+        keys = np.empty(X.shape[0], dtype=np.int64)
+        one = nnz == 1
+        pos = X.indptr[:-1][one]
+        # one-hot: индекс в старших 32 битах, биты float32-значения в младших (ключ >= 0)
+        keys[one] = (X.indices[pos].astype(np.int64) << 32) | \
+            X.data[pos].astype(np.float32).view(np.uint32).astype(np.int64)
+        for i in np.flatnonzero(~one):
+            lo, hi = X.indptr[i], X.indptr[i + 1]
+            h = hashlib.blake2b(X.indices[lo:hi].astype(np.int32).tobytes() +
+                                X.data[lo:hi].astype(np.float32).tobytes(), digest_size=8).digest()
+            # прочие строки — отрицательные ключи, с one-hot не пересекаются
+            keys[i] = -1 - (int.from_bytes(h, "little") >> 1)
+        return keys
+
+    def decision(self, version: int, X, score) -> np.ndarray:
+        keys = self.row_keys(X)
+        dim = int(X.shape[1])
+        uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        values = np.empty(uniq.shape[0], dtype=np.float64)
+        miss = []
+        with self._lock:
+            # ключ строки не содержит размерность: оценки другой ширины входа не переиспользуются
+            if version != self.version or dim != self.dim:
+                if self._cache:
+                    self.invalidations += 1
+                self._cache.clear()
+                self.version, self.dim = version, dim
+            for j, k in enumerate(uniq.tolist()):
+                v = self._cache.get(k)
+                if v is None:
+                    miss.append(j)
+                else:
+                    self._cache.move_to_end(k)
+                    values[j] = v
+        miss = np.asarray(miss, dtype=np.intp)
+        if miss.size:
+            values[miss] = score(X[first[miss]])
+        with self._lock:
+            # промах — одно вычисление ядра; повторы строки внутри запроса считаются попаданиями
+            self.hits += X.shape[0] - miss.size
+            self.misses += int(miss.size)
+            # модель могли подменить, пока считались промахи: такие оценки не кэшируем
+            if self.version == version and self.dim == dim:
+                for j in miss.tolist():
+                    self._cache[int(uniq[j])] = float(values[j])
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+                    self.evictions += 1
+        return values[inverse]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"entries": len(self._cache), "max_entries": self.max_entries, "model_version": self.version,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else None,
+                "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+class OCSVMModel(ResidentArtifact):
 
     def __init__(self,
                  tfidf_params: Dict[str, Any],
@@ -29,38 +267,38 @@ class OCSVMModel:
             gamma=ocsvm_params.get("gamma", "scale"),
             nu=ocsvm_params.get("nu", 0.05),
         )
-        self.model_dir = model_dir
-        os.makedirs(self.model_dir, exist_ok=True)
-        self.model_path = os.path.join(self.model_dir, model_name)
+        self._init_resident(model_dir, model_name)
 
-    def fit(self, texts: List[str]) -> Dict[str, Any]:
-        X = self.vectorizer.fit_transform(texts)
+    def fit(self, texts: List[str]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """(состояние для save(), статистика); обучаются копии — резидентная модель отвечает до save()."""
+        vectorizer, model = clone(self.vectorizer), clone(self.model)
+        X = vectorizer.fit_transform(texts)
         t0 = time.time()
-        self.model.fit(X)
-        return {
+        model.fit(X)
+        return {"vectorizer": vectorizer, "model": model}, {
             "train_time_sec": time.time() - t0,
             "n_samples": X.shape[0],
             "n_features": X.shape[1],
         }
 
     def predict(self, texts: List[str]) -> Tuple[List[int], List[float]]:
-        X = self.vectorizer.transform(texts)
-        labels = self.model.predict(X).tolist()
-        scores = self.model.decision_function(X).tolist()
-        return labels, scores
+        state = self.state
+        X = state["vectorizer"].transform(texts)
+        # метка — знак того же decision_function, ядро считается один раз
+        scores = state["model"].decision_function(X)
+        return np.where(scores > 0, 1, -1).tolist(), scores.tolist()
 
-    def save(self) -> str:
-        joblib.dump({"vectorizer": self.vectorizer, "model": self.model}, self.model_path)
-        return self.model_path
+    def warm_up(self):
+        self.predict([""])
 
-    def load(self) -> bool:
-        obj = joblib.load(self.model_path)
-        self.vectorizer = obj["vectorizer"]
-        self.model = obj["model"]
-        return True
+    def save(self, state: Dict[str, Any]) -> str:
+        return self._dump(state)
 
 
-class OCSVMModelRaw:
+class OCSVMModelRaw(ResidentArtifact):
+    scorer: ChunkScorer | None = None   # None — весь вход одним вызовом
+    memo: ScoreMemo | None = None       # None — без кэша оценок
+
     def __init__(self,
                  ocsvm_params: Dict[str, Any],
                  model_dir: str,
@@ -70,36 +308,244 @@ class OCSVMModelRaw:
             gamma=ocsvm_params.get("gamma", "scale"),
             nu=ocsvm_params.get("nu", 0.05),
         )
-        self.model_dir = model_dir
-        os.makedirs(self.model_dir, exist_ok=True)
-        self.model_path = os.path.join(self.model_dir, model_name)
+        self._init_resident(model_dir, model_name)
 
-    def fit(self, X) -> Dict[str, Any]:
+    def fit(self, X) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """
         X: scipy.sparse.csr_matrix / csc_matrix или numpy.ndarray
+        Возвращает (состояние для save(), статистика обучения).
         """
-        import scipy.sparse as sp
         t0 = time.time()
 
-        self.model.fit(X)
+        model = clone(self.model)
+        model.fit(X)
         n, m = X.shape
-        return {
+        return {"model": model}, {
             "train_time_sec": time.time() - t0,
             "n_samples": int(n),
             "n_features": int(m),
+            "engine": "exact",
         }
 
+    def decision(self, X) -> np.ndarray:
+        X = self._align(X)
+        if self.memo is None:
+            return self._score(X)
+        return self.memo.decision(self.version, X, self._score)
+
+    def _align(self, X):
+        """
+        Вход к размерности модели: словарь шаблонов мог вырасти после обучения —
+        признаки вне модели отбрасываются, недостающие — нули (как в update()).
+        """
+        dim = self.state["model"].n_features_in_
+        if X.shape[1] == dim:
+            return X
+        import scipy.sparse as sp
+        X = sp.csr_matrix(X, copy=True)
+        X.resize(X.shape[0], dim)
+        return X
+
+    def _score(self, X) -> np.ndarray:
+        model, key = self.state["model"], self.loaded_key
+        if self.scorer is None:
+            return model.decision_function(X)
+        return self.scorer.decision(model, self.model_path, key, X)
+
+    def labels(self, scores: np.ndarray) -> np.ndarray:
+        # как OneClassSVM.predict (libsvm): +1 только при score > 0
+        return np.where(scores > 0, 1, -1)
+
     def predict(self, X) -> Tuple[List[int], List[float]]:
-        labels = self.model.predict(X).tolist()
-        scores = self.model.decision_function(X).tolist()
-        return labels, scores
+        # один проход decision_function вместо predict + decision_function
+        scores = self.decision(X)
+        return self.labels(scores).tolist(), scores.tolist()
 
-    def save(self) -> str:
-        joblib.dump({"model": self.model}, self.model_path)
-        return self.model_path
+    def warm_up(self):
+        # первый вызов decision_function инициализирует внутренности libsvm
+        import scipy.sparse as sp
+        model = self.state["model"]
+        model.decision_function(sp.csr_matrix((1, model.n_features_in_)))
+        if self.scorer is not None:
+            self.scorer.warm_up(self.model_path, self.loaded_key, model.n_features_in_)
+
+    def save(self, state: Dict[str, Any]) -> str:
+        return self._dump(state)
+
+
+def rbf_gamma(gamma, X) -> float:
+    """gamma="scale" как в sklearn.svm: 1 / (n_features * X.var()), для sparse без densify."""
+    if gamma == "scale":
+        import scipy.sparse as sp
+        if sp.issparse(X):
+            mean = X.sum() / (X.shape[0] * X.shape[1])
+            var = X.multiply(X).sum() / (X.shape[0] * X.shape[1]) - mean ** 2
+        else:
+            var = X.var()
+        return 1.0 / (X.shape[1] * var) if var > 0 else 1.0
+    if gamma == "auto":
+        return 1.0 / X.shape[1]
+    return float(gamma)
+
+
+class ApproxOCSVMModel(OCSVMModelRaw):
+    """
+    Приближённый OCSVM: RBF-ядро аппроксимируется явным отображением признаков
+    (Nystroem по n_components опорным точкам или случайные признаки Фурье — rff),
+    поверх него линейный one-class SVM с тем же nu, обучаемый SGD. Обучение —
+    линейное по числу строк, предсказание не зависит от числа опорных векторов.
+    Интерфейс и формат артефакта — как у OCSVMModelRaw.
+    """
+
+    def __init__(self,
+                 ocsvm_params: Dict[str, Any],
+                 approx_params: Dict[str, Any],
+                 model_dir: str,
+                 model_name: str):
+        self.gamma = ocsvm_params.get("gamma", "scale")
+        n_components = int(approx_params.get("n_components", 300))
+        random_state = approx_params.get("random_state", 0)
+        if approx_params.get("feature_map", "nystroem") == "rff":
+            feature_map = RBFSampler(n_components=n_components, random_state=random_state)
+        else:
+            feature_map = Nystroem(kernel="rbf", n_components=n_components, random_state=random_state)
+        self.model = Pipeline([
+            ("feature_map", feature_map),
+            ("sgd", SGDOneClassSVM(
+                nu=ocsvm_params.get("nu", 0.05),
+                max_iter=int(approx_params.get("max_iter", 20)),
+                tol=float(approx_params.get("tol", 1e-3)),
+                random_state=random_state,
+            )),
+        ])
+        self._init_resident(model_dir, model_name)
+
+    def fit(self, X) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        t0 = time.time()
+        model = clone(self.model)
+        model.set_params(feature_map__gamma=rbf_gamma(self.gamma, X))
+        model.fit(X)
+        n, m = X.shape
+        return {"model": model}, {
+            "train_time_sec": time.time() - t0,
+            "n_samples": int(n),
+            "n_features": int(m),
+            "engine": "approx",
+        }
+
+    def labels(self, scores: np.ndarray) -> np.ndarray:
+        # как SGDOneClassSVM.predict: граница относится к норме
+        return np.where(scores >= 0, 1, -1)
+
+
+class OnlineOCSVMModel(OCSVMModelRaw):
+    """
+    Онлайн-OCSVM: фиксированное отображение признаков (rff — случайные признаки Фурье,
+    nystroem — опорные точки из первого батча) и SGDOneClassSVM, который дообучается
+    partial_fit по чанкам из chunk_rows строк. Память — O(chunk_rows * n_components),
+    стоимость батча не зависит от объёма истории. С learning_rate: constant модель
+    продолжает следовать за дрейфом «нормы», а не застывает, как при убывающем шаге.
+    """
+
+    def __init__(self,
+                 ocsvm_params: Dict[str, Any],
+                 online_params: Dict[str, Any],
+                 model_dir: str,
+                 model_name: str):
+        self.gamma = ocsvm_params.get("gamma", "scale")
+        self.nu = ocsvm_params.get("nu", 0.05)
+        self.params = online_params
+        self.chunk_rows = max(int(online_params.get("chunk_rows", 5000)), 1)
+        self._update_lock = threading.Lock()
+        self.model = None
+        self._init_resident(model_dir, model_name)
+
+    def _new_model(self, X) -> Pipeline:
+        n_components = int(self.params.get("n_components", 300))
+        random_state = self.params.get("random_state", 0)
+        gamma = rbf_gamma(self.gamma, X)
+        if self.params.get("feature_map", "rff") == "nystroem":
+            feature_map = Nystroem(kernel="rbf", gamma=gamma, n_components=n_components,
+                                   random_state=random_state)
+        else:
+            feature_map = RBFSampler(gamma=gamma, n_components=n_components, random_state=random_state)
+        # отображение фиксируется по первому батчу и дальше не меняется
+        feature_map.fit(X)
+        sgd = SGDOneClassSVM(nu=self.nu, learning_rate=self.params.get("learning_rate", "constant"),
+                             eta0=float(self.params.get("eta0", 0.01)), random_state=random_state)
+        return Pipeline([("feature_map", feature_map), ("sgd", sgd)])
+
+    labels = ApproxOCSVMModel.labels
+
+    def _fold(self, model: Pipeline, X) -> int:
+        chunks = 0
+        for lo in range(0, X.shape[0], self.chunk_rows):
+            Z = model.named_steps["feature_map"].transform(X[lo:lo + self.chunk_rows])
+            model.named_steps["sgd"].partial_fit(Z)
+            chunks += 1
+        return chunks
+
+    def fit(self, X) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        t0 = time.time()
+        model = self._new_model(X)
+        chunks = self._fold(model, X)
+        return {"model": model, "n_seen": int(X.shape[0])}, {
+            "train_time_sec": time.time() - t0,
+            "n_samples": int(X.shape[0]),
+            "n_features": int(X.shape[1]),
+            "chunks": chunks,
+            "engine": "online",
+        }
+
+    def update(self, X) -> Dict[str, Any]:
+        """
+        Дообучение резидентной модели на новом батче нормальных строк и checkpoint.
+        Работа идёт на копии (линейная модель маленькая), резидентная подменяется
+        атомарно при сохранении; параллельные update выполняются по очереди, а
+        полное обучение, закончившееся во время update, не затирается (ValueError).
+        """
+        with self._update_lock:
+            try:
+                self.ensure_loaded()
+            except FileNotFoundError:
+                pass
+            base = self.state
+            if base is None:
+                state, stats = self.fit(X)
+                stats["path"] = self.save(state)
+                stats["model_version"] = state["version"]
+                return stats
+            t0 = time.time()
+            model = copy.deepcopy(base["model"])
+            dim = model.named_steps["feature_map"].n_features_in_
+            batch_dim = int(X.shape[1])
+            if batch_dim != dim:
+                # словарь шаблонов вырос после обучения: признаки вне модели отбрасываются,
+                # недостающие — нули (как в benchmark.py); отображение признаков не меняется
+                X = X.tocsr(copy=True)
+                X.resize(X.shape[0], dim)
+            chunks = self._fold(model, X)
+            n_seen = int(base.get("n_seen", 0)) + int(X.shape[0])
+            state = {"model": model, "n_seen": n_seen}
+            return {
+                "path": self._dump(state, base),
+                "model_version": state["version"],
+                "train_time_sec": time.time() - t0,
+                "n_samples": int(X.shape[0]),
+                "n_features": int(X.shape[1]),
+                "batch_dim": batch_dim,
+                "chunks": chunks,
+                "n_seen": n_seen,
+                "engine": "online",
+            }
 
-    def load(self) -> bool:
-        obj = joblib.load(self.model_path)
-        self.model = obj["model"]
-        return True
 
+def make_vector_model(engine: str, ocsvm_params: Dict[str, Any], approx_params: Dict[str, Any],
+                      model_dir: str, online_params: Dict[str, Any] | None = None) -> OCSVMModelRaw:
+    if engine == "approx":
+        return ApproxOCSVMModel(ocsvm_params, approx_params, model_dir, "ocsvm_approx_vectors.joblib")
+    if engine == "online":
+        return OnlineOCSVMModel(ocsvm_params, online_params or {}, model_dir, "ocsvm_online_vectors.joblib")
+    if engine != "exact":
+        raise ValueError(f"unknown ml engine {engine!r}, expected exact|approx|online")
+    return OCSVMModelRaw(ocsvm_params, model_dir, "ocsvm_raw_vectors.joblib")
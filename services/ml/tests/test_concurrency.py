@@ -0,0 +1,71 @@
+import os, sys, threading
+
+import joblib
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml_core import make_vector_model
+
+
+def matrix(rows: int, dim: int, seed: int) -> sp.csr_matrix:
+    rng = np.random.default_rng(seed)
+    return sp.csr_matrix(rng.random((rows, dim)).astype(np.float32))
+
+
+@pytest.mark.parametrize("engine", ["exact", "approx", "online"])
+def test_concurrent_fits_save_their_own_model(engine, tmp_path):
+    model = make_vector_model(engine, {}, {"n_components": 20}, str(tmp_path), {"n_components": 20})
+    dims = [3, 4, 5, 6, 7, 8]
+    barrier = threading.Barrier(len(dims))
+    errors = []
+
+    def train(dim):
+        try:
+            X = matrix(200, dim, dim)
+            barrier.wait()
+            state, _ = model.fit(X)
+            saved = joblib.load(model.save(state)) if dim % 2 else None
+            assert state["model"].n_features_in_ == dim
+            if saved is not None:
+                # файл мог уже подменить другой поток, но не чужим состоянием этого потока
+                assert saved["model"].n_features_in_ in dims
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=train, args=(d,)) for d in dims]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+    # резидентная модель и её ключ совпадают с артефактом на диске
+    on_disk = joblib.load(model.model_path)["model"].n_features_in_
+    assert model.state["model"].n_features_in_ == on_disk
+    assert model.ensure_loaded() is False
+
+
+def test_online_update_does_not_overwrite_a_concurrent_retrain(tmp_path):
+    model = make_vector_model("online", {}, {}, str(tmp_path), {"n_components": 20})
+    state, _ = model.fit(matrix(100, 4, 0))
+    model.save(state)
+
+    fold = model._fold
+    job = make_vector_model("online", {}, {}, str(tmp_path), {"n_components": 20})
+
+    def fold_and_retrain(m, X):
+        # задача обучения (другой экземпляр, как в процессе jobs) сохраняет модель,
+        # пока update считает свою копию
+        retrained, _ = job.fit(matrix(100, 6, 1))
+        job.save(retrained)
+        return fold(m, X)
+
+    model._fold = fold_and_retrain
+    with pytest.raises(ValueError, match="replaced"):
+        model.update(matrix(50, 4, 2))
+    assert joblib.load(model.model_path)["model"].named_steps["feature_map"].n_features_in_ == 6
+    assert model.ensure_loaded() is True
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
@@ -0,0 +1,29 @@
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jobs
+from jobs import FAILED, TrainJobs
+
+
+def wait_finished(job, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while job.finished is None and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+
+def test_worker_start_failure_fails_the_job_and_frees_the_slot(tmp_path, monkeypatch):
+    def broken_start(self):
+        raise OSError("Too many open files")
+
+    monkeypatch.setattr(jobs._CTX.Process, "start", broken_start)
+    manager = TrainJobs("exact", {}, str(tmp_path), on_done=lambda job: None, max_concurrent=1)
+    first = manager.submit("train_vectors", {})
+    wait_finished(first)
+    second = manager.submit("train_vectors", {})
+    wait_finished(second)
+
+    for job in (first, second):
+        assert job.status == FAILED
+        assert "Too many open files" in job.error
+    assert manager.slots.acquire(blocking=False)
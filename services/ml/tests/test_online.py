@@ -0,0 +1,24 @@
+import os, sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml_core import make_vector_model
+
+
+def matrix(rows: int, dim: int, seed: int) -> sp.csr_matrix:
+    rng = np.random.default_rng(seed)
+    return sp.csr_matrix(rng.random((rows, dim)).astype(np.float32))
+
+
+@pytest.mark.parametrize("batch_dim", [3, 9])
+def test_online_update_resizes_batch_to_model_dim(batch_dim, tmp_path):
+    model = make_vector_model("online", {}, {}, str(tmp_path), {"n_components": 20})
+    state, _ = model.fit(matrix(100, 6, 0))
+    model.save(state)
+    stats = model.update(matrix(50, batch_dim, 1))
+    assert stats["n_features"] == 6 and stats["batch_dim"] == batch_dim
+    assert stats["n_seen"] == 150
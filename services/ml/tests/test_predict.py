@@ -0,0 +1,43 @@
+import os, sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml_core import ScoreMemo, make_vector_model
+
+
+def matrix(rows: int, dim: int, seed: int) -> sp.csr_matrix:
+    rng = np.random.default_rng(seed)
+    return sp.csr_matrix(rng.random((rows, dim)).astype(np.float32))
+
+
+@pytest.mark.parametrize("engine", ["exact", "approx", "online"])
+@pytest.mark.parametrize("batch_dim", [3, 9])
+def test_predict_resizes_input_to_model_dim(engine, batch_dim, tmp_path):
+    model = make_vector_model(engine, {}, {"n_components": 20}, str(tmp_path), {"n_components": 20})
+    state, _ = model.fit(matrix(100, 6, 0))
+    model.save(state)
+    X = matrix(20, batch_dim, 1)
+    expected = X.copy()
+    expected.resize(20, 6)
+    labels, scores = model.predict(X)
+    assert len(labels) == len(scores) == 20
+    np.testing.assert_allclose(scores, model.decision(expected))
+
+
+def test_score_memo_does_not_reuse_scores_across_dims():
+    memo = ScoreMemo()
+    calls = []
+
+    def score(X):
+        calls.append(X.shape[1])
+        return np.full(X.shape[0], float(X.shape[1]))
+
+    row = sp.csr_matrix(([1.0], ([0], [0])), shape=(1, 4))
+    assert memo.decision(1, row, score).tolist() == [4.0]
+    assert memo.decision(1, sp.csr_matrix(row.toarray()[:, :2]), score).tolist() == [2.0]
+    assert memo.decision(1, sp.csr_matrix(row.toarray()[:, :2]), score).tolist() == [2.0]
+    assert calls == [4, 2]
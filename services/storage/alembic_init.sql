@@ -6,7 +6,10 @@
 --   features      — ссылка на внешнее хранилище фич (совместимость)
 --   models        — реестр ML-моделей/артефактов
 --   bgl_logs      — сырые строки BGL (если вдруг захочешь хранить текст)
---   bgl_vectors   — разрежённые векторные представления (CSR как JSON)
+--   bgl_vectors   — разрежённые векторные представления (CSR в массивах int4[]/float4[])
+--   bgl_events    — компактный режим: событие + id шаблона (+ редкие доп. признаки)
+--   template_idf  — веса шаблонов для компактного режима
+--   bgl_scores    — результаты инференса: оценка и метка строки для версии модели
 -- Также создаются базовые индексы по часто используемым полям.
 -- =====================================================================
 
@@ -82,7 +85,7 @@ END$$;
 
 -- ---------------------------------------
 -- BGL: векторные представления (CSR)
---   indices / values — JSON-массивы
+--   indices / values — нативные массивы PostgreSQL
 --   dim              — размерность пространства
 -- ---------------------------------------
 CREATE TABLE IF NOT EXISTS bgl_vectors (
@@ -92,10 +95,25 @@ CREATE TABLE IF NOT EXISTS bgl_vectors (
   is_alert     BOOLEAN,
   template_id  INTEGER,
   dim          INTEGER,
-  indices      TEXT,     -- JSON array of ints (CSR.indices)
-  values       TEXT      -- JSON array of floats (CSR.data)
+  indices      INT4[],   -- CSR.indices
+  values       FLOAT4[]  -- CSR.data
 );
 
+-- Миграция старых таблиц, где indices/values были TEXT с JSON:
+-- '[1, 2]' -> '{1, 2}' и приведение к массиву, один раз на таблицу
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = 'public' AND table_name = 'bgl_vectors'
+      AND column_name = 'indices' AND data_type = 'text'
+  ) THEN
+    ALTER TABLE bgl_vectors
+      ALTER COLUMN indices TYPE INT4[] USING translate(indices, '[]', '{}')::INT4[],
+      ALTER COLUMN values  TYPE FLOAT4[] USING translate(values, '[]', '{}')::FLOAT4[];
+  END IF;
+END$$;
+
 -- Индексы для bgl_vectors
 DO $$
 BEGIN
@@ -122,5 +140,99 @@ BEGIN
   ) THEN
     CREATE INDEX idx_bgl_vectors_template_id ON bgl_vectors (template_id);
   END IF;
+
+  -- keyset-пагинация по id среди non-alert строк (выборки для обучения)
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relname = 'idx_bgl_vectors_normal_id' AND n.nspname = 'public'
+  ) THEN
+    CREATE INDEX idx_bgl_vectors_normal_id ON bgl_vectors (id) WHERE is_alert = false;
+  END IF;
+END$$;
+
+
+-- ---------------------------------------
+-- BGL: компактное хранение (vector_store: compact)
+--   bgl_events   — только событие и id шаблона; extra_* — признаки сверх
+--                  one-hot шаблона (обычно NULL)
+--   template_idf — вес шаблона; смена IDF = обновление этой маленькой таблицы
+--   bgl_vectors_compact — те же колонки, что у bgl_vectors, вектор собирается
+--                  при чтении: [template_id] + extra_indices, [вес] + extra_values
+-- ---------------------------------------
+CREATE TABLE IF NOT EXISTS bgl_events (
+  id             SERIAL PRIMARY KEY,
+  line_id        INTEGER,
+  alert_tag      VARCHAR(64),
+  is_alert       BOOLEAN,
+  template_id    INTEGER,
+  extra_indices  INT4[],
+  extra_values   FLOAT4[]
+);
+
+CREATE TABLE IF NOT EXISTS template_idf (
+  template_id  INTEGER PRIMARY KEY,
+  weight       FLOAT4 NOT NULL,
+  updated_at   TIMESTAMPTZ DEFAULT now()
+);
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relname = 'idx_bgl_events_template_id' AND n.nspname = 'public'
+  ) THEN
+    CREATE INDEX idx_bgl_events_template_id ON bgl_events (template_id);
+  END IF;
+
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relname = 'idx_bgl_events_normal_id' AND n.nspname = 'public'
+  ) THEN
+    CREATE INDEX idx_bgl_events_normal_id ON bgl_events (id) WHERE is_alert = false;
+  END IF;
 END$$;
 
+-- dim общий для всех строк: по максимальному id шаблона в весах и в событиях (оба по индексу)
+CREATE OR REPLACE VIEW bgl_vectors_compact AS
+SELECT e.id, e.line_id, e.alert_tag, e.is_alert, e.template_id, d.dim,
+       ARRAY[e.template_id] || COALESCE(e.extra_indices, '{}'::INT4[]) AS indices,
+       ARRAY[COALESCE(w.weight, 1.0)::FLOAT4] || COALESCE(e.extra_values, '{}'::FLOAT4[]) AS values
+FROM bgl_events e
+LEFT JOIN template_idf w ON w.template_id = e.template_id
+CROSS JOIN (
+  SELECT GREATEST(
+    (SELECT COALESCE(MAX(template_id) + 1, 0) FROM template_idf),
+    (SELECT COALESCE(MAX(template_id) + 1, 0) FROM bgl_events)
+  ) AS dim
+) d;
+
+
+-- ---------------------------------------
+-- BGL: результаты инференса
+--   ключ (model_name, model_version, line_id) — он же индекс для чтения
+--   диапазона строк модели; idx_bgl_scores_model_score — top-k самых
+--   аномальных (меньший score) и гистограмма по модели без сортировки таблицы
+-- ---------------------------------------
+CREATE TABLE IF NOT EXISTS bgl_scores (
+  model_name     VARCHAR(128) NOT NULL,
+  model_version  VARCHAR(64)  NOT NULL,
+  line_id        INTEGER      NOT NULL,
+  score          FLOAT4       NOT NULL,
+  label          SMALLINT,
+  scored_at      TIMESTAMPTZ  DEFAULT now(),
+  PRIMARY KEY (model_name, model_version, line_id)
+);
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relname = 'idx_bgl_scores_model_score' AND n.nspname = 'public'
+  ) THEN
+    CREATE INDEX idx_bgl_scores_model_score ON bgl_scores (model_name, model_version, score) INCLUDE (line_id);
+  END IF;
+END$$;
@@ -1,8 +1,37 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import text
-from db import engine
-import os, json
+from db import engine, async_engine
+from config import load_config
+from copy_ingest import (BodyReader, CopyStream, COPY_SQL, COPY_EVENTS_SQL, ndjson_rows, arrow_rows,
+                         encode_row, encode_event, split_extras)
+import os, json, time, queue, asyncio
+
+cfg = load_config()
+COPY_CHUNK_BYTES = int(cfg.get("copy_chunk_bytes", 1 << 20))
+INGEST_QUEUE     = int(cfg.get("ingest_queue_chunks", 16))
+FETCH_SIZE       = int(cfg.get("stream_fetch_size", 5000))
+# full — вектора целиком в bgl_vectors; compact — события в bgl_events + веса в template_idf
+COMPACT          = cfg.get("vector_store", "full") == "compact"
+VECTORS_SOURCE   = "bgl_vectors_compact" if COMPACT else "bgl_vectors"
+EVENTS_TABLE     = "bgl_events" if COMPACT else "bgl_vectors"
+SAMPLE_CFG       = cfg.get("sample", {}) or {}
+
+if COMPACT:
+    INSERT_SQL = text("""INSERT INTO bgl_events (line_id, alert_tag, is_alert, template_id, extra_indices, extra_values)
+                         VALUES (:lid, :tag, :ia, :tid, :inds, :vals)""")
+else:
+    INSERT_SQL = text("""INSERT INTO bgl_vectors (line_id, alert_tag, is_alert, template_id, dim, indices, values)
+                         VALUES (:lid, :tag, :ia, :tid, :dim, :inds, :vals)""")
+
+# db.statement_timeout_ms ограничивает интерактивные запросы; COPY и выборки для обучения
+# (полный проход по md5-порядку) снимают лимит в своей транзакции
+NO_TIMEOUT_SQL = "SET LOCAL statement_timeout = 0"
+
+NDJSON_MEDIA = "application/x-ndjson"
+ARROW_MEDIA  = "application/vnd.apache.arrow.stream"
 
 app = FastAPI(title="Storage Service")
 
@@ -15,7 +44,34 @@ def startup():
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    return {"status": "ok", "driver": "asyncpg" if async_engine is not None else "psycopg2"}
+
+
+def _fetch(res, fetch: str | None):
+    if fetch == "all":
+        return [dict(r) for r in res.mappings().all()]
+    if fetch == "scalar":
+        return res.scalar_one()
+    return None
+
+def _sync_exec(sql, params, fetch, no_timeout):
+    with engine.begin() as conn:
+        if no_timeout:
+            conn.execute(text(NO_TIMEOUT_SQL))
+        return _fetch(conn.execute(sql, params), fetch)
+
+async def db_exec(sql, params=None, fetch: str | None = None, no_timeout: bool = False):
+    """
+    Запрос в отдельной транзакции: с db.driver=asyncpg — на асинхронном движке
+    прямо в event loop, иначе — синхронно через psycopg2 в пуле потоков.
+    Список словарей в params — executemany. no_timeout снимает statement_timeout.
+    """
+    if async_engine is not None:
+        async with async_engine.begin() as conn:
+            if no_timeout:
+                await conn.execute(text(NO_TIMEOUT_SQL))
+            return _fetch(await conn.execute(sql, params), fetch)
+    return await run_in_threadpool(_sync_exec, sql, params, fetch, no_timeout)
 
 
 class VecIn(BaseModel):
@@ -27,68 +83,370 @@ class VecIn(BaseModel):
     indices: list[int]
     values: list[float]
 
+def insert_params(v: VecIn) -> dict:
+    # списки уходят в int4[]/float4[] как массивы драйвера, без JSON-сериализации
+    p = {"lid": v.line_id, "tag": v.alert_tag, "ia": v.is_alert, "tid": v.template_id}
+    if COMPACT:
+        ind, val = split_extras(v.template_id, v.indices, v.values)
+        p["inds"] = None if ind is None else ind.tolist()
+        p["vals"] = None if val is None else val.tolist()
+    else:
+        p.update(dim=v.dim, inds=v.indices, vals=v.values)
+    return p
+
 @app.post("/bgl/vectors")
-def insert_vec(v: VecIn):
-    with engine.begin() as conn:
-        res = conn.execute(
-            text("""INSERT INTO bgl_vectors (line_id, alert_tag, is_alert, template_id, dim, indices, values)
-                    VALUES (:lid, :tag, :ia, :tid, :dim, :inds, :vals) RETURNING id"""),
-            {
-                "lid": v.line_id, "tag": v.alert_tag, "ia": v.is_alert,
-                "tid": v.template_id, "dim": v.dim,
-                "inds": json.dumps(v.indices, ensure_ascii=False),
-                "vals": json.dumps(v.values)
-            }
-        )
-        return {"id": res.scalar_one()}
+async def insert_vec(v: VecIn):
+    new_id = await db_exec(text(INSERT_SQL.text + " RETURNING id"), insert_params(v), "scalar")
+    return {"id": new_id}
 
 @app.post("/bgl/vectors/bulk")
-def insert_vec_bulk(items: list[VecIn]):
+async def insert_vec_bulk(items: list[VecIn]):
     if not items:
         return {"inserted": 0}
-    rows = [{
-        "lid": it.line_id, "tag": it.alert_tag, "ia": it.is_alert,
-        "tid": it.template_id, "dim": it.dim,
-        "inds": json.dumps(it.indices, ensure_ascii=False),
-        "vals": json.dumps(it.values)
-    } for it in items]
-    with engine.begin() as conn:
-        conn.execute(
-            text("""INSERT INTO bgl_vectors (line_id, alert_tag, is_alert, template_id, dim, indices, values)
-                    VALUES (:lid, :tag, :ia, :tid, :dim, :inds, :vals)"""),
-            rows
-        )
+    await db_exec(INSERT_SQL, [insert_params(it) for it in items])
     return {"inserted": len(items)}
 
+def _copy_vectors(body: BodyReader, fmt: str) -> CopyStream:
+    encode = encode_event if COMPACT else encode_row
+    rows = arrow_rows(body, encode) if fmt == "arrow" else ndjson_rows(body, encode)
+    stream = CopyStream(rows, COPY_CHUNK_BYTES)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(NO_TIMEOUT_SQL)
+            cur.copy_expert(COPY_EVENTS_SQL if COMPACT else COPY_SQL, stream, size=COPY_CHUNK_BYTES)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        if stream.error is not None:
+            raise stream.error from e
+        raise
+    finally:
+        # остаток тела дочитывается впустую, чтобы не заблокировать отправителя
+        while not body.eof:
+            body.read(COPY_CHUNK_BYTES)
+        conn.close()
+    return stream
+
+@app.post("/bgl/vectors/ingest")
+async def ingest_vectors(request: Request,
+                         format: str | None = Query(None, pattern="^(ndjson|arrow)$")):
+    """
+    Потоковая загрузка: тело (NDJSON по строке на вектор или Arrow IPC stream
+    из /collect_vectors?format=arrow) по мере прихода уходит в
+    COPY bgl_vectors (bgl_events в компактном режиме) FROM STDIN (FORMAT binary)
+    одной транзакцией.
+    Очередь между приёмом и COPY ограничена ingest_queue_chunks кусками.
+    """
+    fmt = format or ("arrow" if ARROW_MEDIA in request.headers.get("content-type", "") else "ndjson")
+    if fmt == "arrow":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(415, "pyarrow is not installed, send NDJSON")
+    chunks: queue.Queue = queue.Queue(INGEST_QUEUE)
+    body = BodyReader(chunks)
+    t0 = time.perf_counter()
+    job = asyncio.ensure_future(run_in_threadpool(_copy_vectors, body, fmt))
+
+    async def feed(item):
+        # ожидание места в очереди — backpressure на клиента
+        while not job.done():
+            try:
+                chunks.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.005)
+
+    async for chunk in request.stream():
+        if chunk:
+            await feed(chunk)
+    await feed(None)
+    try:
+        stream = await job
+    except (ValueError, KeyError) as e:
+        raise HTTPException(400, f"bad input: {e}")
+    elapsed = time.perf_counter() - t0
+    return {
+        "inserted": stream.count,
+        "bytes": stream.bytes,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": int(stream.count / elapsed) if elapsed > 0 else None,
+    }
+
+def vectors_query(limit: int, offset: int, only_non_alert: bool,
+                  after_id: int | None, before_id: int | None):
+    """
+    Keyset-пагинация: after_id — строки с id > after_id по возрастанию id,
+    before_id — с id < before_id по убыванию (как без ключа). Стоимость страницы
+    не зависит от глубины, в отличие от OFFSET, который оставлен для совместимости.
+    """
+    where, params = [], {"lim": limit, "off": offset}
+    if only_non_alert:
+        where.append("is_alert=false")
+    if after_id is not None:
+        where.append("id > :after")
+        params["after"] = after_id
+    if before_id is not None:
+        where.append("id < :before")
+        params["before"] = before_id
+    order = "ASC" if after_id is not None and before_id is None else "DESC"
+    sql = f"SELECT * FROM {VECTORS_SOURCE}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY id {order} LIMIT :lim OFFSET :off"
+    return text(sql), params
+
+def vector_row(r) -> dict:
+    # int4[]/float4[] приходят из драйвера уже списками
+    return {**r, "indices": r["indices"] or [], "values": r["values"] or []}
+
+def ndjson_vectors(sql, params, no_timeout: bool = False):
+    """Серверный (именованный) курсор: в памяти не больше FETCH_SIZE строк."""
+    with engine.connect() as conn:
+        if no_timeout:
+            conn.execute(text(NO_TIMEOUT_SQL))
+        result = conn.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(sql, params)
+        for part in result.mappings().partitions():
+            yield "".join(json.dumps(vector_row(r), separators=(",", ":")) + "\n" for r in part).encode()
+
+async def ndjson_vectors_async(sql, params, no_timeout: bool = False):
+    async with async_engine.connect() as conn:
+        if no_timeout:
+            await conn.execute(text(NO_TIMEOUT_SQL))
+        result = await conn.stream(sql, params)
+        async for part in result.mappings().partitions(FETCH_SIZE):
+            yield "".join(json.dumps(vector_row(r), separators=(",", ":")) + "\n" for r in part).encode()
+
 @app.get("/bgl/vectors")
-def list_vecs(limit: int = 1000, offset: int = 0, only_non_alert: bool = False):
-    with engine.begin() as conn:
-        if only_non_alert:
-            sql = "SELECT * FROM bgl_vectors WHERE is_alert=false ORDER BY id DESC LIMIT :lim OFFSET :off"
-        else:
-            sql = "SELECT * FROM bgl_vectors ORDER BY id DESC LIMIT :lim OFFSET :off"
-        rows = conn.execute(text(sql), {"lim": limit, "off": offset}).mappings().all()
-        out = []
-        for r in rows:
-            d = dict(r)
-            d["indices"] = json.loads(d["indices"]) if d.get("indices") else []
-            d["values"]  = json.loads(d["values"]) if d.get("values") else []
-            out.append(d)
-        return out
+async def list_vecs(limit: int = 1000, offset: int = 0, only_non_alert: bool = False,
+                    after_id: int | None = Query(None, ge=0), before_id: int | None = Query(None, ge=0),
+                    format: str = Query("json", pattern="^(json|ndjson)$")):
+    """
+    format=ndjson отдаёт строки потоком из серверного курсора (fetch по stream_fetch_size),
+    память не зависит от limit; последний id страницы — ключ after_id/before_id следующей.
+    """
+    sql, params = vectors_query(limit, offset, only_non_alert, after_id, before_id)
+    if format == "ndjson":
+        stream = ndjson_vectors_async if async_engine is not None else ndjson_vectors
+        return StreamingResponse(stream(sql, params), media_type=NDJSON_MEDIA)
+    return [vector_row(r) for r in await db_exec(sql, params, "all")]
 
 
-@app.post("/models")
-def create_model(name: str, version: str, path: str, metric_aupr: float = 0.0, notes: str = ""):
-    with engine.begin() as conn:
-        res = conn.execute(
-            text("INSERT INTO models (name,version,path,metric_aupr,notes) VALUES (:n,:v,:p,:m,:no) RETURNING id"),
-            {"n": name, "v": version, "p": path, "m": metric_aupr, "no": notes}
+def sample_query(n: int, mode: str, seed: int, per_template_cap: int | None, only_non_alert: bool,
+                 from_line: int | None, to_line: int | None, last_lines: int | None,
+                 pct: float | None = None):
+    """
+    Выборка id в базе, затем вектора по ним. Порядок «случайности» — md5(id || seed):
+    одна и та же выборка при том же seed и тех же данных.
+      uniform    — n строк с наименьшим хэшем (top-n без полной сортировки);
+                   pct — сначала прореживает таблицу TABLESAMPLE BERNOULLI (pct) REPEATABLE (seed)
+      stratified — ROW_NUMBER() по template_id в порядке хэша, не больше per_template_cap
+                   на шаблон; шаблоны чередуются, поэтому частый шаблон не вытесняет редкие
+      window     — uniform внутри окна line_id (from_line/to_line или last_lines последних строк)
+    """
+    where, params = [], {"n": n, "seed": str(seed)}
+    if only_non_alert:
+        where.append("is_alert = false")
+    if from_line is not None:
+        where.append("line_id >= :from_line")
+        params["from_line"] = from_line
+    if to_line is not None:
+        where.append("line_id < :to_line")
+        params["to_line"] = to_line
+    if last_lines is not None:
+        where.append(f"line_id > (SELECT MAX(line_id) FROM {EVENTS_TABLE}) - :last_lines")
+        params["last_lines"] = last_lines
+    if mode == "window" and from_line is None and to_line is None and last_lines is None:
+        raise HTTPException(400, "mode=window needs from_line/to_line or last_lines")
+    cond = (" WHERE " + " AND ".join(where)) if where else ""
+    rank = "md5(id::text || :seed)"
+
+    if mode == "stratified":
+        params["cap"] = per_template_cap or int(SAMPLE_CFG.get("per_template_cap", 200))
+        ids = f"""
+            SELECT id FROM (
+                SELECT id, {rank} AS h,
+                       ROW_NUMBER() OVER (PARTITION BY template_id ORDER BY {rank}) AS rn
+                FROM {EVENTS_TABLE}{cond}
+            ) r
+            WHERE rn <= :cap
+            ORDER BY rn, h
+            LIMIT :n"""
+    else:
+        source = EVENTS_TABLE
+        if pct is not None:
+            source += " TABLESAMPLE BERNOULLI (:pct) REPEATABLE (:seed_int)"
+            params.update(pct=pct, seed_int=seed)
+        ids = f"SELECT id FROM {source}{cond} ORDER BY {rank} LIMIT :n"
+
+    sql = f"SELECT v.* FROM {VECTORS_SOURCE} v JOIN ({ids}) s ON s.id = v.id ORDER BY v.id"
+    return text(sql), params
+
+@app.get("/bgl/vectors/sample")
+async def sample_vecs(n: int = Query(10000, gt=0),
+                      mode: str = Query("uniform", pattern="^(uniform|stratified|window)$"),
+                      seed: int = 0,
+                      per_template_cap: int | None = Query(None, gt=0),
+                      only_non_alert: bool = True,
+                      from_line: int | None = Query(None, ge=0), to_line: int | None = Query(None, ge=0),
+                      last_lines: int | None = Query(None, gt=0),
+                      fast: bool = False,
+                      format: str = Query("json", pattern="^(json|ndjson)$")):
+    """
+    Обучающая выборка размера n, собранная в базе (см. sample_query). Строки отдаются
+    в порядке id; format=ndjson — потоком, как GET /bgl/vectors.
+    """
+    pct = None
+    if fast and mode == "uniform":
+        # доля строк с запасом oversample по оценке размера таблицы из статистики
+        # (подзапрос внутри TABLESAMPLE PostgreSQL не допускает)
+        est = await db_exec(text("SELECT reltuples FROM pg_class WHERE relname = :t"),
+                            {"t": EVENTS_TABLE}, "scalar")
+        if est and est > 0:
+            pct = min(100.0, max(0.01, n * float(SAMPLE_CFG.get("oversample", 3.0)) * 100.0 / est))
+    sql, params = sample_query(n, mode, seed, per_template_cap, only_non_alert,
+                               from_line, to_line, last_lines, pct)
+    if format == "ndjson":
+        stream = ndjson_vectors_async if async_engine is not None else ndjson_vectors
+        return StreamingResponse(stream(sql, params, no_timeout=True), media_type=NDJSON_MEDIA)
+    return [vector_row(r) for r in await db_exec(sql, params, "all", no_timeout=True)]
+
+
+class TemplateIDF(BaseModel):
+    weights: list[float]
+    template_ids: list[int] | None = None   # по умолчанию weights[i] — вес шаблона i
+    replace: bool = False                   # удалить веса шаблонов, которых нет в запросе
+
+@app.put("/bgl/template_idf")
+async def put_template_idf(body: TemplateIDF):
+    """
+    Веса шаблонов для компактного режима: одна upsert-операция по массивам
+    вместо переписывания всех строк событий при дрейфе IDF.
+    """
+    ids = body.template_ids if body.template_ids is not None else list(range(len(body.weights)))
+    if len(ids) != len(body.weights):
+        raise HTTPException(400, "template_ids/weights length mismatch")
+    sql = """
+        WITH del AS (
+            DELETE FROM template_idf
+            WHERE CAST(:replace AS BOOLEAN) AND template_id <> ALL(CAST(:ids AS INT4[]))
+            RETURNING 1
+        ), upd AS (
+            INSERT INTO template_idf (template_id, weight)
+            SELECT * FROM unnest(CAST(:ids AS INT4[]), CAST(:w AS FLOAT4[]))
+            ON CONFLICT (template_id) DO UPDATE SET weight = EXCLUDED.weight, updated_at = now()
+            RETURNING 1
+        )
+        SELECT (SELECT count(*) FROM upd) AS updated, (SELECT count(*) FROM del) AS removed"""
+    rows = await db_exec(text(sql), {"ids": ids, "w": body.weights, "replace": body.replace}, "all")
+    return rows[0]
+
+@app.get("/bgl/template_idf")
+async def get_template_idf():
+    rows = await db_exec(text("SELECT template_id, weight FROM template_idf ORDER BY template_id"), None, "all")
+    return {"template_ids": [r["template_id"] for r in rows], "weights": [r["weight"] for r in rows]}
+
+
+
+class ScoresIn(BaseModel):
+    model_name: str
+    model_version: str
+    line_ids: list[int]
+    scores: list[float]
+    labels: list[int] | None = None
+
+@app.post("/bgl/scores/bulk")
+async def insert_scores(body: ScoresIn):
+    """
+    Результаты инференса колонками: одна upsert-операция по массивам; повторный
+    скоринг той же версии модели перезаписывает оценки строк.
+    """
+    n = len(body.line_ids)
+    if len(body.scores) != n or (body.labels is not None and len(body.labels) != n):
+        raise HTTPException(400, "line_ids/scores/labels length mismatch")
+    sql = """
+        INSERT INTO bgl_scores (model_name, model_version, line_id, score, label)
+        SELECT :m, :v, t.line_id, t.score, t.label
+        FROM unnest(CAST(:ids AS INT4[]), CAST(:scores AS FLOAT4[]), CAST(:labels AS INT2[]))
+             AS t(line_id, score, label)
+        ON CONFLICT (model_name, model_version, line_id)
+        DO UPDATE SET score = EXCLUDED.score, label = EXCLUDED.label, scored_at = now()"""
+    await db_exec(text(sql), {"m": body.model_name, "v": body.model_version, "ids": body.line_ids,
+                              "scores": body.scores, "labels": body.labels or [None] * n})
+    return {"inserted": n}
+
+def scores_range(from_line: int | None, to_line: int | None, params: dict) -> str:
+    cond = "model_name = :m AND model_version = :v"
+    if from_line is not None:
+        cond += " AND line_id >= :from_line"
+        params["from_line"] = from_line
+    if to_line is not None:
+        cond += " AND line_id < :to_line"
+        params["to_line"] = to_line
+    return cond
+
+@app.get("/bgl/scores")
+async def list_scores(model_name: str, model_version: str,
+                      from_line: int | None = Query(None, ge=0), to_line: int | None = Query(None, ge=0),
+                      limit: int = Query(1000, gt=0)):
+    params = {"m": model_name, "v": model_version, "limit": limit}
+    cond = scores_range(from_line, to_line, params)
+    sql = f"SELECT line_id, score, label FROM bgl_scores WHERE {cond} ORDER BY line_id LIMIT :limit"
+    return await db_exec(text(sql), params, "all")
+
+@app.get("/bgl/scores/top")
+async def top_scores(model_name: str, model_version: str, k: int = Query(100, gt=0),
+                     from_line: int | None = Query(None, ge=0), to_line: int | None = Query(None, ge=0)):
+    """k самых аномальных строк (меньший score OCSVM) — по индексу (модель, score)."""
+    params = {"m": model_name, "v": model_version, "k": k}
+    cond = scores_range(from_line, to_line, params)
+    sql = f"SELECT line_id, score, label FROM bgl_scores WHERE {cond} ORDER BY score LIMIT :k"
+    return await db_exec(text(sql), params, "all")
+
+@app.get("/bgl/scores/histogram")
+async def score_histogram(model_name: str, model_version: str, bins: int = Query(50, gt=0, le=10000),
+                          lo: float | None = None, hi: float | None = None,
+                          from_line: int | None = Query(None, ge=0), to_line: int | None = Query(None, ge=0)):
+    """
+    Гистограмма оценок модели: bins корзин на [lo, hi] (по умолчанию — min/max
+    оценок), счёт — в базе через width_bucket, наружу уходит только bins чисел.
+    Оценки вне [lo, hi] попадают в крайние корзины.
+    """
+    params = {"m": model_name, "v": model_version, "bins": bins, "lo": lo, "hi": hi}
+    cond = scores_range(from_line, to_line, params)
+    sql = f"""
+        WITH s AS (
+            SELECT score FROM bgl_scores WHERE {cond}
+        ), b AS (
+            SELECT COALESCE(CAST(:lo AS FLOAT8), MIN(score)) AS lo,
+                   COALESCE(CAST(:hi AS FLOAT8), MAX(score)) AS hi
+            FROM s
         )
-        return {"id": res.scalar_one()}
+        SELECT b.lo, b.hi,
+               LEAST(GREATEST(width_bucket(s.score, b.lo, GREATEST(b.hi, b.lo + 1e-9), :bins), 1), :bins) AS bucket,
+               count(*) AS n
+        FROM s CROSS JOIN b
+        GROUP BY b.lo, b.hi, bucket
+        ORDER BY bucket"""
+    rows = await db_exec(text(sql), params, "all")
+    counts = [0] * bins
+    for r in rows:
+        counts[r["bucket"] - 1] = r["n"]
+    lo_v, hi_v = (rows[0]["lo"], rows[0]["hi"]) if rows else (lo, hi)
+    return {"lo": lo_v, "hi": hi_v, "bins": bins, "counts": counts, "total": sum(counts)}
+
+
+@app.post("/models")
+async def create_model(name: str, version: str, path: str, metric_aupr: float = 0.0, notes: str = ""):
+    new_id = await db_exec(
+        text("INSERT INTO models (name,version,path,metric_aupr,notes) VALUES (:n,:v,:p,:m,:no) RETURNING id"),
+        {"n": name, "v": version, "p": path, "m": metric_aupr, "no": notes},
+        "scalar",
+    )
+    return {"id": new_id}
 
 @app.get("/models")
-def list_models():
-    with engine.begin() as conn:
-        rows = conn.execute(text("SELECT * FROM models ORDER BY id DESC")).mappings().all()
-        return [dict(r) for r in rows]
+async def list_models():
+    return await db_exec(text("SELECT * FROM models ORDER BY id DESC"), None, "all")
 
@@ -0,0 +1,207 @@
+"""
+Потоковая загрузка векторов через COPY bgl_vectors FROM STDIN (FORMAT binary).
+Тело запроса (NDJSON или Arrow IPC stream) читается кусками из очереди,
+строки сразу кодируются в бинарный формат COPY и отдаются psycopg2 блоками
+по chunk_bytes — ни тело, ни батч целиком в памяти не держатся.
+"""
+import json, queue, struct
+import numpy as np
+
+COPY_COLUMNS = ("line_id", "alert_tag", "is_alert", "template_id", "dim", "indices", "values")
+COPY_SQL = f"COPY bgl_vectors ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT binary)"
+# компактный режим: событие без dim и веса шаблона, лишние признаки — отдельно
+EVENT_COLUMNS = ("line_id", "alert_tag", "is_alert", "template_id", "extra_indices", "extra_values")
+COPY_EVENTS_SQL = f"COPY bgl_events ({', '.join(EVENT_COLUMNS)}) FROM STDIN WITH (FORMAT binary)"
+
+PG_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PG_TRAILER = struct.pack("!h", -1)
+INT4_OID, FLOAT4_OID = 23, 700
+
+_ROW_HEAD = struct.Struct("!h")
+_INT4 = struct.Struct("!ii")          # длина поля (4) + значение
+_BOOL = struct.Struct("!i?")
+_ARR_HEAD = struct.Struct("!iiiiii")  # длина поля, ndim, has_null, oid, размер, нижняя граница
+_EMPTY_ARR = struct.Struct("!iiii")   # длина поля, ndim=0, has_null, oid
+_NULL = struct.pack("!i", -1)
+_ELEM_INT4 = np.dtype([("len", ">i4"), ("val", ">i4")])
+_ELEM_FLOAT4 = np.dtype([("len", ">i4"), ("val", ">f4")])
+
+
+class BodyReader:
+    """Файлоподобный read() поверх очереди кусков тела; None — конец тела."""
+
+    def __init__(self, chunks: queue.Queue):
+        self.chunks = chunks
+        self.buf = bytearray()
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        chunk = self.chunks.get()
+        if chunk is None:
+            self.eof = True
+            return False
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += chunk
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while (size < 0 or len(self.buf) - self.pos < size) and not self.eof:
+            self._fill()
+        stop = len(self.buf) if size < 0 else min(self.pos + size, len(self.buf))
+        out = bytes(self.buf[self.pos:stop])
+        self.pos = stop
+        return out
+
+    def __iter__(self):
+        # построчно, для NDJSON
+        while True:
+            nl = self.buf.find(b"\n", self.pos)
+            if nl >= 0:
+                line = bytes(self.buf[self.pos:nl])
+                self.pos = nl + 1
+                yield line
+            elif self.eof or not self._fill():
+                if self.pos < len(self.buf):
+                    yield bytes(self.buf[self.pos:])
+                    self.pos = len(self.buf)
+                return
+
+    @property
+    def closed(self) -> bool:
+        return False
+
+
+def _array(values, elem: np.dtype, oid: int) -> bytes:
+    n = len(values)
+    if n == 0:
+        return _EMPTY_ARR.pack(12, 0, 0, oid)
+    body = np.empty(n, dtype=elem)
+    body["len"] = 4
+    body["val"] = values
+    return _ARR_HEAD.pack(20 + 8 * n, 1, 0, oid, n, 1) + body.tobytes()
+
+def encode_row(line_id: int, alert_tag: str | None, is_alert: bool, template_id: int,
+               dim: int, indices, values) -> bytes:
+    if len(indices) != len(values):
+        raise ValueError(f"indices/values length mismatch at line_id {line_id}")
+    tag = b"" if alert_tag is None else alert_tag.encode("utf-8")
+    return b"".join((
+        _ROW_HEAD.pack(len(COPY_COLUMNS)),
+        _INT4.pack(4, line_id),
+        struct.pack("!i", len(tag)), tag,
+        _BOOL.pack(1, bool(is_alert)),
+        _INT4.pack(4, template_id),
+        _INT4.pack(4, dim),
+        _array(indices, _ELEM_INT4, INT4_OID),
+        _array(values, _ELEM_FLOAT4, FLOAT4_OID),
+    ))
+
+def split_extras(template_id: int, indices, values):
+    """
+    Компактное хранение: признак самого шаблона восстанавливается из template_idf,
+    сохраняются только остальные (None, если вектор one-hot).
+    """
+    ind = np.asarray(indices, dtype=np.int64)
+    keep = ind != template_id
+    if not keep.any():
+        return None, None
+    return ind[keep], np.asarray(values, dtype=np.float64)[keep]
+
+def encode_event(line_id: int, alert_tag: str | None, is_alert: bool, template_id: int,
+                 dim: int, indices, values) -> bytes:
+    if len(indices) != len(values):
+        raise ValueError(f"indices/values length mismatch at line_id {line_id}")
+    tag = b"" if alert_tag is None else alert_tag.encode("utf-8")
+    extra_ind, extra_val = split_extras(template_id, indices, values)
+    return b"".join((
+        _ROW_HEAD.pack(len(EVENT_COLUMNS)),
+        _INT4.pack(4, line_id),
+        struct.pack("!i", len(tag)), tag,
+        _BOOL.pack(1, bool(is_alert)),
+        _INT4.pack(4, template_id),
+        _NULL if extra_ind is None else _array(extra_ind, _ELEM_INT4, INT4_OID),
+        _NULL if extra_val is None else _array(extra_val, _ELEM_FLOAT4, FLOAT4_OID),
+    ))
+
+def ndjson_rows(body: BodyReader, encode=encode_row):
+    for n, line in enumerate(body):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            r = json.loads(line)
+            yield encode(r["line_id"], r["alert_tag"], r["is_alert"], r["template_id"],
+                         r["dim"], r["indices"], r["values"])
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            raise ValueError(f"bad NDJSON row {n}: {e}") from e
+
+def arrow_rows(body: BodyReader, encode=encode_row):
+    """Arrow IPC stream в схеме /collect_vectors?format=arrow коллектора."""
+    import pyarrow as pa
+
+    n = 0
+    try:
+        reader = pa.ipc.open_stream(pa.PythonFile(body, mode="r"))
+        for n, batch in enumerate(reader):
+            cols = {k: batch.column(k).to_pylist()
+                    for k in ("line_id", "alert_tag", "is_alert", "template_id", "dim")}
+            ind, val = batch.column("indices"), batch.column("values")
+            offsets = ind.offsets.to_numpy()
+            flat_ind = ind.values.to_numpy(zero_copy_only=False)
+            flat_val = val.values.to_numpy(zero_copy_only=False)
+            for i in range(batch.num_rows):
+                lo, hi = offsets[i], offsets[i + 1]
+                yield encode(cols["line_id"][i], cols["alert_tag"][i], cols["is_alert"][i],
+                             cols["template_id"][i], cols["dim"][i], flat_ind[lo:hi], flat_val[lo:hi])
+    except (pa.ArrowException, OSError, ValueError, KeyError, TypeError, AttributeError, struct.error) as e:
+        # обрезанный поток, чужая схема или значения вне int4 — ошибка клиента, а не 500
+        raise ValueError(f"bad Arrow batch {n}: {e}") from e
+
+
+class CopyStream:
+    """
+    Источник для cursor.copy_expert: заголовок, строки блоками не меньше
+    chunk_bytes, трейлер. Считает строки и байты для ответа.
+    """
+
+    def __init__(self, rows, chunk_bytes: int = 1 << 20):
+        self.rows = rows
+        self.chunk_bytes = chunk_bytes
+        self.pending = PG_HEADER
+        self.done = False
+        self.count = 0
+        self.bytes = 0
+        self.error: Exception | None = None
+
+    def read(self, size: int = -1) -> bytes:
+        # psycopg2 заменяет исключение из read() своим — исходное сохраняем для ответа
+        try:
+            return self._read(size)
+        except Exception as e:
+            self.error = e
+            raise
+
+    def _read(self, size: int) -> bytes:
+        parts, total = [self.pending], len(self.pending)
+        self.pending = b""
+        while not self.done and total < max(size, self.chunk_bytes):
+            row = next(self.rows, None)
+            if row is None:
+                self.done = True
+                parts.append(PG_TRAILER)
+                total += len(PG_TRAILER)
+                break
+            self.count += 1
+            parts.append(row)
+            total += len(row)
+        data = b"".join(parts)
+        if 0 < size < len(data):
+            data, self.pending = data[:size], data[size:]
+        self.bytes += len(data)
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.read(size)
@@ -1,7 +1,37 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from config import db_url
+from config import load_config, db_url
 
-engine = create_engine(db_url(), echo=False, future=True)
+DB_CFG = load_config().get("db", {}) or {}
+DRIVER = DB_CFG.get("driver", "psycopg2")        # psycopg2 | asyncpg
+STATEMENT_TIMEOUT_MS = int(DB_CFG.get("statement_timeout_ms", 0))
+
+def pool_kwargs() -> dict:
+    return dict(
+        pool_size=int(DB_CFG.get("pool_size", 5)),
+        max_overflow=int(DB_CFG.get("max_overflow", 10)),
+        pool_timeout=float(DB_CFG.get("pool_timeout", 30)),
+        pool_recycle=int(DB_CFG.get("pool_recycle", 1800)),
+        pool_pre_ping=bool(DB_CFG.get("pool_pre_ping", True)),
+    )
+
+# Синхронный движок нужен всегда: init-скрипт при старте и COPY через psycopg2
+engine = create_engine(
+    db_url(), echo=False, future=True, **pool_kwargs(),
+    connect_args={"options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"} if STATEMENT_TIMEOUT_MS else {},
+)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
+# driver: asyncpg — эндпоинты чтения/записи работают через асинхронный движок
+# без пула потоков; кэш подготовленных выражений asyncpg настраивается отдельно
+async_engine = None
+if DRIVER == "asyncpg":
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    server_settings = {"statement_timeout": str(STATEMENT_TIMEOUT_MS)} if STATEMENT_TIMEOUT_MS else {}
+    async_engine = create_async_engine(
+        db_url("asyncpg") + f"?prepared_statement_cache_size={int(DB_CFG.get('prepared_statement_cache_size', 100))}",
+        echo=False, **pool_kwargs(),
+        connect_args={"server_settings": server_settings,
+                      "statement_cache_size": int(DB_CFG.get("statement_cache_size", 100))},
+    )
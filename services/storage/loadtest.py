@@ -0,0 +1,87 @@
+"""
+Нагрузочный тест storage: N параллельных клиентов в течение duration секунд
+шлют смесь запросов (bulk-вставка, чтение страницы векторов, список моделей).
+Только стандартная библиотека, запускается из любого контейнера или с хоста:
+
+    python loadtest.py --url http://localhost:8002 --clients 1,8,32 --duration 20
+
+Для сравнения драйверов тест прогоняется дважды — с db.driver: psycopg2
+и db.driver: asyncpg в configs/storage.yaml (после перезапуска сервиса).
+"""
+import argparse, json, random, time, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def request(url: str, method: str = "GET", body=None, timeout: float = 60.0):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method,
+                                 headers={"Content-Type": "application/json"} if data else {})
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        return r.read()
+
+def make_rows(n: int, dim: int) -> list[dict]:
+    rows = []
+    for _ in range(n):
+        t = random.randrange(dim)
+        rows.append({"line_id": random.randrange(1 << 30), "alert_tag": "-", "is_alert": False,
+                     "template_id": t, "dim": dim, "indices": [t], "values": [1.0]})
+    return rows
+
+def client(args, deadline: float) -> dict:
+    stats = {"requests": 0, "errors": 0, "rows_in": 0, "rows_out": 0, "lat": []}
+    rows = make_rows(args.bulk_rows, args.dim)
+    while time.perf_counter() < deadline:
+        op = random.random()
+        t0 = time.perf_counter()
+        try:
+            if op < args.write_share:
+                request(f"{args.url}/bgl/vectors/bulk", "POST", rows)
+                stats["rows_in"] += len(rows)
+            elif op < args.write_share + (1 - args.write_share) * 0.9:
+                out = request(f"{args.url}/bgl/vectors?limit={args.read_rows}&only_non_alert=true")
+                stats["rows_out"] += len(json.loads(out))
+            else:
+                request(f"{args.url}/models")
+            stats["requests"] += 1
+        except Exception:
+            stats["errors"] += 1
+        stats["lat"].append(time.perf_counter() - t0)
+    return stats
+
+def run(args, clients: int) -> dict:
+    deadline = time.perf_counter() + args.duration
+    with ThreadPoolExecutor(clients) as ex:
+        parts = list(ex.map(lambda _: client(args, deadline), range(clients)))
+    lat = sorted(x for p in parts for x in p["lat"])
+    total = {k: sum(p[k] for p in parts) for k in ("requests", "errors", "rows_in", "rows_out")}
+    pct = lambda q: round(lat[min(int(q * len(lat)), len(lat) - 1)] * 1000, 1) if lat else None
+    return {
+        "clients": clients,
+        "req_per_sec": round(total["requests"] / args.duration, 1),
+        "rows_in_per_sec": int(total["rows_in"] / args.duration),
+        "rows_out_per_sec": int(total["rows_out"] / args.duration),
+        "errors": total["errors"],
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Storage load test")
+    ap.add_argument("--url", default="http://localhost:8002")
+    ap.add_argument("--clients", default="1,4,16,32", help="список уровней параллельности через запятую")
+    ap.add_argument("--duration", type=float, default=15.0, help="секунд на уровень")
+    ap.add_argument("--write-share", type=float, default=0.3, help="доля bulk-вставок")
+    ap.add_argument("--bulk-rows", type=int, default=500)
+    ap.add_argument("--read-rows", type=int, default=1000)
+    ap.add_argument("--dim", type=int, default=2000)
+    args = ap.parse_args()
+
+    health = json.loads(request(f"{args.url}/health"))
+    print(f"storage {args.url}, driver={health.get('driver')}")
+    for n in (int(x) for x in args.clients.split(",")):
+        print(json.dumps(run(args, n)))
+
+
+if __name__ == "__main__":
+    main()
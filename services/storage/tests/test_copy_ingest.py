@@ -0,0 +1,57 @@
+import os, sys, queue
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from copy_ingest import BodyReader, arrow_rows, ndjson_rows
+
+pa = pytest.importorskip("pyarrow")
+
+
+def body_of(data: bytes, chunk: int = 7) -> BodyReader:
+    chunks: queue.Queue = queue.Queue()
+    for i in range(0, len(data), chunk):
+        chunks.put(data[i:i + chunk])
+    chunks.put(None)
+    return BodyReader(chunks)
+
+
+def arrow_body(line_ids) -> bytes:
+    n = len(line_ids)
+    batch = pa.record_batch({
+        "line_id": pa.array(line_ids, pa.int64()),
+        "alert_tag": pa.array(["-"] * n),
+        "is_alert": pa.array([False] * n),
+        "template_id": pa.array([1] * n, pa.int32()),
+        "dim": pa.array([4] * n, pa.int32()),
+        "indices": pa.array([[1]] * n, pa.list_(pa.int32())),
+        "values": pa.array([[1.0]] * n, pa.list_(pa.float32())),
+    })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as w:
+        w.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def test_arrow_rows_encodes_every_row():
+    assert len(list(arrow_rows(body_of(arrow_body([0, 1, 2]))))) == 3
+
+
+@pytest.mark.parametrize("cut", [5, 0.5, -3])
+def test_truncated_arrow_body_is_a_client_error(cut):
+    data = arrow_body(list(range(100)))
+    end = int(len(data) * cut) if isinstance(cut, float) else cut
+    with pytest.raises(ValueError, match="bad Arrow"):
+        list(arrow_rows(body_of(data[:end])))
+
+
+def test_arrow_value_out_of_int4_is_a_client_error():
+    with pytest.raises(ValueError, match="bad Arrow"):
+        list(arrow_rows(body_of(arrow_body([2 ** 40]))))
+
+
+def test_truncated_ndjson_body_is_a_client_error():
+    data = b'{"line_id": 1, "alert_tag": "-", "is_alert": false, "template_id": 1, "dim": 4, "ind'
+    with pytest.raises(ValueError, match="bad NDJSON"):
+        list(ndjson_rows(body_of(data)))
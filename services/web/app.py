@@ -1,6 +1,7 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.responses import FileResponse
-import requests, os, time
+import requests, os, sys, time, json, base64
+from array import array
 from jinja2 import Template
 from config import load_config
 
@@ -31,64 +32,183 @@ def collect_templates():
         "collector_dataset": h.get("dataset_path"),
     }
 
-@app.post("/scenario/collect_vectors_batch")
-def collect_vectors_batch(offset: int = 0, limit: int = 2000):
-
-    r = requests.get(f"{COLLECTOR_URL}/collect_vectors",
-                     params={"offset": offset, "limit": limit},
-                     timeout=7200)
+def _b64(a: array) -> str:
+    if sys.byteorder == "big":
+        a.byteswap()
+    return base64.b64encode(a.tobytes()).decode()
+
+class CSRBuilder:
+    """Строки storage -> {"csr": ...} для ML: int32/float32 в base64 вместо списка объектов."""
+
+    def __init__(self):
+        self.indptr, self.indices, self.data = array("i", [0]), array("i"), array("f")
+        self.dim = None
+
+    def add(self, r: dict):
+        if self.dim is None:
+            self.dim = r["dim"]
+        self.indices.extend(r["indices"])
+        self.data.extend(r["values"])
+        self.indptr.append(len(self.indices))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def payload(self) -> dict:
+        return {"csr": {"shape": [len(self), self.dim], "indptr": _b64(self.indptr),
+                        "indices": _b64(self.indices), "data": _b64(self.data)}}
+
+def pull_vectors(url: str, params: dict) -> CSRBuilder:
+    # NDJSON из серверного курсора storage: строки разбираются по одной, без списка целиком
+    vectors = CSRBuilder()
+    with requests.get(url, params=params, stream=True, timeout=7200) as rs:
+        rs.raise_for_status()
+        for line in rs.iter_lines():
+            if line:
+                vectors.add(json.loads(line))
+    return vectors
+
+def push_idf() -> dict:
+    """Веса шаблонов коллектора -> storage.template_idf (нужны в компактном режиме)."""
+    w = requests.get(f"{COLLECTOR_URL}/idf", timeout=600)
+    w.raise_for_status()
+    r = requests.put(f"{STORAGE_URL}/bgl/template_idf", json={"weights": w.json()["weights"]}, timeout=600)
     r.raise_for_status()
-    payload = r.json()
-    vectors = payload.get("data", [])
-    fetched = len(vectors)
-
-    if fetched == 0:
-        return {"inserted": 0, "fetched": 0, "offset": offset, "limit": limit}
+    return r.json()
 
+@app.post("/scenario/sync_idf")
+def sync_idf():
+    return push_idf()
 
-    rb = requests.post(f"{STORAGE_URL}/bgl/vectors/bulk", json=vectors, timeout=7200)
+@app.post("/scenario/collect_vectors_batch")
+def collect_vectors_batch(offset: int = 0, limit: int = 2000):
+    # NDJSON коллектора передаётся в COPY-загрузку storage потоком, без разбора в web
+    with requests.get(f"{COLLECTOR_URL}/collect_vectors",
+                      params={"offset": offset, "limit": limit, "format": "ndjson"},
+                      stream=True, timeout=7200) as r:
+        r.raise_for_status()
+        rb = requests.post(f"{STORAGE_URL}/bgl/vectors/ingest", data=r.iter_content(1 << 20),
+                           headers={"Content-Type": "application/x-ndjson"}, timeout=7200)
     rb.raise_for_status()
-    inserted = rb.json().get("inserted", 0)
+    res = rb.json()
+    inserted = res.get("inserted", 0)
+    # IDF дрейфует с каждой досборкой: обновляем маленькую таблицу весов, события не трогаем
+    idf = push_idf() if inserted else None
 
     return {
         "inserted": inserted,
-        "fetched": fetched,
+        "fetched": inserted,
         "offset": offset,
-        "limit": limit
+        "limit": limit,
+        "rows_per_sec": res.get("rows_per_sec"),
+        "idf": idf,
     }
 
 @app.post("/scenario/train_model_vectors")
-def train_model_vectors(n: int = 50000):
-    rows = requests.get(f"{STORAGE_URL}/bgl/vectors",
-                        params={"limit": n, "offset": 0, "only_non_alert": True},
-                        timeout=7200).json()
-    if not rows:
-        raise HTTPException(400, "Нет non-alert векторов для обучения")
+def train_model_vectors(n: int = 50000,
+                        sample: str = Query("latest", pattern="^(latest|uniform|stratified|window)$"),
+                        seed: int = 0, per_template_cap: int | None = None,
+                        last_lines: int | None = None, background: bool = False):
+    # latest — первые n non-alert строк; остальное — выборка на стороне storage (/bgl/vectors/sample).
+    # Данные web не читает: ML получает описание набора и забирает строки из storage сам
+    desc = {"n": n, "sample": sample, "seed": seed, "only_non_alert": True}
+    if per_template_cap is not None:
+        desc["per_template_cap"] = per_template_cap
+    if last_lines is not None:
+        desc["last_lines"] = last_lines
+    if background:
+        # задача в очереди ML: сразу возвращается job_id, статус — /scenario/jobs/{job_id}
+        r = requests.post(f"{ML_URL}/jobs/train", json=desc, timeout=60)
+    else:
+        r = requests.post(f"{ML_URL}/train_vectors/from_storage", json=desc, timeout=7200)
+    if r.status_code in (400, 429):
+        raise HTTPException(r.status_code, r.json().get("detail"))
+    r.raise_for_status()
+    return r.json()
 
-    vectors = [{"dim": r["dim"], "indices": r["indices"], "values": r["values"]} for r in rows]
-    r = requests.post(f"{ML_URL}/train_vectors", json={"vectors": vectors}, timeout=7200)
+@app.get("/scenario/jobs/{job_id}")
+def training_job(job_id: str):
+    r = requests.get(f"{ML_URL}/jobs/{job_id}", timeout=30)
+    if r.status_code == 404:
+        raise HTTPException(404, "job not found")
+    r.raise_for_status()
+    return r.json()
+
+@app.post("/scenario/jobs/{job_id}/cancel")
+def cancel_training_job(job_id: str):
+    r = requests.post(f"{ML_URL}/jobs/{job_id}/cancel", timeout=30)
+    if r.status_code == 404:
+        raise HTTPException(404, "job not found")
+    r.raise_for_status()
+    return r.json()
+
+@app.post("/scenario/update_model_vectors")
+def update_model_vectors(last_lines: int = 20000, n: int = 10000, seed: int = 0):
+    """Дообучение онлайн-модели (engine: online) на выборке из последних last_lines строк."""
+    vectors = pull_vectors(f"{STORAGE_URL}/bgl/vectors/sample",
+                           {"n": n, "mode": "window", "last_lines": last_lines, "seed": seed,
+                            "only_non_alert": True, "format": "ndjson"})
+    if not len(vectors):
+        raise HTTPException(400, "Нет новых non-alert векторов")
+
+    r = requests.post(f"{ML_URL}/update_vectors", json=vectors.payload(), timeout=7200)
+    if r.status_code in (400, 409):
+        raise HTTPException(r.status_code, r.json().get("detail"))
     r.raise_for_status()
     return r.json()
 
 
 @app.post("/scenario/infer_last_vectors")
-def infer_last_vectors(n: int = 1000):
+def infer_last_vectors(n: int = 1000, model_name: str | None = None, model_version: str | None = None,
+                       store: bool = True, return_scores: bool = True):
+    """
+    Оценки сохраняются под именем и версией модели, которая их посчитала (из ответа
+    ML /predict_vectors), поэтому переобучение не перезаписывает прежние оценки.
+    model_name/model_version переопределяют их явно.
+    """
     rows = requests.get(f"{STORAGE_URL}/bgl/vectors",
                         params={"limit": n, "offset": 0, "only_non_alert": False},
                         timeout=7200).json()
     if not rows:
         raise HTTPException(400, "Нет векторов для инференса")
 
-    vectors = [{"dim": r["dim"], "indices": r["indices"], "values": r["values"]} for r in rows]
-    r = requests.post(f"{ML_URL}/predict_vectors", json={"vectors": vectors}, timeout=7200)
+    vectors = CSRBuilder()
+    for row in rows:
+        vectors.add(row)
+    r = requests.post(f"{ML_URL}/predict_vectors", json=vectors.payload(), timeout=7200)
     r.raise_for_status()
-    return {"prediction": r.json(), "requested": n, "received": len(rows)}
+    pred = r.json()
+
+    # оценки сохраняются один раз в bgl_scores; отчёты читают top-k/гистограмму оттуда
+    model_name = model_name or pred["model"]
+    model_version = model_version or pred["model_version"]
+    stored = 0
+    if store:
+        rs = requests.post(f"{STORAGE_URL}/bgl/scores/bulk", json={
+            "model_name": model_name, "model_version": model_version,
+            "line_ids": [row["line_id"] for row in rows],
+            "scores": pred["scores"], "labels": pred["labels"],
+        }, timeout=7200)
+        rs.raise_for_status()
+        stored = rs.json()["inserted"]
+    out = {"requested": n, "received": len(rows), "stored": stored,
+           "model_name": model_name, "model_version": model_version}
+    if return_scores:
+        out["prediction"] = pred
+    return out
 
 
 @app.get("/scenario/report", response_class=FileResponse)
 def report():
     models = requests.get(f"{STORAGE_URL}/models", timeout=30).json()
     summary = requests.get(f"{ML_URL}/summary", timeout=30).json()
+    # сохранённые оценки текущей модели ML из bgl_scores, без повторного скоринга
+    vec_model, vec_version = summary.get("vec_model_name"), summary.get("vec_model_version")
+    top = []
+    if vec_model and vec_version:
+        rt = requests.get(f"{STORAGE_URL}/bgl/scores/top",
+                          params={"model_name": vec_model, "model_version": vec_version, "k": 20}, timeout=30)
+        top = rt.json() if rt.ok else []
     template_str = """
     <html>
     <head><meta charset="utf-8"><title>OCSVM Report (BGL, vectors)</title></head>
@@ -105,6 +225,12 @@ def report():
         <li>{{ m.id }} | {{ m.name }} | {{ m.version }} | {{ m.path }} | AUPR={{ m.metric_aupr }}</li>
       {% endfor %}
       </ul>
+      <h2>Самые аномальные строки ({{ vec_model }} {{ vec_version }})</h2>
+      <ul>
+      {% for t in top %}
+        <li>line {{ t.line_id }} | score={{ "%.4f"|format(t.score) }} | label={{ t.label }}</li>
+      {% endfor %}
+      </ul>
       <p>Генерация: {{ ts }}</p>
       <p>Примечание: шаблоны и IDF собирает C++-сборщик; обучение и инференс работают на разрежённых векторах.</p>
     </body>
@@ -116,6 +242,9 @@ def report():
         vec_model_path=summary.get("vec_model_path"),
         vec_exists=summary.get("vec_exists"),
         models=models,
+        vec_model=vec_model,
+        vec_version=vec_version,
+        top=top,
         ts=time.ctime()
     )
     out_path = os.path.join(REPORT_DIR, "report.html")